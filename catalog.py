@@ -0,0 +1,226 @@
+#! /usr/bin/env python3
+# SQLite catalog of the flights in a collection of SD card images and mission files.
+#
+# Indexing walks a directory tree and, for each file with a superblock, records its flight table, a hash
+# of each flight's raw blocks and a summary of each flight (the one saved by telem-parser.py if there is
+# one, otherwise a scan of its block headers). Files that haven't changed size or modification time since
+# they were last indexed are skipped, and files are read in parallel. The same flight copied to several
+# images or mission files has the same hash, so duplicates can be found without comparing the files.
+# Images with several CU InSpace partitions are read through partitions.open_image, so a flight continued
+# across partitions is catalogued as one, just like telem-parser.py parses it.
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from parse_cache import flight_hash
+from partitions import open_image
+from summary import find_event, read_summary, scan_flight
+from superblock import SuperBlock, find_superblock
+
+# Default catalog database, next to the out and missions directories
+CATALOG_PATH = Path.cwd().joinpath("catalog.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    superblock_addr INTEGER,
+    version INTEGER,
+    continued INTEGER,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flights (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    flight_num INTEGER NOT NULL,
+    first_block INTEGER NOT NULL,
+    num_blocks INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    hash TEXT,
+    first_time REAL,
+    last_time REAL,
+    gnss_blocks INTEGER,
+    max_altitude REAL,
+    apogee_time REAL,
+    summary TEXT,
+    PRIMARY KEY (file_id, flight_num)
+);
+CREATE INDEX IF NOT EXISTS flights_hash ON flights(hash);
+CREATE INDEX IF NOT EXISTS flights_timestamp ON flights(timestamp);
+"""
+
+
+def index_file(path: Path, outdir: Path):
+    """ Reads the flights of a file, returns (superblock address, superblock, [(flight, hash, summary)]),
+    or None if it has no superblock """
+    with open_image(path) as file:
+        # Size of the data in the file, which for a compressed mission file is more than the file's size
+        size = file.seek(0, 2)
+        addr = find_superblock(file)
+        if addr is None:
+            return None
+        file.seek(addr * 512)
+        sb = SuperBlock.from_bytes(file.read(512))
+
+        # Summaries saved by telem-parser.py run from the current directory on this file
+        try:
+            imagedir = outdir.joinpath(path.relative_to(Path.cwd()))
+        except ValueError:
+            imagedir = None
+
+        flights = []
+        for i, flight in enumerate(sb.flights):
+            if (addr + flight.first_block + flight.num_blocks) * 512 > size:
+                # Only the superblock (or part of the flight) is in this file
+                flights.append((flight, None, None))
+                continue
+            summary = read_summary(imagedir, i, flight) if imagedir is not None else None
+            if summary is None:
+                summary = scan_flight(file, addr, flight)
+            flights.append((flight, flight_hash(file, addr, flight), summary))
+    return addr, sb, flights
+
+
+class Catalog:
+    def __init__(self, path: Path = CATALOG_PATH):
+        self.path: Path = Path(path).resolve()
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def index(self, root: Path, outdir: Path = Path.cwd().joinpath("out"), jobs: int = None):
+        """ Indexes every file under a directory, returns (files indexed, files skipped as unchanged) """
+        known = dict((path, (size, mtime)) for path, size, mtime in
+                     self.db.execute("SELECT path, size, mtime FROM files"))
+
+        to_index = []
+        seen = set()
+        skipped = 0
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = Path(dirpath, name).resolve()
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                seen.add(str(path))
+                if path == self.path:
+                    continue
+                if st.st_size < 512 or known.get(str(path)) == (st.st_size, st.st_mtime):
+                    skipped += 1
+                    continue
+                to_index.append((path, st.st_size, st.st_mtime))
+
+        # Files that were indexed under this directory but have gone
+        prefix = str(Path(root).resolve()) + os.sep
+        gone = [path for path in known if path.startswith(prefix) and path not in seen]
+        self.db.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in gone))
+
+        with ThreadPoolExecutor(jobs) as executor:
+            results = executor.map(lambda f: index_file(f[0], outdir), to_index)
+            for (path, size, mtime), result in zip(to_index, results):
+                self._add(path, size, mtime, result)
+        self.db.commit()
+        return len(to_index), skipped
+
+    def _add(self, path: Path, size: int, mtime: float, result):
+        self.db.execute("DELETE FROM files WHERE path = ?", (str(path),))
+        if result is None:
+            # Still recorded so that it isn't read again until it changes
+            self.db.execute("INSERT INTO files (path, size, mtime, indexed_at) VALUES (?, ?, ?, ?)",
+                            (str(path), size, mtime, time.time()))
+            return
+
+        addr, sb, flights = result
+        file_id = self.db.execute("INSERT INTO files (path, size, mtime, superblock_addr, version, continued, "
+                                  "indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (str(path), size, mtime, addr, sb.version, sb.continued, time.time())).lastrowid
+        for i, (flight, hash_, summary) in enumerate(flights):
+            summary = summary or dict()
+            altitude = summary.get("sensors", {}).get("altitude")
+            self.db.execute("INSERT INTO flights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (file_id, i, flight.first_block, flight.num_blocks, flight.timestamp, hash_,
+                             summary.get("first_time"), summary.get("last_time"),
+                             summary.get("block_type_counts", {}).get("GNSSLocationBlock"),
+                             altitude["max"]["altitude"] if altitude is not None else None,
+                             find_event(summary, "apogee"), json.dumps(summary) if summary else None))
+
+    def query(self, since: datetime = None, until: datetime = None, gnss: bool = False,
+              min_altitude: float = None):
+        """ Returns (path, flight number, timestamp, length in blocks, hash) of each matching flight """
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(int(since.timestamp()))
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(int(until.timestamp()))
+        if gnss:
+            conditions.append("gnss_blocks > 0")
+        if min_altitude is not None:
+            conditions.append("max_altitude >= ?")
+            params.append(min_altitude)
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions) != 0 else ""
+        return self.db.execute("SELECT path, flight_num, timestamp, num_blocks, hash FROM flights "
+                               f"JOIN files ON files.id = flights.file_id {where} "
+                               "ORDER BY timestamp, path, flight_num", params).fetchall()
+
+    def duplicates(self):
+        """ Returns {hash: [(path, flight number)]} for each flight found in more than one place """
+        dups = dict()
+        for hash_, path, flight_num in self.db.execute(
+                "SELECT hash, path, flight_num FROM flights JOIN files ON files.id = flights.file_id "
+                "WHERE hash IN (SELECT hash FROM flights WHERE hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1) "
+                "ORDER BY hash, path, flight_num"):
+            dups.setdefault(hash_, []).append((path, flight_num))
+        return dups
+
+
+def _date(text: str) -> datetime:
+    return datetime.fromisoformat(text).replace(tzinfo=timezone.utc)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Catalog the flights in SD card images and mission files.")
+    arg_parser.add_argument("--db", type=Path, default=CATALOG_PATH, help="catalog database (default: ./catalog.db)")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    index_parser = subparsers.add_parser("index", help="index the files under a directory")
+    index_parser.add_argument("directory", type=Path)
+    index_parser.add_argument("--jobs", type=int, help="number of files read at once")
+    query_parser = subparsers.add_parser("query", help="list flights")
+    query_parser.add_argument("--since", type=_date, help="only flights on or after a date (YYYY-MM-DD, UTC)")
+    query_parser.add_argument("--until", type=_date, help="only flights before a date (YYYY-MM-DD, UTC)")
+    query_parser.add_argument("--gnss", action="store_true", help="only flights with GNSS locations")
+    query_parser.add_argument("--min-altitude", type=float, metavar="M",
+                              help="only flights that reached an altitude (needs a parsed summary)")
+    subparsers.add_parser("duplicates", help="list flights found in more than one file")
+    args = arg_parser.parse_args()
+
+    catalog = Catalog(args.db)
+    match args.command:
+        case "index":
+            indexed, skipped = catalog.index(args.directory, jobs=args.jobs)
+            print(f"Indexed {indexed} file{'s' if indexed != 1 else ''}, {skipped} unchanged or too small.")
+        case "query":
+            for path, flight_num, timestamp, num_blocks, hash_ in catalog.query(args.since, args.until, args.gnss,
+                                                                                args.min_altitude):
+                when = datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{path} flight {flight_num}: {when}, {num_blocks} blocks, "
+                      f"hash {hash_[:16] if hash_ is not None else 'unknown (superblock only)'}")
+        case "duplicates":
+            for hash_, places in catalog.duplicates().items():
+                print(f"{hash_[:16]}:")
+                for path, flight_num in places:
+                    print(f"    {path} flight {flight_num}")
+    catalog.close()
@@ -0,0 +1,267 @@
+# Library interface to the telemetry parser, for scripts and services that would otherwise have to run
+# telem-parser.py in a subprocess.
+#
+# parse_image() parses the flights of an SD card image or mission file into CSV files like the parser's
+# "Parse telemetry into CSV files" command, and iter_blocks() generates the blocks of its flights for use
+# in Python. telem-parser.py is a command line interface on top of this module. Files are opened with
+# partitions.open_image, so flights continued across partitions are read as one.
+#
+# Importing this module only imports what finding flights needs. Everything else (the block decoders and
+# handlers, the parse cache, profiling, and the downsampling and pyramid handlers, which use NumPy) is
+# imported by the functions that use it, so a script that only lists flights doesn't pay for them.
+# import_bench.py checks the import time.
+#
+#   import cuinspace_telemetry
+#   summaries = cuinspace_telemetry.parse_image("full", flights=[0])
+#   for flight_num, block in cuinspace_telemetry.iter_blocks("full"):
+#       ...
+
+import os
+from functools import partial
+from pathlib import Path
+
+from superblock import SuperBlock, Flight, superblock_sector
+
+MISSION_EXTENSION = "mission"
+
+
+def image_dir(path, outdir: Path = None) -> Path:
+    """ Folder the outputs of an image's flights go in: out/<path> in the current directory, or outdir/<path>
+    (with an absolute path, or a relative one going up out of the current directory, taken as its absolute
+    path relative to the root) """
+    path = Path(os.path.normpath(path))
+    if path.parts[:1] == ("..",):
+        path = path.resolve()
+    if path.is_absolute():
+        path = path.relative_to(path.anchor)
+    return (outdir if outdir is not None else Path.cwd().joinpath("out")).joinpath(path)
+
+
+def read_superblock(file) -> tuple[int, SuperBlock]:
+    """ Sector and contents of the superblock in an SD card image or mission file. Raises ValueError if it
+    has none. """
+    superblock_addr = superblock_sector(file)
+    if superblock_addr is None:
+        raise ValueError("No CUInSpace partition found in MBR.")
+
+    file.seek(superblock_addr * 512)
+    try:
+        return superblock_addr, SuperBlock.from_bytes(file.read(512))
+    except ValueError:
+        raise ValueError("Could not parse superblock. recovery.py can rebuild it from the flights on the card.")
+
+
+def read_flights(path) -> list[Flight]:
+    """ The flights recorded in an SD card image or mission file """
+    from partitions import open_image
+
+    with open_image(path) as file:
+        return read_superblock(file)[1].flights
+
+
+def make_handler_factories(timeline: float = None, resample_method: str = "hold", downsample: int = None,
+                           downsample_method: str = "lttb", pyramid: bool = False) -> list:
+    """ Handler factories for a parse: the default and plugin handlers, plus a timeline resampled to
+    timeline Hz (0 to not resample) if timeline is given, outputs downsampled to about downsample points if
+    it is given, and pyramids if pyramid is true """
+    from handlers import load_handlers
+
+    handler_factories = load_handlers()
+    if timeline is not None:
+        from timeline import TimelineHandler
+
+        handler_factories.append(partial(TimelineHandler, timeline or None, resample_method))
+    if downsample is not None:
+        from downsample import DOWNSAMPLE_HANDLERS
+
+        handler_factories.extend(partial(h, downsample, downsample_method) for h in DOWNSAMPLE_HANDLERS)
+    if pyramid:
+        from pyramid import PYRAMID_HANDLERS
+
+        handler_factories.extend(PYRAMID_HANDLERS)
+    return handler_factories
+
+
+def event_window(imagedir: Path, flight_num: int, flight: Flight, event: str, before: str, after: str):
+    """ Window of mission times around an event in a flight's summary, or None if it can't be found """
+    from summary import find_event, read_summary
+
+    summary = read_summary(imagedir, flight_num, flight)
+    if summary is None:
+        print(f"Flight {flight_num} has no summary, parse it fully to find its events.")
+        return None
+    # Events are only found by a full parse, a summary from a header scan (or an older parser) has none
+    if summary.get("scanned") or "events" not in summary:
+        print(f"Flight {flight_num} hasn't been fully parsed, parse it fully to find its events.")
+        return None
+
+    time = find_event(summary, event)
+    if time is None:
+        print(f"No {event} event found in flight {flight_num}.")
+        return None
+    return time - float(before), time + float(after)
+
+
+def parse_flights(file, imagedir: Path, superblock_addr: int, flights: list[Flight], selected: list[int],
+                  handler_factories=None, window: tuple[float, float] = None, around: tuple[str, str, str] = None,
+                  cache=None, memory=None, progress=None, profiles: dict = None, cprofile: bool = False):
+    """ Parses the selected flights of an open image into imagedir. Only the mission times in a window
+    (t0, t1) in ms are parsed if window is given, or those around an event if around is given as (event,
+    before, after). A ParseCache is used for full parses if cache is given. progress is called with each
+    flight's number and Flight for the Progress to report to (or None). If profiles is given, each flight
+    is parsed under a Profiler, which is stored in it by flight number, and if cprofile is true each
+    flight's parse is run under cProfile with its stats saved in imagedir. Flights skipped because they
+    have already been parsed aren't profiled. """
+    from flight_parser import parse_flight
+
+    profiling = profiles is not None or cprofile
+    for i, flight in enumerate(flights):
+        if i not in selected:
+            continue
+        flight_window = window
+        if around is not None:
+            flight_window = event_window(imagedir, i, flight, *around)
+            if flight_window is None:
+                continue
+        flight_progress = progress(i, flight) if progress is not None else None
+
+        if flight_window is None and cache is not None and not profiling:
+            from parse_cache import parse_flight_cached
+
+            parse_flight_cached(cache, file, imagedir, superblock_addr, i, flight, handler_factories,
+                                progress=flight_progress, memory=memory)
+        elif profiling:
+            from profiling import Profiler, cprofile_call
+
+            profiler = Profiler() if profiles is not None else None
+            pstats_path = imagedir.joinpath(f"flight_{i}.pstats")
+            if cprofile:
+                parsed = cprofile_call(pstats_path, parse_flight, file, imagedir, superblock_addr, i, flight,
+                                       handler_factories=handler_factories, window=flight_window,
+                                       profiler=profiler, progress=flight_progress, memory=memory)
+            else:
+                parsed = parse_flight(file, imagedir, superblock_addr, i, flight, handler_factories=handler_factories,
+                                      window=flight_window, profiler=profiler, progress=flight_progress,
+                                      memory=memory)
+            if not parsed:
+                # Nothing was parsed, so there is nothing to profile
+                print(f"Flight {i} was skipped and isn't profiled, remove its output folder to profile it.")
+                if cprofile:
+                    pstats_path.unlink(missing_ok=True)
+                continue
+            if profiler is not None:
+                profiles[i] = profiler
+                print(profiler.format())
+        else:
+            parse_flight(file, imagedir, superblock_addr, i, flight, handler_factories=handler_factories,
+                         window=flight_window, progress=flight_progress, memory=memory)
+
+
+def parse_image(path, flights: list[int] = None, outdir: Path = None, handler_factories=None,
+                window: tuple[float, float] = None, around: tuple[str, str, str] = None, cache=None,
+                memory=None, progress=None) -> dict[int, dict]:
+    """ Parses the flights of an SD card image or mission file (all of them, or the numbers in flights)
+    into CSV files in image_dir(path, outdir), like telem-parser.py. The other arguments are as for
+    parse_flights. Returns the summaries of the parsed flights by flight number (only full parses have
+    them). Raises ValueError if the file has no superblock. """
+    from partitions import open_image
+    from summary import read_summary
+
+    imagedir = image_dir(path, outdir)
+    imagedir.mkdir(parents=True, exist_ok=True)
+    with open_image(path, buffer_size=memory.reader_bytes if memory is not None else -1) as file:
+        superblock_addr, superblock = read_superblock(file)
+        selected = range(len(superblock.flights)) if flights is None else flights
+        parse_flights(file, imagedir, superblock_addr, superblock.flights, selected, handler_factories,
+                      window, around, cache, memory, progress)
+
+    summaries = dict()
+    for i in selected:
+        summary = read_summary(imagedir, i)
+        if summary is not None and window is None and around is None:
+            summaries[i] = summary
+    return summaries
+
+
+def iter_blocks(path, flights: list[int] = None, raw: bool = False):
+    """ Generates (flight number, block) for each block in the flights of an SD card image or mission file
+    (all of them, or the numbers in flights), with blocks decoded into SDBlocks, or as their raw bytes if
+    raw is true. Blocks of unknown types are skipped when decoding. Raises ValueError if the file has no
+    superblock. """
+    from flight_parser import gen_raw_blocks
+    from partitions import open_image
+    from sd_block import SDBlock
+
+    with open_image(path) as file:
+        superblock_addr, superblock = read_superblock(file)
+        for i, flight in enumerate(superblock.flights):
+            if flights is not None and i not in flights:
+                continue
+            file.seek((superblock_addr + flight.first_block) * 512)
+            for rawblock in gen_raw_blocks(file, flight.num_blocks):
+                if raw:
+                    yield i, rawblock
+                    continue
+                block_class, block_type, _ = SDBlock.parse_header(rawblock)
+                if SDBlock.lookup_class(block_class, block_type) is not None:
+                    yield i, SDBlock.from_bytes(rawblock)
+
+
+def sanitize_superblock(superblock: bytearray, flights_to_keep: list[Flight]):
+    """ Sanitizes the superblock by shifting flights and only keeping specified flights for telemetry mission """
+    flight_blocks_stored = 1
+    # Loop over every flight spot
+    for i in range(32):
+        # Location of flight struct in superblock
+        flight_start = 0x60 + (12 * i)
+
+        # Zero out unused flight data holders
+        if len(flights_to_keep) == 0:
+            superblock[flight_start:flight_start + 12] = b'\x00' * 12
+            continue
+
+        # Shift flight block numbering to properly match
+        flight = flights_to_keep[0]
+        flight.first_block = flight_blocks_stored
+        flight_blocks_stored += flight.num_blocks
+
+        # Output adjusted flight to superblock
+        superblock[flight_start:flight_start + 12] = flight.to_bytes()
+
+        # Remove flight shifted
+        flights_to_keep.pop(0)
+    return superblock
+
+
+def create_telemetry_mission(file, mission_filename: str, superblock_addr: int,
+                             flights_list: list[Flight], missions_dir: Path = None) -> Path:
+    """ CONSTRUCT TELEMETRY MISSION FILE FROM SD CARD IMAGE FILE """
+    """ FIRST BLOCK IS A SUPERBLOCK, FOLLOWED BY SD DATA BLOCKS """
+
+    # Written to missions_dir (./missions by default), and its path returned
+    if missions_dir is None:
+        missions_dir = Path.cwd().joinpath("missions")
+    missions_dir.mkdir(parents=True, exist_ok=True)
+    output_file_path = missions_dir.joinpath(f"{mission_filename}.{MISSION_EXTENSION}")
+
+    # Generates the new telemetry mission file
+    with open(output_file_path, "wb") as outfile:
+        # Sanitize superblock
+        file.seek(superblock_addr * 512)
+        # Sanitize a copy of each flight, since they are still needed to find the blocks to copy
+        new_sb = sanitize_superblock(bytearray(file.read(512)),
+                                     [Flight(f.first_block, f.num_blocks, f.timestamp) for f in flights_list])
+        outfile.write(new_sb)
+
+        # Show user the new flight details
+        print("NEW TELEMETRY FLIGHT DETAILS")
+        SuperBlock.from_bytes(new_sb).output()
+
+        # Output corresponding flight blocks to output file
+        for flight_to_copy in flights_list:
+            file.seek((superblock_addr + flight_to_copy.first_block) * 512)
+
+            # Copy each block to new file
+            for i in range(flight_to_copy.num_blocks):
+                outfile.write(file.read(512))
+    return output_file_path
@@ -7,6 +7,7 @@
 
 import struct
 from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
 from enum import IntEnum
 from block import DataBlockSubtype, BlockException, BlockUnknownException
 from misc import converter
@@ -809,6 +810,8 @@ class KX134AccelerometerDataBlock(DataBlock):
         self.rolloff: KX134LPFRolloff = rolloff
         self.resolution: KX134Resolution = resolution
         self.samples: list = samples
+        # Samples dropped from the end by trim_samples, which still count towards the times of the rest
+        self.samples_after: int = 0
 
         self.sample_period = 1 / self.odr.samples_per_sec
 
@@ -891,11 +894,17 @@ class KX134AccelerometerDataBlock(DataBlock):
         return head + (b'\x00' * padding)
 
     def gen_samples(self):
-        count = len(self.samples)
+        count = len(self.samples) + self.samples_after
         for i, samp in enumerate(self.samples):
             time = (self.mission_time * (1000 / 1024)) - ((count - i) * (self.sample_period * 1024))
             yield time, samp[0], samp[1], samp[2]
 
+    def trim_samples(self, t0: float, t1: float):
+        """ Keeps only the samples taken between mission times t0 and t1 (ms), without changing their times """
+        first, last = sample_range([time for time, *_ in self.gen_samples()], t0, t1)
+        self.samples_after += len(self.samples) - last
+        self.samples = self.samples[first:last]
+
     @staticmethod
     def type_desc():
         return "KX134 Accelerometer"
@@ -1155,6 +1164,8 @@ class MPU9250IMUDataBlock(DataBlock):
         self.accel_bw: MPU9250AccelBW = accel_bw
         self.gyro_bw: MPU9250GyroBW = gyro_bw
         self.samples = samples
+        # Samples dropped from the end by trim_samples, which still count towards the times of the rest
+        self.samples_after: int = 0
 
         self.sample_period = 1 / self.ag_sample_rate
 
@@ -1241,11 +1252,19 @@ class MPU9250IMUDataBlock(DataBlock):
         return payload + (b'\x00' * padding)
 
     def gen_samples(self):
-        count = len(self.samples)
+        count = len(self.samples) + self.samples_after
         for i, samp in enumerate(self.samples):
             time = (self.mission_time * (1000 / 1024)) - ((count - i) * self.sample_period)
             yield time, samp
 
+    def trim_samples(self, t0: float, t1: float):
+        """ Keeps only the samples taken between mission times t0 and t1 (ms), without changing their times """
+        first, last = sample_range([time for time, _ in self.gen_samples()], t0, t1)
+        self.samples_after += len(self.samples) - last
+        self.samples = self.samples[first:last]
+        if len(self.samples) != 0:
+            self.sensor = avg_mpu9250_samples(self.samples)
+
     def __str__(self):
         return (
             f"{self.type_desc()} -> time: {self.mission_time}, accel: ({self.sensor.accel_x},{self.sensor.accel_y},{self.sensor.accel_z}), temp: {self.sensor.temperature}, "
@@ -1274,6 +1293,12 @@ class MPU9250IMUDataBlock(DataBlock):
         yield "gyro_fsr", self.gyro_fsr
 
 
+def sample_range(times: list[float], t0: float, t1: float) -> tuple[int, int]:
+    """ Returns the slice (start, stop) of a list of times in order that are between t0 and t1 """
+    first = bisect_left(times, t0)
+    return first, max(bisect_right(times, t1), first)
+
+
 def avg_mpu9250_samples(data_samples: list[MPU9250Sample]) -> MPU9250Sample:
     """
     Parses a list of samples from a mpu9250 packet and returns the average values for accel, temp, gyro and magnetometer
@@ -0,0 +1,234 @@
+# Downsampling of high rate sensor streams to a target number of points for plotting.
+#
+# Two methods are available, both vectorised with NumPy:
+#  - minmax: the minimum and maximum of each of target / 2 equal time buckets
+#  - lttb: Largest-Triangle-Three-Buckets, which keeps the points that best preserve the shape of the
+#    series. When streaming, LTTB is run on min/max candidates (MinMaxLTTB) so the whole flight never
+#    needs to be held in memory.
+#
+# The streaming downsampler keeps the min and max of fixed width time buckets, and doubles the bucket
+# width (merging pairs of buckets) whenever there are too many. Memory use only depends on the target.
+
+from pathlib import Path
+
+from data_block import KX134AccelerometerDataBlock, MPU9250IMUDataBlock
+from handlers import BlockHandler
+
+# Number of min/max candidate buckets kept per output point by the streaming LTTB downsampler
+LTTB_CANDIDATE_RATIO = 2
+
+
+def minmax(t, v, n_out: int):
+    """ Indices of the min and max point of each of n_out / 2 equal sized buckets of a series """
+    import numpy as np
+
+    v = np.asarray(v)
+    n = len(v)
+    if n <= n_out:
+        return np.arange(n)
+
+    n_buckets = max(n_out // 2, 1)
+    ids = (np.arange(n) * n_buckets) // n
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    mins = np.lexsort((v, ids))[starts]
+    maxs = np.lexsort((-v, ids))[starts]
+    return np.unique(np.concatenate((mins, maxs)))
+
+
+def lttb(t, v, n_out: int):
+    """ Indices of the points of a series selected by Largest-Triangle-Three-Buckets """
+    import numpy as np
+
+    t = np.asarray(t, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    n = len(v)
+    if n <= n_out or n_out < 3:
+        return np.arange(n) if n <= n_out else np.array([0, n - 1])[:n_out]
+
+    # First and last points are always kept, the rest are split into n_out - 2 buckets
+    edges = (np.arange(n_out - 1) * (n - 2)) // (n_out - 2) + 1
+    edges[-1] = n - 1
+
+    # Average of each bucket, used as the third point of the triangles of the bucket before it
+    sums_t = np.add.reduceat(t[1:n - 1], edges[:-1] - 1)
+    sums_v = np.add.reduceat(v[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_t = np.append(sums_t / counts, t[-1])
+    avg_v = np.append(sums_v / counts, v[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    prev = 0
+    for b in range(n_out - 2):
+        start, end = edges[b], edges[b + 1]
+        bt = t[start:end]
+        bv = v[start:end]
+        # Twice the area of the triangle from the previous point to each candidate to the next average
+        areas = np.abs((t[prev] - avg_t[b + 1]) * (bv - v[prev]) - (t[prev] - bt) * (avg_v[b + 1] - v[prev]))
+        prev = start + int(np.argmax(areas))
+        selected[b + 1] = prev
+    return selected
+
+
+def _reduce(ids, tmin, vmin, tmax, vmax):
+    """ Merges buckets with the same id (ids must be sorted), keeping the min and max point of each
+    column """
+    import numpy as np
+
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    if len(starts) == len(ids):
+        return ids, tmin, vmin, tmax, vmax
+
+    cols = np.arange(vmin.shape[1])
+    imin = np.column_stack([np.lexsort((vmin[:, c], ids))[starts] for c in cols])
+    imax = np.column_stack([np.lexsort((-vmax[:, c], ids))[starts] for c in cols])
+    return (ids[starts], tmin[imin, cols], vmin[imin, cols], tmax[imax, cols], vmax[imax, cols])
+
+
+class StreamingDownsampler:
+    """ Downsamples a time series with one or more columns to about n_out points per column, given in
+    chunks in time order """
+
+    def __init__(self, n_out: int, method: str = "lttb", initial_width: float = 1.0):
+        if method not in ("lttb", "minmax"):
+            raise ValueError(f"Unknown downsampling method: {method}")
+        self.n_out: int = n_out
+        self.method: str = method
+        self.width: float = initial_width
+        # Number of buckets kept between chunks
+        if method == "minmax":
+            self.max_buckets = max(n_out, 2)
+        else:
+            self.max_buckets = max(n_out * LTTB_CANDIDATE_RATIO, 2)
+        self.t0 = None
+        self.buckets = None
+
+    def push(self, t, values):
+        """ Adds a chunk of samples, t has a time (ms) per sample and values a row per sample """
+        import numpy as np
+
+        t = np.asarray(t, dtype=np.float64)
+        if len(t) == 0:
+            return
+        values = np.asarray(values, dtype=np.float64).reshape(len(t), -1)
+        if self.t0 is None:
+            self.t0 = t[0]
+
+        ids = np.floor((t - self.t0) / self.width).astype(np.int64)
+        times = np.repeat(t[:, None], values.shape[1], axis=1)
+        chunk = (ids, times, values, times, values)
+        if self.buckets is not None:
+            chunk = tuple(np.concatenate((a, b)) for a, b in zip(self.buckets, chunk))
+        if np.any(chunk[0][1:] < chunk[0][:-1]):
+            order = np.argsort(chunk[0], kind="stable")
+            chunk = tuple(a[order] for a in chunk)
+        self.buckets = _reduce(*chunk)
+
+        # Too many buckets, double their width until there are few enough
+        while len(self.buckets[0]) > self.max_buckets:
+            self.width *= 2
+            self.buckets = _reduce(self.buckets[0] // 2, *self.buckets[1:])
+
+    def state_bytes(self, num_columns: int) -> int:
+        """ Most memory used by the buckets kept between chunks of num_columns columns, counting the copies
+        made while a chunk is added """
+        return 3 * self.max_buckets * (8 + 4 * 8 * num_columns)
+
+    def result(self):
+        """ Returns (times, values) for each column, each with about n_out points """
+        import numpy as np
+
+        if self.buckets is None:
+            return []
+
+        ids, tmin, vmin, tmax, vmax = self.buckets
+        if self.method == "minmax" and len(ids) > self.n_out // 2:
+            # Merge into exactly n_out / 2 buckets
+            n_buckets = max(self.n_out // 2, 1)
+            ids, tmin, vmin, tmax, vmax = _reduce((np.arange(len(ids)) * n_buckets) // len(ids),
+                                                  tmin, vmin, tmax, vmax)
+
+        columns = []
+        for c in range(vmin.shape[1]):
+            t = np.concatenate((tmin[:, c], tmax[:, c]))
+            v = np.concatenate((vmin[:, c], vmax[:, c]))
+            order = np.argsort(t, kind="stable")
+            t, v = t[order], v[order]
+            # The min and max of a bucket can be the same point
+            keep = np.r_[True, (t[1:] != t[:-1]) | (v[1:] != v[:-1])]
+            t, v = t[keep], v[keep]
+            if self.method == "lttb":
+                i = lttb(t, v, self.n_out)
+                t, v = t[i], v[i]
+            columns.append((t, v))
+        return columns
+
+
+class DownsampleHandler(BlockHandler):
+    """ Writes a downsampled copy of a multi-sample sensor's output, with a time and value column for
+    each of its columns """
+
+    filename: str = None
+    columns: tuple = ()
+
+    def __init__(self, n_out: int = 2000, method: str = "lttb"):
+        self.downsampler = StreamingDownsampler(n_out, method)
+        self.path = None
+
+    def samples(self, block):
+        """ Generates (time, (values...)) for each sample in a block """
+        return ()
+
+    def state_bytes(self) -> int:
+        return self.downsampler.state_bytes(len(self.columns))
+
+    def open(self, flightdir: Path):
+        self.path = flightdir.joinpath(f"{self.filename}_downsampled.csv")
+
+    def consume_batch(self, blocks):
+        times = []
+        values = []
+        for block in blocks:
+            for time, v in self.samples(block):
+                times.append(time)
+                values.append(v)
+        self.downsampler.push(times, values)
+
+    def close(self):
+        result = self.downsampler.result()
+        if len(result) == 0:
+            open(self.path, "w").close()
+            return
+
+        with open(self.path, "w") as outfile:
+            outfile.write(",".join(f"{name} Time (ms),{name}" for name in self.columns) + "\n")
+            for i in range(max(len(t) for t, _ in result)):
+                outfile.write(",".join(f"{t[i]},{v[i]}" if i < len(t) else "," for t, v in result) + "\n")
+
+
+class KX134DownsampleHandler(DownsampleHandler):
+    """ KX134AccelerometerDataBlock """
+    block_types = (KX134AccelerometerDataBlock,)
+    filename = "kx134_accelerometer"
+    columns = ("X (g)", "Y (g)", "Z (g)")
+
+    def samples(self, block):
+        for time, x, y, z in block.data.gen_samples():
+            yield time, (x, y, z)
+
+
+class MPU9250DownsampleHandler(DownsampleHandler):
+    """ MPU9250IMUDataBlock """
+    block_types = (MPU9250IMUDataBlock,)
+    filename = "mpu9250_imu"
+    columns = ("Accel X (g)", "Accel Y (g)", "Accel Z (g)", "Gyro X (dps)", "Gyro Y (dps)", "Gyro Z (dps)",
+               "Mag X (uT)", "Mag Y (uT)", "Mag Z (uT)", "Temperature (C)")
+
+    def samples(self, block):
+        for time, s in block.data.gen_samples():
+            yield time, (s.accel_x, s.accel_y, s.accel_z, s.gyro_x, s.gyro_y, s.gyro_z,
+                         s.mag_x, s.mag_y, s.mag_z, s.temperature)
+
+
+DOWNSAMPLE_HANDLERS = [KX134DownsampleHandler, MPU9250DownsampleHandler]
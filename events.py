@@ -0,0 +1,155 @@
+# Streaming detection of the key moments of a flight (launch, burnout, apogee and landing).
+#
+# The detector is fed altitude, KX134 acceleration and status blocks as they are decoded and only keeps
+# a handful of values between them, so it uses constant memory however long the flight is. Events are
+# found from the sensors, and every change of the avionics' deployment state is also reported.
+
+import math
+
+from data_block import AltitudeDataBlock, KX134AccelerometerDataBlock, StatusDataBlock, DeploymentState
+from misc.converter import mt_to_ms
+
+# Acceleration (g) above which the rocket is taken to be under power, for at least LAUNCH_DURATION ms
+LAUNCH_ACCELERATION = 2.5
+LAUNCH_DURATION = 100
+# Acceleration (g) below which the motor is taken to have burnt out, for at least BURNOUT_DURATION ms
+BURNOUT_ACCELERATION = 1.0
+BURNOUT_DURATION = 100
+# Height (m) above the ground the rocket has to reach for a launch to be detected from altitude alone
+LAUNCH_HEIGHT = 30
+# Distance (m) the altitude has to fall below its maximum for apogee to be confirmed
+APOGEE_DROP = 10
+# Altitude has to stay within LANDING_TOLERANCE (m) for LANDING_DURATION ms for a landing
+LANDING_TOLERANCE = 2
+LANDING_DURATION = 5000
+# Weight of each new altitude reading in the smoothed altitude
+ALTITUDE_SMOOTHING = 0.2
+# Weight of each new smoothed altitude in the ground level before launch
+GROUND_SMOOTHING = 0.01
+
+
+class FlightEvent:
+    def __init__(self, time: float, name: str, source: str, detail: str = ""):
+        self.time: float = time
+        self.name: str = name
+        self.source: str = source
+        self.detail: str = detail
+
+    def __str__(self):
+        return f"{self.name} at {self.time} ms (from {self.source}{', ' + self.detail if self.detail else ''})"
+
+    def __iter__(self):
+        yield "time", self.time
+        yield "name", self.name
+        yield "source", self.source
+        yield "detail", self.detail
+
+
+class EventDetector:
+    def __init__(self):
+        self.events: list[FlightEvent] = []
+        self.launched = False
+        self.burnt_out = False
+        self.apogee = False
+        self.landed = False
+
+        self._ground = None
+        self._altitude = None
+        self._max_altitude = -math.inf
+        self._max_altitude_time = None
+        self._landing_ref = None
+        self._landing_ref_time = None
+        self._high_accel_since = None
+        self._low_accel_since = None
+        self._deployment_state = None
+
+    def state(self) -> dict:
+        """ Everything the detector keeps, as JSON compatible values, to carry on from later (see restore) """
+        return {**vars(self), "events": [dict(event) for event in self.events]}
+
+    def restore(self, state: dict):
+        """ Carries on from the state of a detector """
+        vars(self).update(state)
+        self.events = [FlightEvent(**event) for event in state["events"]]
+
+    def _emit(self, time, name, source, detail=""):
+        event = FlightEvent(time, name, source, detail)
+        self.events.append(event)
+        return [event]
+
+    def consume(self, data):
+        """ Feeds a decoded data block to the detector, returns any events it caused """
+        match data:
+            case AltitudeDataBlock():
+                return self._altitude_sample(mt_to_ms(data.mission_time), data.altitude)
+            case KX134AccelerometerDataBlock():
+                events = []
+                for time, x, y, z in data.gen_samples():
+                    events.extend(self._accel_sample(time, math.sqrt((x * x) + (y * y) + (z * z))))
+                return events
+            case StatusDataBlock():
+                return self._status(mt_to_ms(data.mission_time), data.deployment_state)
+        return []
+
+    def _accel_sample(self, time, g):
+        if not self.launched:
+            if g < LAUNCH_ACCELERATION:
+                self._high_accel_since = None
+            elif self._high_accel_since is None:
+                self._high_accel_since = time
+            elif time - self._high_accel_since >= LAUNCH_DURATION:
+                self.launched = True
+                return self._emit(self._high_accel_since, "launch", "kx134", f"{g:.2f} g")
+        elif not self.burnt_out:
+            if g > BURNOUT_ACCELERATION:
+                self._low_accel_since = None
+            elif self._low_accel_since is None:
+                self._low_accel_since = time
+            elif time - self._low_accel_since >= BURNOUT_DURATION:
+                self.burnt_out = True
+                return self._emit(self._low_accel_since, "burnout", "kx134", f"{g:.2f} g")
+        return []
+
+    def _altitude_sample(self, time, altitude):
+        if self._altitude is None:
+            self._altitude = altitude
+        else:
+            self._altitude += ALTITUDE_SMOOTHING * (altitude - self._altitude)
+        altitude = self._altitude
+
+        if not self.launched:
+            # Slowly track the ground level until launch
+            if self._ground is None:
+                self._ground = altitude
+            if altitude - self._ground >= LAUNCH_HEIGHT:
+                self.launched = True
+                return self._emit(time, "launch", "altitude", f"{altitude - self._ground:.1f} m above ground")
+            self._ground += GROUND_SMOOTHING * (altitude - self._ground)
+            return []
+
+        if not self.apogee:
+            if altitude > self._max_altitude:
+                self._max_altitude = altitude
+                self._max_altitude_time = time
+            elif self._max_altitude - altitude >= APOGEE_DROP:
+                self.apogee = True
+                return self._emit(self._max_altitude_time, "apogee", "altitude", f"{self._max_altitude:.1f} m")
+            return []
+
+        if not self.landed:
+            if self._landing_ref is None or abs(altitude - self._landing_ref) > LANDING_TOLERANCE:
+                self._landing_ref = altitude
+                self._landing_ref_time = time
+            elif time - self._landing_ref_time >= LANDING_DURATION:
+                self.landed = True
+                return self._emit(self._landing_ref_time, "landing", "altitude", f"{altitude:.1f} m")
+        return []
+
+    def _status(self, time, state: DeploymentState):
+        if state == self._deployment_state:
+            return []
+        previous = self._deployment_state
+        self._deployment_state = state
+        if previous is None:
+            return []
+        return self._emit(time, "deployment_state", "status", str(state))
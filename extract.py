@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# Finds where the data written to an SD card ends, to copy no more of it than needed.
+#
+# The dd command SuperBlock.output suggests copies up to the end of the last flight in the superblock, but
+# a flight that was still being logged when the power was lost isn't in the superblock yet, and its sectors
+# come after that. Sectors are written one after the other from there, so the end of the written data is
+# found by a binary search between the end of the recorded flights and the end of the partition, reading a
+# few sectors at each step (a sample is written if any of its sectors isn't all zeros or all 0xFF). That's
+# about 30 small reads for a 32 GB card, where a full scan would read all of it. The end found is then
+# checked by reading the sectors just after it, and the search carries on past them if any are written.
+#
+#   python3 extract.py /dev/sdb
+#   python3 extract.py /dev/sdb --output full
+
+import argparse
+import os
+import time
+
+from recovery import ERASED_SECTOR, ZERO_SECTOR, check_chain, find_partition
+from superblock import SuperBlock
+
+# Sectors read at each step of the search
+SAMPLE_SECTORS = 8
+# Sectors after the end found that have to be unwritten
+CONFIRM_SECTORS = 256
+# Bytes copied at once
+COPY_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def sample_written(file, sector: int, num_sectors: int = SAMPLE_SECTORS) -> bool:
+    """ Whether any of num_sectors sectors starting at a sector are written """
+    file.seek(sector * 512)
+    data = file.read(num_sectors * 512)
+    return any(data[i:i + 512] not in (ZERO_SECTOR, ERASED_SECTOR) for i in range(0, len(data) - 511, 512))
+
+
+class Probe:
+    def __init__(self, recorded_end: int, written_end: int, reads: int, chain: bool):
+        # Sector after the last recorded flight, and after the last written sector
+        self.recorded_end: int = recorded_end
+        self.written_end: int = written_end
+        self.reads: int = reads
+        # Whether the unrecorded sectors start with a valid chain of blocks
+        self.chain: bool = chain
+
+    @property
+    def unrecorded(self) -> int:
+        return self.written_end - self.recorded_end
+
+
+def find_written_end(file, start_sector: int, end_sector: int) -> Probe:
+    """ Finds the sector after the last written one between start_sector (the end of the recorded flights,
+    where written sectors may carry on from) and end_sector """
+    reads = 0
+
+    def written(sector: int) -> bool:
+        nonlocal reads
+        reads += 1
+        return sample_written(file, sector, min(SAMPLE_SECTORS, end_sector - sector))
+
+    lo = start_sector
+    while lo < end_sector and written(lo):
+        # Invariant: the sample at lo is written and the end is after it, and hi is unwritten (or the end)
+        hi = end_sector
+        while hi - lo > SAMPLE_SECTORS:
+            mid = (lo + hi) // 2
+            if written(mid):
+                lo = mid
+            else:
+                hi = mid
+        # The end is in the last sample, find the sector
+        file.seek(lo * 512)
+        data = file.read((hi - lo) * 512)
+        reads += 1
+        last = max((i for i in range(0, len(data) - 511, 512)
+                    if data[i:i + 512] not in (ZERO_SECTOR, ERASED_SECTOR)), default=-512)
+        lo += last // 512 + 1
+
+        # A few unwritten sectors in the middle of the data would end the search too early
+        file.seek(lo * 512)
+        after = file.read(min(CONFIRM_SECTORS, end_sector - lo) * 512)
+        reads += 1
+        written_after = [i for i in range(0, len(after) - 511, 512)
+                         if after[i:i + 512] not in (ZERO_SECTOR, ERASED_SECTOR)]
+        if len(written_after) == 0:
+            break
+        lo += written_after[0] // 512
+
+    chain = lo > start_sector and check_chain(file, start_sector, lo)
+    return Probe(start_sector, lo, reads + (1 if lo > start_sector else 0), chain)
+
+
+def copy_sectors(infile, outfile, num_sectors: int):
+    """ Copies the first num_sectors sectors of a file, printing the progress """
+    size = num_sectors * 512
+    copied = 0
+    start = time.perf_counter()
+    infile.seek(0)
+    while copied < size:
+        data = infile.read(min(COPY_CHUNK_BYTES, size - copied))
+        if len(data) == 0:
+            break
+        outfile.write(data)
+        copied += len(data)
+        print(f"\rCopied {copied / 1e6:.0f} of {size / 1e6:.0f} MB", end="", flush=True)
+    seconds = time.perf_counter() - start
+    print(f"\rCopied {copied / 1e6:.0f} MB in {seconds:.1f} s ({copied / 1e6 / max(seconds, 1e-9):.0f} MB/s)")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Find the end of the data written to an SD card or image and "
+                                                     "copy only what's needed.")
+    arg_parser.add_argument("infile", help="SD card device or image")
+    arg_parser.add_argument("--output", metavar="PATH",
+                            help="copy the card up to the end of the written data to a file")
+    args = arg_parser.parse_args()
+
+    with open(args.infile, "rb", buffering=0) as f:
+        try:
+            part_offset, part_end = find_partition(args.infile)
+        except ValueError as e:
+            exit(str(e))
+        size = f.seek(0, os.SEEK_END) // 512
+        end_sector = min(part_end, size) if part_end is not None else size
+
+        f.seek(part_offset * 512)
+        try:
+            sb = SuperBlock.from_bytes(f.read(512))
+        except ValueError:
+            exit("Could not parse superblock. recovery.py can rebuild it from the flights on the card.")
+        recorded_end = max((flight.first_block + flight.num_blocks for flight in sb.flights), default=1)
+
+        start = time.perf_counter()
+        probe = find_written_end(f, part_offset + recorded_end, end_sector)
+        ms = (time.perf_counter() - start) * 1000
+        print(f"Last recorded flight ends at sector {probe.recorded_end}, written data ends at sector "
+              f"{probe.written_end} ({probe.reads} reads in {ms:.1f} ms)")
+        if probe.unrecorded != 0:
+            print(f"{probe.unrecorded} sectors after the recorded flights are written"
+                  f"{', starting with valid blocks' if probe.chain else ', but not with valid blocks'}: probably a "
+                  f"flight that was still being logged. recovery.py can add it to the superblock.")
+        sb.output(True, last_block=probe.written_end - part_offset)
+
+        if args.output is not None:
+            with open(args.output, "wb") as out:
+                # As many sectors as the dd command copies
+                copy_sectors(f, out, min(probe.written_end + 1, size))
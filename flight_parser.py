@@ -0,0 +1,258 @@
+# Reading and parsing the blocks of a flight.
+
+import struct
+from collections import Counter
+from pathlib import Path
+from time import perf_counter
+
+from data_block import KX134AccelerometerDataBlock, MPU9250IMUDataBlock
+from handlers import BlockHandler, load_handlers, to_columns
+from memory_budget import MemoryBudget, decoded_size
+from misc.converter import mt_to_ms
+from profiling import Profiler, block_samples
+from progress import Progress
+from sd_block import LoggingMetadataSpacerBlock, SDBlock, SDBlockClass, SDBlockException
+from summary import SensorStatsHandler, block_stats_summary, follow_state_path, write_summary
+from superblock import Flight
+from time_index import TimeIndex, index_path, load_or_build_index
+
+# Number of blocks a handler receives per consume_batch call
+BATCH_SIZE = 1024
+# Blocks with several samples each, which a windowed parse trims to the samples in the window
+SAMPLED_BLOCKS = (KX134AccelerometerDataBlock, MPU9250IMUDataBlock)
+# Version of the parser's outputs, part of the parse cache key so it has to change whenever the decoding
+# or the output of any built in handler does
+PARSER_VERSION = 2
+
+
+class ParsingException(Exception):
+    pass
+
+
+def gen_raw_blocks(file, num_blocks, offset=0):
+    """ Generates the raw bytes of each block in a flight, file must be at the given byte offset in the
+    flight (which has to be the start of a block) """
+    count = offset
+
+    while count <= ((num_blocks * 512) - 4):
+        header = file.read(4)
+
+        try:
+            block_length = SDBlock.parse_length(header)
+
+        except SDBlockException:
+            # END OF FILE EXCEPTION
+            # print(count, ((num_blocks * 512) - 4), block_length, num_blocks*512)
+            return
+
+        # Unwritten sectors (all zeros) after the last block
+        if block_length < 4:
+            return
+
+        count = count + block_length
+        if count > (num_blocks * 512):
+            raise ParsingException(f"Read block of length {block_length} would read {count} bytes "
+                                   f"from {num_blocks * 512} byte flight")
+        try:
+            yield header + file.read(block_length - 4)
+        except ValueError:
+            print("READ LENGTH MUST BE NON-NEG OR -1", header, block_length, block_length - 4)
+            return
+
+
+def gen_blocks(file, first_block, num_blocks):
+    """ Generates each parsed block in a flight along with its raw bytes """
+    for block in gen_raw_blocks(file, num_blocks):
+        yield SDBlock.from_bytes(block), block
+
+
+def parse_flight(file, imagedir: Path, part_offset, flight_num, flight: Flight, handler_factories=None,
+                 window: tuple[float, float] = None, profiler: Profiler = None, progress: Progress = None,
+                 memory: MemoryBudget = None):
+    """ Parses a flight into its handlers' output files. If a window (t0, t1) of mission times in ms is
+    given only blocks with a mission time in that window are output, using the flight's time index to
+    skip to t0 and stopping once every stream has passed t1. If a profiler is given, the time spent
+    reading, decoding and in each handler is recorded in it, and if a progress is given the blocks read
+    and samples decoded are counted in it. If a memory budget is given, batches, handler buffers and the
+    time index are kept within it. Returns False if the flight wasn't parsed because its output folder
+    already exists. """
+    print(f"############### Flight {flight_num} ###############")
+    print(f"Starts at block: {flight.first_block}, {flight.num_blocks} "
+          f"block{'s' if flight.num_blocks != 1 else ''} long, time: {flight.timestamp}")
+
+    handlers: list[BlockHandler] = [factory() for factory in (handler_factories or load_handlers())]
+    if window is None:
+        handlers.append(SensorStatsHandler())
+    if memory is not None:
+        # Set aside the handlers' state first, raises ValueError if the limit is too small for it
+        memory = memory.for_handlers(handlers)
+
+    # Create flight
+    if window is None:
+        flightdir = imagedir.joinpath(f"flight_{flight_num}")
+    else:
+        flightdir = imagedir.joinpath(f"flight_{flight_num}_{window[0]:g}-{window[1]:g}ms")
+    try:
+        flightdir.mkdir(parents=True, exist_ok=False)
+    except FileExistsError:
+        print(f"Flight {flight_num} has already been parsed. Not parsing again.")
+        return False
+    if window is None:
+        # Left by a follow of an earlier folder, which this parse replaces
+        follow_state_path(imagedir, flight_num).unlink(missing_ok=True)
+    parse_start = perf_counter()
+
+    # Open handlers for writing
+    for handler in handlers:
+        if memory is not None:
+            handler.limit_memory(memory.handler_bytes // len(handlers))
+        handler.open(flightdir)
+
+    # Handlers for each block class and their pending blocks, only these classes get decoded
+    routes = dict()
+    for handler in handlers:
+        for cls in handler.block_types:
+            routes.setdefault(cls, []).append(handler)
+    pending = dict((handler, []) for handler in handlers)
+    # Memory used by the decoded blocks waiting for handlers, when limiting memory
+    pending_bytes = 0
+
+    def flush(handler):
+        blocks = pending[handler]
+        if len(blocks) != 0:
+            if profiler is not None:
+                start = perf_counter()
+            handler.consume_batch(to_columns(blocks) if handler.columnar else blocks)
+            pending[handler] = []
+            if profiler is not None:
+                profiler.add(f"handler {type(handler).__name__}", perf_counter() - start, blocks=len(blocks),
+                             samples=sum(block_samples(block) for block in blocks))
+
+    # Read blocks and record data
+    block_type_counts = Counter()
+    spacer_bytes = 0
+    num_blocks = 0
+    first_time = None
+    last_time = None
+
+    # Time index is built as a by-product of a full parse, a windowed parse uses it to skip ahead
+    if window is None:
+        index = TimeIndex(max_entries=memory.index_entries if memory is not None else None)
+        offset = 0
+    else:
+        index = None
+        offset = load_or_build_index(file, imagedir, part_offset, flight_num, flight).seek_offset(window[0])
+    streams_seen = set()
+    streams_passed = set()
+
+    file.seek((part_offset + flight.first_block) * 512 + offset)
+
+    counter = progress.counter(offset) if progress is not None else None
+    rawblocks = gen_raw_blocks(file, flight.num_blocks, offset)
+    if profiler is not None:
+        rawblocks = profiler.time_iter("read", rawblocks)
+    for rawblock in rawblocks:
+        block_offset = offset
+        offset += len(rawblock)
+        num_blocks += 1
+        if counter is not None:
+            counter.add(len(rawblock))
+
+        block_class, block_type, block_length = SDBlock.parse_header(rawblock)
+        cls = SDBlock.lookup_class(block_class, block_type)
+        overlaps = False
+        if cls is None:
+            print(f"No handler for block with class {block_class} and type {block_type}")
+            continue
+
+        if block_class == SDBlockClass.TELEMETRY_DATA:
+            # Mission time is the first field of every telemetry data block
+            mission_time = mt_to_ms(struct.unpack("<I", rawblock[4:8])[0])
+            if first_time is None:
+                first_time = mission_time
+
+            last_time = mission_time
+
+            if index is not None:
+                index.add(block_offset, block_class, rawblock)
+
+            if window is not None:
+                streams_seen.add(cls)
+                if mission_time > window[1]:
+                    # Samples are taken before their block's mission time, so the first block of a stream past
+                    # the window can still have some in it
+                    overlaps = cls in SAMPLED_BLOCKS and cls not in streams_passed
+                    streams_passed.add(cls)
+                    if streams_passed == streams_seen and not overlaps:
+                        break
+
+        # Other blocks are in the window if the telemetry before them is
+        if window is not None and not overlaps and (last_time is None or not window[0] <= last_time <= window[1]):
+            continue
+
+        # Increment count for block type
+        block_type_counts[cls] += 1
+
+        # If this is a spacer, add to the total
+        if cls == LoggingMetadataSpacerBlock:
+            spacer_bytes += block_length
+
+        # Only decode blocks that some handler wants
+        wanted = routes.get(cls)
+        if wanted is None:
+            continue
+
+        if profiler is None:
+            block = SDBlock.from_bytes(rawblock)
+        else:
+            start = perf_counter()
+            block = SDBlock.from_bytes(rawblock)
+            seconds = perf_counter() - start
+            samples = block_samples(block)
+            profiler.add("decode", seconds, len(rawblock), 1, samples)
+            profiler.add_block_type(cls.__name__, seconds, len(rawblock), samples)
+
+        if window is not None and cls in SAMPLED_BLOCKS:
+            block.data.trim_samples(*window)
+            if len(block.data.samples) == 0:
+                continue
+
+        if counter is not None:
+            counter.add_samples(cls.__name__, block_samples(block))
+
+        for handler in wanted:
+            pending[handler].append(block)
+            if len(pending[handler]) >= BATCH_SIZE:
+                flush(handler)
+
+        if memory is not None:
+            pending_bytes += decoded_size(block, len(rawblock))
+            if pending_bytes > memory.batch_bytes:
+                for handler in handlers:
+                    flush(handler)
+                pending_bytes = 0
+
+    # Flush and close handlers
+    for handler in handlers:
+        flush(handler)
+        if profiler is not None:
+            start = perf_counter()
+        handler.close()
+        if profiler is not None:
+            profiler.add(f"handler {type(handler).__name__}", perf_counter() - start)
+    if progress is not None:
+        progress.close()
+
+    # A windowed parse only saw part of the flight, so it doesn't update the index or summary
+    if window is None:
+        index.to_file(index_path(imagedir, flight_num), flight)
+
+        summary = block_stats_summary(flight, num_blocks, block_type_counts, spacer_bytes, first_time, last_time)
+        for handler in handlers:
+            summary.update(handler.summary())
+        write_summary(imagedir, flight_num, summary)
+
+    if profiler is not None:
+        profiler.wall += perf_counter() - parse_start
+    print(f"Read {num_blocks} entries, output to {flightdir}.")
+    return True
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+# Follows an SD card image that is still being written (for example one mirrored from a card during a
+# bench test), parsing new blocks into the flight folders as they appear.
+#
+# Every poll checks whether the image has changed and, if it has, rereads the superblock. Each flight
+# being followed remembers the offset after the last block it fully decoded, and only the bytes from there
+# to the end of the flight are read and parsed, with the new rows appended to the flight's output files,
+# so a poll costs time proportional to the new data rather than the size of the image. A block that isn't
+# completely written yet is left for the next poll. Once a later flight appears, the one before it is
+# finished: its handlers are closed and its summary and time index are saved.
+#
+# When following stops, the flights still being followed are closed the same way, and where they had got
+# to (the offset, counts, time index and each handler's state) is saved to flight_N_follow.json. The next
+# run carries on from there, appending to the existing outputs. The file is removed while the flight is
+# being followed, so outputs left by a run that didn't stop cleanly are parsed again from the start, as
+# are those of handlers that can't carry on (see BlockHandler.resume).
+#
+#   python3 follow.py full --interval 0.5
+
+import argparse
+import json
+import os
+import shutil
+import struct
+import time
+from collections import Counter
+from pathlib import Path
+
+from cuinspace_telemetry import image_dir
+from flight_parser import BATCH_SIZE, ParsingException, gen_raw_blocks
+from handlers import BlockHandler, load_handlers
+from misc.converter import mt_to_ms
+from parse_cache import flight_key
+from sd_block import SDBlock, SDBlockClass, LoggingMetadataSpacerBlock
+from summary import SensorStatsHandler, block_stats_summary, follow_state_path, read_summary, write_summary
+from superblock import SuperBlock, Flight, find_superblock
+from time_index import TimeIndex, index_path
+
+# Default seconds between polls
+POLL_INTERVAL = 1.0
+# Bytes read from the image at once
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+def gen_new_blocks(file, part_offset: int, flight: Flight, offset: int):
+    """ Generates the raw bytes of the completely written blocks of a flight from an offset in it (the end of
+    the last block read) to the flight's current end, reading READ_CHUNK_BYTES at a time """
+    # A new buffer over the file's descriptor for each poll, so it never holds stale data from the last one
+    with open(file.fileno(), "rb", buffering=READ_CHUNK_BYTES, closefd=False) as reader:
+        reader.seek((part_offset + flight.first_block) * 512 + offset)
+        try:
+            for rawblock in gen_raw_blocks(reader, flight.num_blocks, offset):
+                if len(rawblock) < SDBlock.parse_length(rawblock):
+                    # Not all of the block has been written yet
+                    return
+                yield rawblock
+        except ParsingException:
+            # The flight's last block runs past what the superblock says has been written so far
+            return
+
+
+class FlightFollower:
+    """ Parses a flight a part at a time as it is written, keeping its handlers open in between """
+
+    def __init__(self, imagedir: Path, flight_num: int, flight: Flight, handler_factories=None):
+        self.imagedir: Path = imagedir
+        self.flight_num: int = flight_num
+        self.flightdir: Path = imagedir.joinpath(f"flight_{flight_num}")
+        self.handler_factories: list = handler_factories or load_handlers()
+
+        self.handlers: list[BlockHandler] = [factory() for factory in self.handler_factories]
+        self.handlers.append(SensorStatsHandler())
+        self.routes = dict()
+        for handler in self.handlers:
+            for cls in handler.block_types:
+                self.routes.setdefault(cls, []).append(handler)
+
+        # Offset in the flight after the last fully decoded block
+        self.offset: int = 0
+        self.num_blocks: int = 0
+        # (block class, block type) -> number of blocks
+        self.block_type_counts = Counter()
+        self.spacer_bytes: int = 0
+        self.first_time = None
+        self.last_time = None
+        self.index = TimeIndex()
+
+        state = self.load_state(flight)
+        # Removed until the flight is closed again, after which the outputs no longer match it
+        follow_state_path(imagedir, flight_num).unlink(missing_ok=True)
+        if state is not None:
+            for handler, (_, handler_state) in zip(self.handlers, state["handlers"]):
+                handler.resume(self.flightdir, handler_state)
+            print(f"Carrying on from {self.offset} bytes into flight {flight_num}")
+            return
+
+        # Outputs the handlers can't carry on from are parsed again
+        if self.flightdir.exists():
+            shutil.rmtree(self.flightdir)
+        self.flightdir.mkdir(parents=True)
+        for handler in self.handlers:
+            handler.open(self.flightdir)
+
+    def load_state(self, flight: Flight) -> dict | None:
+        """ Restores where an earlier follow of the flight got to, returns the saved state or None if there
+        is none that this follow can carry on from """
+        try:
+            with open(follow_state_path(self.imagedir, self.flight_num), "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Flights only grow while they are written, so the rest of their superblock entry stays the same
+        if (state["first_block"], state["timestamp"]) != (flight.first_block, flight.timestamp) \
+                or state["offset"] > flight.num_blocks * 512 or not self.flightdir.is_dir():
+            return None
+        # The folder has to be the one the follow left, not one parsed since
+        summary = read_summary(self.imagedir, self.flight_num)
+        if summary is None or summary.get("cache_key") != state["cache_key"] \
+                or summary.get("num_blocks") != state["num_blocks"]:
+            return None
+        handlers = [type(handler).__qualname__ for handler in self.handlers]
+        if [name for name, _ in state["handlers"]] != handlers \
+                or any(handler_state is None for _, handler_state in state["handlers"]):
+            return None
+
+        self.offset = state["offset"]
+        self.num_blocks = state["num_blocks"]
+        self.block_type_counts = Counter(dict(((block_class, block_type), count)
+                                              for block_class, block_type, count in state["block_type_counts"]))
+        self.spacer_bytes = state["spacer_bytes"]
+        self.first_time = state["first_time"]
+        self.last_time = state["last_time"]
+        self.index = TimeIndex(state["index"]["stride_sectors"], state["index"]["offsets"], state["index"]["times"])
+        return state
+
+    def poll(self, file, part_offset: int, flight: Flight) -> int:
+        """ Parses the blocks written since the last poll, returns how many there were """
+        new_blocks = 0
+        pending = dict((handler, []) for handler in self.handlers)
+        for rawblock in gen_new_blocks(file, part_offset, flight, self.offset):
+            new_blocks += 1
+            block_offset = self.offset
+            self.offset += len(rawblock)
+
+            block_class, block_type, block_length = SDBlock.parse_header(rawblock)
+            cls = SDBlock.lookup_class(block_class, block_type)
+            if cls is None:
+                print(f"No handler for block with class {block_class} and type {block_type}")
+                continue
+            if block_class == SDBlockClass.TELEMETRY_DATA:
+                mission_time = mt_to_ms(struct.unpack("<I", rawblock[4:8])[0])
+                if self.first_time is None:
+                    self.first_time = mission_time
+                self.last_time = mission_time
+                self.index.add(block_offset, block_class, rawblock)
+            self.block_type_counts[(block_class, block_type)] += 1
+            if cls == LoggingMetadataSpacerBlock:
+                self.spacer_bytes += block_length
+
+            wanted = self.routes.get(cls)
+            if wanted is not None:
+                block = SDBlock.from_bytes(rawblock)
+                for handler in wanted:
+                    pending[handler].append(block)
+                    if len(pending[handler]) >= BATCH_SIZE:
+                        handler.consume_batch(pending[handler])
+                        pending[handler] = []
+
+        self.num_blocks += new_blocks
+        for handler in self.handlers:
+            if len(pending[handler]) != 0:
+                handler.consume_batch(pending[handler])
+            handler.flush()
+        return new_blocks
+
+    def close(self, file, part_offset: int, flight: Flight, finished: bool = False):
+        """ Closes the handlers and saves the flight's summary and time index. Unless the flight is finished,
+        where the follow got to is saved too, for a later one to carry on from. """
+        states = [(type(handler).__qualname__, handler.state()) for handler in self.handlers]
+        for handler in self.handlers:
+            handler.close()
+        self.index.to_file(index_path(self.imagedir, self.flight_num), flight)
+        block_type_counts = Counter(dict((SDBlock.lookup_class(*header), count)
+                                         for header, count in self.block_type_counts.items()))
+        summary = block_stats_summary(flight, self.num_blocks, block_type_counts, self.spacer_bytes,
+                                      self.first_time, self.last_time)
+        for handler in self.handlers:
+            summary.update(handler.summary())
+        # The outputs are what a parse of the flight as it is now would give, so the parse cache keeps them
+        # rather than parsing the flight again
+        cache_key = summary["cache_key"] = flight_key(file, part_offset, flight, self.handler_factories)
+        write_summary(self.imagedir, self.flight_num, summary)
+
+        if not finished:
+            with open(follow_state_path(self.imagedir, self.flight_num), "w") as f:
+                json.dump({"first_block": flight.first_block, "timestamp": flight.timestamp,
+                           "offset": self.offset, "num_blocks": self.num_blocks,
+                           "block_type_counts": [[*header, count] for header, count in self.block_type_counts.items()],
+                           "spacer_bytes": self.spacer_bytes, "first_time": self.first_time,
+                           "last_time": self.last_time,
+                           "index": {"stride_sectors": self.index.stride_sectors, "offsets": self.index.offsets,
+                                     "times": self.index.times},
+                           "handlers": states, "cache_key": cache_key}, f)
+
+
+def follow_image(path, imagedir: Path, interval: float = POLL_INTERVAL, handler_factories=None,
+                 idle_timeout: float = None):
+    """ Follows an image until interrupted (or, if idle_timeout is given, until it hasn't changed for that
+    many seconds), parsing its flights as they are written. Flights that were completely parsed before are
+    left as they are. """
+    followers: dict[int, FlightFollower] = dict()
+    # Flights that are finished, or were already parsed
+    finished = set()
+    flights: list[Flight] = []
+    superblock_addr = None
+    last_stat = None
+    last_change = time.monotonic()
+
+    # Unbuffered, so reads always see what has been written since the last one
+    file = open(path, "rb", buffering=0)
+    try:
+        try:
+            while True:
+                stat = os.stat(path)
+                if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != last_stat:
+                    if last_stat is not None and stat.st_ino != last_stat[0]:
+                        # Replaced rather than written to, as some mirroring tools do
+                        file.close()
+                        file = open(path, "rb", buffering=0)
+                    last_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    last_change = time.monotonic()
+
+                    if superblock_addr is None:
+                        superblock_addr = find_superblock(file)
+                    if superblock_addr is not None:
+                        file.seek(superblock_addr * 512)
+                        try:
+                            flights = SuperBlock.from_bytes(file.read(512)).flights
+                        except ValueError:
+                            # Caught mid-write, try again next poll
+                            last_stat = None
+
+                    for i, flight in enumerate(flights):
+                        if i in finished:
+                            continue
+                        follower = followers.get(i)
+                        if follower is None:
+                            # Parsed before, rather than only scanned for a summary
+                            summary = read_summary(imagedir, i, flight)
+                            if i < len(flights) - 1 and imagedir.joinpath(f"flight_{i}").is_dir() \
+                                    and summary is not None and not summary.get("scanned"):
+                                finished.add(i)
+                                continue
+                            follower = followers[i] = FlightFollower(imagedir, i, flight, handler_factories)
+                            print(f"Following flight {i}")
+                        new_blocks = follower.poll(file, superblock_addr, flight)
+                        if new_blocks != 0:
+                            print(f"Flight {i}: {new_blocks} new blocks, {follower.offset} bytes parsed")
+                        # A flight is finished once another one has started after it
+                        if i < len(flights) - 1:
+                            follower.close(file, superblock_addr, flight, finished=True)
+                            del followers[i]
+                            finished.add(i)
+                            print(f"Flight {i} finished, output in {follower.flightdir}")
+                elif idle_timeout is not None and time.monotonic() - last_change > idle_timeout:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for i, follower in followers.items():
+                follower.close(file, superblock_addr, flights[i])
+                print(f"Flight {i} closed, output in {follower.flightdir}")
+    finally:
+        file.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Parse an SD card image that is still being written, "
+                                                     "following it until interrupted.")
+    arg_parser.add_argument("infile", help="SD card image")
+    arg_parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+                            help=f"seconds between checks for new data (default: {POLL_INTERVAL:g})")
+    arg_parser.add_argument("--idle-timeout", type=float, metavar="SECONDS",
+                            help="stop once the image hasn't changed for SECONDS seconds")
+    args = arg_parser.parse_args()
+
+    imagedir = image_dir(args.infile)
+    imagedir.mkdir(parents=True, exist_ok=True)
+    follow_image(args.infile, imagedir, args.interval, idle_timeout=args.idle_timeout)
@@ -0,0 +1,431 @@
+# Block handlers, which consume parsed blocks in batches and write them to output files.
+#
+# A handler declares the block classes it wants in block_types (the data block class for telemetry
+# data, the SD block class otherwise). The parser only decodes blocks that at least one handler
+# wants, and hands each handler lists of blocks (or, for columnar handlers, a dict of columns).
+#
+# Third-party handlers can be registered with an entry point in the HANDLER_ENTRY_POINT_GROUP group
+# that points to a BlockHandler subclass (or any callable returning a BlockHandler).
+
+import csv
+from pathlib import Path
+
+from data_block import (AccelerationDataBlock, AltitudeDataBlock, AngularVelocityDataBlock, DebugMessageDataBlock,
+                        GNSSLocationBlock, GNSSMetadataBlock, KX134AccelerometerDataBlock, KX134LPFRolloff,
+                        MPU9250IMUDataBlock, StatusDataBlock)
+from events import EventDetector
+from misc.converter import mt_to_ms
+from radio_packet import PACKET_HEADER, device_name, gen_radio_blocks, unpack_packet_headers
+from sd_block import (TelemetryDataBlock, DiagnosticDataLogMessageBlock,
+                      DiagnosticDataOutgoingRadioPacketBlock, DiagnosticDataIncomingRadioPacketBlock)
+
+HANDLER_ENTRY_POINT_GROUP = "cuinspace_telemetry.handlers"
+
+
+class BlockHandler:
+    """ Interface for consumers of parsed blocks """
+
+    # Block classes this handler wants to receive
+    block_types: tuple = ()
+
+    # If true consume_batch receives a dict of column name -> list of values instead of blocks, with a row
+    # per sample for blocks with several (see block_rows)
+    columnar: bool = False
+
+    # Buffer size of the handler's output files, -1 for the default
+    buffer_size: int = -1
+
+    def limit_memory(self, nbytes: int):
+        """ Called before open when parsing with a memory limit, with the number of bytes the handler's
+        buffers and any state it keeps should stay within """
+        self.buffer_size = max(4096, min(nbytes // 2, 1024 * 1024))
+
+    def state_bytes(self) -> int:
+        """ Memory the handler keeps between batches whatever its limit (such as the state of a streaming
+        computation), set aside before the rest of a memory limit is split """
+        return 0
+
+    def open(self, flightdir: Path):
+        """ Called once before any blocks of a flight are consumed """
+
+    def consume_batch(self, blocks):
+        """ Called with a list of blocks (or a dict of columns) in the order they were read """
+
+    def flush(self):
+        """ Called when following a flight that is still being written, after each new part of it has been
+        consumed, to write out what the handler has so far """
+
+    def close(self):
+        """ Called once after all blocks of a flight have been consumed """
+
+    def summary(self) -> dict:
+        """ Called after close, returns values to add to the flight summary """
+        return {}
+
+    def state(self):
+        """ Called before close when following a flight that may still be written to, returns what the
+        handler needs to carry on appending to its outputs in a later run (JSON compatible values), or None
+        if it can't """
+        return None
+
+    def resume(self, flightdir: Path, state):
+        """ Called instead of open to carry on appending to the outputs of a flight where an earlier run
+        left off, with what state returned then """
+        self.open(flightdir)
+
+
+def block_rows(block):
+    """ Generates the rows (dicts of fields) a block adds to columns. Blocks with several samples add a row
+    per sample, with the block's fields plus the sample's time in ms (sample_time) and values. """
+    if not isinstance(block, TelemetryDataBlock):
+        yield vars(block)
+        return
+    d = block.data
+    fields = dict(d)
+    match d:
+        case KX134AccelerometerDataBlock():
+            for time, x, y, z in d.gen_samples():
+                yield {**fields, "sample_time": time, "x": x, "y": y, "z": z}
+        case MPU9250IMUDataBlock():
+            for time, sample in d.gen_samples():
+                yield {**fields, "sample_time": time, **dict(sample)}
+        case _:
+            yield fields
+
+
+def to_columns(blocks) -> dict[str, list]:
+    """ Converts a list of blocks to a dict of columns using their fields, with a row per sample """
+    rows = [row for block in blocks for row in block_rows(block)]
+    keys = dict.fromkeys(key for row in rows for key in row)
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+
+class CSVHandler(BlockHandler):
+    """ Writes one CSV row (or more) per block, header is written with the first row """
+
+    filename: str = None
+    header: str = None
+
+    def __init__(self):
+        self.outfile = None
+        self.rows_written = 0
+
+    def open(self, flightdir: Path):
+        self.outfile = open(flightdir.joinpath(f"{self.filename}.csv"), "w", buffering=self.buffer_size)
+
+    def state(self):
+        return {"rows_written": self.rows_written}
+
+    def resume(self, flightdir: Path, state):
+        self.outfile = open(flightdir.joinpath(f"{self.filename}.csv"), "a", buffering=self.buffer_size)
+        self.rows_written = state["rows_written"]
+
+    def consume_batch(self, blocks):
+        lines = [line for block in blocks for line in self.rows(block)]
+        if len(lines) != 0 and self.rows_written == 0 and self.header is not None:
+            self.outfile.write(self.header)
+        self.outfile.writelines(lines)
+        self.rows_written += len(lines)
+
+    def flush(self):
+        if self.outfile is not None:
+            self.outfile.flush()
+
+    def rows(self, block):
+        """ Generates the output lines for a block """
+        yield f"{block}\n"
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+class LogMessageHandler(CSVHandler):
+    """ DiagnosticDataLogMessageBlock and DebugMessageDataBlock """
+    block_types = (DiagnosticDataLogMessageBlock, DebugMessageDataBlock)
+    filename = "log_messages"
+
+
+class RadioPacketHandler(CSVHandler):
+    """ DiagnosticDataOutgoingRadioPacketBlock and DiagnosticDataIncomingRadioPacketBlock, written as a row per
+    packet and a file per radio block type (filename_type.csv) with a row per block """
+    header = 'Mission Time (ms),Callsign,Version,Source,Packet Number,Length (bytes),Blocks\n'
+
+    # Buffer size of the files per radio block type, of which there can be many
+    block_buffer_size: int = -1
+
+    def __init__(self):
+        super().__init__()
+        self.flightdir = None
+        # Radio block type name -> (file, csv writer)
+        self.block_files = dict()
+
+    def limit_memory(self, nbytes: int):
+        super().limit_memory(nbytes)
+        self.block_buffer_size = 4096
+
+    def open(self, flightdir: Path):
+        super().open(flightdir)
+        self.flightdir = flightdir
+
+    def state(self):
+        return {**super().state(), "block_files": list(self.block_files)}
+
+    def resume(self, flightdir: Path, state):
+        super().resume(flightdir, state)
+        self.flightdir = flightdir
+        for name in state["block_files"]:
+            f = self._open_block_file(name, "a")
+            self.block_files[name] = (f, csv.writer(f))
+
+    def _open_block_file(self, name: str, mode: str):
+        return open(self.flightdir.joinpath(f"{self.filename}_{name}.csv"), mode, newline="",
+                    buffering=self.block_buffer_size)
+
+    def consume_batch(self, blocks):
+        blocks = [block for block in blocks if len(block.packet) >= PACKET_HEADER.size]
+        headers = unpack_packet_headers(b"".join(block.packet[:PACKET_HEADER.size] for block in blocks))
+        lines = []
+        for i, block in enumerate(blocks):
+            time = mt_to_ms(block.mission_time)
+            number = headers["packet_number"][i]
+            # Packets are padded to a multiple of 4 bytes when logged, their header has the real length
+            length = min(headers["length"][i], len(block.packet))
+            num_blocks = 0
+            for radio_block in gen_radio_blocks(block.packet[PACKET_HEADER.size:length]):
+                self.write_block(time, number, radio_block)
+                num_blocks += 1
+            lines.append(f"{time},{headers['callsign'][i]},{headers['version'][i]},"
+                         f"{device_name(headers['source'][i])},{number},{length},{num_blocks}\n")
+        if len(lines) != 0 and self.rows_written == 0:
+            self.outfile.write(self.header)
+        self.outfile.writelines(lines)
+        self.rows_written += len(lines)
+
+    def write_block(self, time: float, packet_number: int, block):
+        # Data blocks that couldn't be decoded go to their own file, since their columns differ
+        if block.data is not None:
+            name = block.type_name
+            fields = dict(_flatten_fields(dict(block.data)))
+        elif block.error is not None:
+            name = f"{block.type_name}_invalid"
+            fields = {"payload": block.payload.hex(), "error": block.error}
+        else:
+            name = block.type_name
+            fields = {"payload": block.payload.hex()}
+
+        if name not in self.block_files:
+            f = self._open_block_file(name, "w")
+            writer = csv.writer(f)
+            writer.writerow(["Mission Time (ms)", "Packet Number", "Destination", "Signal Report", *fields])
+            self.block_files[name] = (f, writer)
+        self.block_files[name][1].writerow([time, packet_number, device_name(block.destination),
+                                            int(block.signal_report), *fields.values()])
+
+    def flush(self):
+        super().flush()
+        for f, _ in self.block_files.values():
+            f.flush()
+
+    def close(self):
+        super().close()
+        for f, _ in self.block_files.values():
+            f.close()
+        self.block_files = dict()
+
+
+def _flatten_fields(fields: dict, prefix: str = ""):
+    """ Generates (name, value) for the fields of a data block, with nested fields named parent_child """
+    for name, value in fields.items():
+        if isinstance(value, dict):
+            yield from _flatten_fields(value, f"{prefix}{name}_")
+        elif isinstance(value, list):
+            yield f"{prefix}{name}", f"[{' '.join(str(item) for item in value)}]"
+        else:
+            yield f"{prefix}{name}", str(value)
+
+
+class OutgoingRadioPacketHandler(RadioPacketHandler):
+    block_types = (DiagnosticDataOutgoingRadioPacketBlock,)
+    filename = "outgoing_radio_packets"
+
+
+class IncomingRadioPacketHandler(RadioPacketHandler):
+    block_types = (DiagnosticDataIncomingRadioPacketBlock,)
+    filename = "incoming_radio_packets"
+
+
+class AltitudeHandler(CSVHandler):
+    """ AltitudeDataBlock """
+    block_types = (AltitudeDataBlock,)
+    filename = "altitude"
+    header = 'Mission Time (ms),Pressure (Pa),Temperature (C),Altitude (m)\n'
+
+    def rows(self, block):
+        d = block.data
+        yield f"{mt_to_ms(d.mission_time)},{d.pressure},{d.temperature},{d.altitude}\n"
+
+
+class GNSSLocationHandler(CSVHandler):
+    """ GNSSLocationBlock """
+    block_types = (GNSSLocationBlock,)
+    filename = "gnss_location"
+    header = ('Mission Time (ms),Latitude,Longitude,UTC Time,Altitude (m),'
+              'Speed (knots),Course (degs),PDOP,HDOP,VDOP,Sats in Fix,Fix Type\n')
+
+    def rows(self, block):
+        d = block.data
+        yield (f"{mt_to_ms(d.mission_time)},{d.latitude / 600000},"
+               f"{d.longitude / 600000},{d.utc_time},{d.altitude},"
+               f"{d.speed},{d.course},{d.pdop},{d.hdop},{d.vdop},{d.sats},{d.fix_type}\n")
+
+
+class GNSSMetadataHandler(CSVHandler):
+    """ GNSSMetadataBlock """
+    block_types = (GNSSMetadataBlock,)
+    filename = "gnss_metadata"
+    header = 'Mission Time (ms),GPS sats in use,GLONASS sats in use, Sats in view\n'
+
+    def rows(self, block):
+        d = block.data
+
+        # Alternative sats_in_view output
+        # sat_string = ""
+        # for sat in d.sats_in_view:
+        #     sat_string += ' '.join(str(item) for item in list(dict(sat).values())) + " "
+
+        yield (f"{mt_to_ms(d.mission_time)},[{' '.join(str(num) for num in d.gps_sats_in_use)}],"
+               f"[{' '.join(str(num) for num in d.glonass_sats_in_use)}],"
+               f"[{' '.join(str(sat.identifier) for sat in d.sats_in_view)}]\n")
+
+
+class KX134Handler(CSVHandler):
+    """ KX134AccelerometerDataBlock """
+    block_types = (KX134AccelerometerDataBlock,)
+    filename = "kx134_accelerometer"
+    header = ('Mission Time (ms),ODR (Hz),Range (g),LPF Rolloff (ODR/x),'
+              'Resolution (bits),X (g),Y (g),Z (g)\n')
+
+    def rows(self, block):
+        d = block.data
+        # Settings are the same for every sample in a block
+        settings = (f"{d.odr.samples_per_sec},{d.accel_range.acceleration},"
+                    f"{'9' if d.rolloff == KX134LPFRolloff.ODR_OVER_9 else '2'},{d.resolution.bits}")
+        for time, x, y, z in d.gen_samples():
+            yield f"{time},{settings},{x},{y},{z}\n"
+
+
+class MPU9250Handler(CSVHandler):
+    """ MPU9250IMUDataBlock """
+    block_types = (MPU9250IMUDataBlock,)
+    filename = "mpu9250_imu"
+    header = ('Mission Time (ms),Accel/Gyro Sample Rate (Hz),Mag Sample Rate (Hz),'
+              'Accel FSR (g),Gyro FSR (deg/s),Accel Bandwidth (Hz),Gyro '
+              'Bandwidth,Accel X (g),Accel Y (g),Accel Z (g),Gyro X (dps),'
+              'Gyro Y (dps),Gyro Z (dps),Mag X (uT),Mag Y (uT),Mag Z '
+              '(uT),Mag Overflow,Mag Res (bits),Temperature (C)\n')
+
+    def rows(self, block):
+        d = block.data
+        # Settings are the same for every sample in a block
+        settings = (f"{d.ag_sample_rate},{d.mag_sample_rate.samples_per_sec},"
+                    f"{d.accel_fsr.acceleration},{d.gyro_fsr.angular_velocity},"
+                    f"{d.accel_bw.bandwidth},{d.gyro_bw.bandwidth}")
+        for time, s in d.gen_samples():
+            yield (f"{time},{settings},{s.accel_x},"
+                   f"{s.accel_y},{s.accel_z},{s.gyro_x},{s.gyro_y},{s.gyro_z},{s.mag_x},"
+                   f"{s.mag_y},{s.mag_z},{s.mag_ovf},{s.mag_res.bits},{s.temperature}\n")
+
+
+class StatusHandler(CSVHandler):
+    """ StatusDataBlock """
+    block_types = (StatusDataBlock,)
+    filename = "status"
+    header = ('Mission Time (ms),KX134 State,Altimeter State,IMU State,'
+              'SD Card Driver State,Deployment State,SD Blocks Recorded,'
+              'SD Checkouts Missed\n')
+
+    def rows(self, block):
+        d = block.data
+        yield (f"{mt_to_ms(d.mission_time)},{str(d.kx134_state)},{str(d.alt_state)},"
+               f"{str(d.imu_state)},{str(d.sd_state)},{str(d.deployment_state)},"
+               f"{d.sd_blocks_recorded},{d.sd_checkouts_missed}\n")
+
+
+class AccelerationHandler(CSVHandler):
+    """ AccelerationDataBlock """
+    block_types = (AccelerationDataBlock,)
+    filename = "acceleration"
+    header = 'Mission Time (ms),FSR (g),X (g),Y (g),Z (g)\n'
+
+    def rows(self, block):
+        d = block.data
+        yield f"{mt_to_ms(d.mission_time)},{d.fsr},{d.x},{d.y},{d.z}\n"
+
+
+class AngularVelocityHandler(CSVHandler):
+    """ AngularVelocityDataBlock """
+    block_types = (AngularVelocityDataBlock,)
+    filename = "angular_velocity"
+    header = 'Mission Time (ms),FSR (dps),X (dps),Y (dps),Z (dps)\n'
+
+    def rows(self, block):
+        d = block.data
+        yield f"{mt_to_ms(d.mission_time)},{d.fsr},{d.x},{d.y},{d.z}\n"
+
+
+class EventHandler(CSVHandler):
+    """ Detects flight events from AltitudeDataBlock, KX134AccelerometerDataBlock and StatusDataBlock """
+    block_types = (AltitudeDataBlock, KX134AccelerometerDataBlock, StatusDataBlock)
+    filename = "events"
+    header = 'Mission Time (ms),Event,Source,Detail\n'
+
+    def __init__(self):
+        super().__init__()
+        self.detector = EventDetector()
+
+    def rows(self, block):
+        for event in self.detector.consume(block.data):
+            yield f"{event.time},{event.name},{event.source},{event.detail}\n"
+
+    def state(self):
+        return {**super().state(), "detector": self.detector.state()}
+
+    def resume(self, flightdir: Path, state):
+        super().resume(flightdir, state)
+        self.detector.restore(state["detector"])
+
+    def summary(self) -> dict:
+        return {"events": [dict(event) for event in self.detector.events]}
+
+
+# Handlers used for every parsed flight
+DEFAULT_HANDLERS = [
+    LogMessageHandler,
+    OutgoingRadioPacketHandler,
+    IncomingRadioPacketHandler,
+    AltitudeHandler,
+    GNSSLocationHandler,
+    GNSSMetadataHandler,
+    KX134Handler,
+    MPU9250Handler,
+    StatusHandler,
+    AccelerationHandler,
+    AngularVelocityHandler,
+    EventHandler,
+]
+
+
+def load_handlers() -> list:
+    """ Returns the handler factories to use for a flight: the defaults plus any registered plugins """
+    # importlib.metadata is slow to import, and only needed here
+    from importlib.metadata import entry_points
+
+    factories = list(DEFAULT_HANDLERS)
+    for ep in entry_points(group=HANDLER_ENTRY_POINT_GROUP):
+        try:
+            factories.append(ep.load())
+        except Exception as e:
+            print(f"Could not load handler plugin {ep.name}: {e}")
+    return factories
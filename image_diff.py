@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+# Compares the flights of two SD card images or mission files, for example a card extracted twice or a
+# mission file and the image it was made from.
+#
+# Each flight is hashed in chunks of CHUNK_SECTORS sectors, memory mapping the files and hashing parts of
+# a flight in parallel, and only the chunks whose hashes differ are looked at more closely: the blocks
+# overlapping them are decoded on both sides and the first differing block of each type is shown, with
+# the first byte and the decoded fields (of the first differing sample) that differ between its two sides.
+#
+#   python3 image_diff.py full other.mission
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from handlers import block_rows
+from mission_v2 import MissionV2File, open_mission
+from sd_block import SDBlock, SDBlockException
+from superblock import SuperBlock, Flight, find_superblock
+from time_index import gen_block_headers
+
+# Number of sectors hashed together
+CHUNK_SECTORS = 64
+
+
+def _hash_range(buf, start: int, stop: int, chunk_bytes: int) -> list[bytes]:
+    return [hashlib.blake2b(buf[offset:min(offset + chunk_bytes, stop)], digest_size=16).digest()
+            for offset in range(start, stop, chunk_bytes)]
+
+
+def chunk_hashes(file, start: int, length: int, chunk_bytes: int, jobs: int = None) -> list[bytes]:
+    """ Hashes of each chunk of length bytes of a file from start. Plain files are memory mapped and
+    hashed by jobs threads. """
+    if isinstance(file, MissionV2File):
+        file.seek(start)
+        hashes = []
+        for offset in range(0, length, chunk_bytes):
+            data = file.read(min(chunk_bytes, length - offset))
+            if len(data) == 0:
+                break
+            hashes.append(hashlib.blake2b(data, digest_size=16).digest())
+        return hashes
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        stop = min(start + length, len(m))
+        if stop <= start:
+            return []
+        jobs = jobs or os.cpu_count() or 1
+        num_chunks = math.ceil((stop - start) / chunk_bytes)
+        # Each thread hashes a run of whole chunks
+        per_job = math.ceil(num_chunks / jobs) * chunk_bytes
+        view = memoryview(m)
+        try:
+            with ThreadPoolExecutor(jobs) as executor:
+                parts = executor.map(lambda s: _hash_range(view, s, min(s + per_job, stop), chunk_bytes),
+                                     range(start, stop, per_job))
+                return [h for part in parts for h in part]
+        finally:
+            view.release()
+
+
+def differing_ranges(a: list[bytes], b: list[bytes]) -> list[tuple[int, int]]:
+    """ Ranges [start, stop) of chunk numbers whose hashes differ, including chunks only one side has """
+    ranges = []
+    for i in range(max(len(a), len(b))):
+        if i < len(a) and i < len(b) and a[i] == b[i]:
+            continue
+        if len(ranges) != 0 and ranges[-1][1] == i:
+            ranges[-1] = (ranges[-1][0], i + 1)
+        else:
+            ranges.append((i, i + 1))
+    return ranges
+
+
+def gen_blocks_in_ranges(file, part_offset: int, flight: Flight, ranges: list[tuple[int, int]]):
+    """ Generates (offset in flight, raw bytes) for each block of a flight overlapping any of the byte
+    ranges, finding the blocks from their headers and only reading those """
+    # Find the blocks first, since reading them moves the file away from the next header
+    wanted = []
+    ranges = iter(ranges)
+    current = next(ranges, None)
+    for offset, _, _, length, _ in gen_block_headers(file, part_offset, flight):
+        while current is not None and offset >= current[1]:
+            current = next(ranges, None)
+        if current is None:
+            break
+        if offset + length > current[0]:
+            wanted.append((offset, length))
+
+    for offset, length in wanted:
+        file.seek((part_offset + flight.first_block) * 512 + offset)
+        yield offset, file.read(length)
+
+
+def first_differences(file_a, addr_a: int, flight_a: Flight, file_b, addr_b: int, flight_b: Flight,
+                      ranges: list[tuple[int, int]]) -> dict:
+    """ {block type name: ((offset, raw bytes) of a, (offset, raw bytes) of b)} for the first block of each
+    type that differs between two flights in byte ranges of them. A side is None if it has no such block. """
+    def by_type(file, addr, flight):
+        blocks = dict()
+        for offset, raw in gen_blocks_in_ranges(file, addr, flight, ranges):
+            cls = SDBlock.lookup_class(*SDBlock.parse_header(raw)[:2])
+            blocks.setdefault(cls.__name__ if cls is not None else "Unknown", []).append((offset, raw))
+        return blocks
+
+    blocks_a = by_type(file_a, addr_a, flight_a)
+    blocks_b = by_type(file_b, addr_b, flight_b)
+    differences = dict()
+    for name in sorted(blocks_a.keys() | blocks_b.keys()):
+        a = blocks_a.get(name, [])
+        b = blocks_b.get(name, [])
+        for i in range(max(len(a), len(b))):
+            block_a = a[i] if i < len(a) else None
+            block_b = b[i] if i < len(b) else None
+            if block_a is None or block_b is None or block_a[1] != block_b[1]:
+                differences[name] = (block_a, block_b)
+                break
+    return differences
+
+
+def _describe(block) -> str:
+    if block is None:
+        return "(none)"
+    offset, raw = block
+    try:
+        return f"at byte {offset}: {SDBlock.from_bytes(raw)}"
+    except (SDBlockException, ValueError, struct.error) as e:
+        return f"at byte {offset}: could not decode ({e}), {raw.hex()}"
+
+
+def _difference(raw_a: bytes, raw_b: bytes) -> str:
+    """ Where the two sides of a block first differ: the byte, and the decoded fields if both decode """
+    i = next((i for i, (x, y) in enumerate(zip(raw_a, raw_b)) if x != y), min(len(raw_a), len(raw_b)))
+    if i < min(len(raw_a), len(raw_b)):
+        text = f"byte {i} of the block: 0x{raw_a[i]:02x} vs 0x{raw_b[i]:02x}"
+    else:
+        text = f"length: {len(raw_a)} vs {len(raw_b)} bytes"
+    try:
+        rows_a = list(block_rows(SDBlock.from_bytes(raw_a)))
+        rows_b = list(block_rows(SDBlock.from_bytes(raw_b)))
+    except (SDBlockException, ValueError, struct.error):
+        return text
+
+    for n, (row_a, row_b) in enumerate(zip(rows_a, rows_b)):
+        fields = [f"{key} {row_a.get(key)} vs {row_b.get(key)}" for key in dict.fromkeys([*row_a, *row_b])
+                  if row_a.get(key) != row_b.get(key)]
+        if len(fields) != 0:
+            where = f"sample {n}: " if len(rows_a) > 1 or len(rows_b) > 1 else ""
+            return f"{text}, {where}{', '.join(fields)}"
+    if len(rows_a) != len(rows_b):
+        return f"{text}, samples: {len(rows_a)} vs {len(rows_b)}"
+    return text
+
+
+def diff_files(path_a, path_b, chunk_sectors: int = CHUNK_SECTORS, jobs: int = None) -> bool:
+    """ Prints how the flights of two files differ, returns True if they are the same """
+    chunk_bytes = chunk_sectors * 512
+    with open_mission(path_a) as file_a, open_mission(path_b) as file_b:
+        addr_a = find_superblock(file_a)
+        addr_b = find_superblock(file_b)
+        if addr_a is None or addr_b is None:
+            print(f"No superblock found in {path_a if addr_a is None else path_b}")
+            return False
+        file_a.seek(addr_a * 512)
+        sb_a = SuperBlock.from_bytes(file_a.read(512))
+        file_b.seek(addr_b * 512)
+        sb_b = SuperBlock.from_bytes(file_b.read(512))
+
+        same = len(sb_a.flights) == len(sb_b.flights)
+        if not same:
+            print(f"{path_a} has {len(sb_a.flights)} flights, {path_b} has {len(sb_b.flights)}")
+
+        for i, (flight_a, flight_b) in enumerate(zip(sb_a.flights, sb_b.flights)):
+            hashes_a = chunk_hashes(file_a, (addr_a + flight_a.first_block) * 512, flight_a.num_blocks * 512,
+                                    chunk_bytes, jobs)
+            hashes_b = chunk_hashes(file_b, (addr_b + flight_b.first_block) * 512, flight_b.num_blocks * 512,
+                                    chunk_bytes, jobs)
+            ranges = differing_ranges(hashes_a, hashes_b)
+            if flight_a.num_blocks != flight_b.num_blocks:
+                print(f"Flight {i}: {flight_a.num_blocks} blocks long in {path_a}, {flight_b.num_blocks} in {path_b}")
+            if flight_a.timestamp != flight_b.timestamp:
+                print(f"Flight {i}: time {flight_a.timestamp} in {path_a}, {flight_b.timestamp} in {path_b}")
+            if len(ranges) == 0 and flight_a.num_blocks == flight_b.num_blocks:
+                print(f"Flight {i}: identical ({flight_a.num_blocks} blocks)")
+                continue
+
+            same = False
+            sector_ranges = [(start * chunk_sectors, min(stop * chunk_sectors,
+                                                         max(flight_a.num_blocks, flight_b.num_blocks)))
+                             for start, stop in ranges]
+            print(f"Flight {i}: {len(ranges)} differing range{'s' if len(ranges) != 1 else ''} of sectors: " +
+                  ", ".join(f"{start}-{stop - 1}" for start, stop in sector_ranges))
+
+            byte_ranges = [(start * 512, stop * 512) for start, stop in sector_ranges]
+            differences = first_differences(file_a, addr_a, flight_a, file_b, addr_b, flight_b, byte_ranges)
+            for name, (block_a, block_b) in differences.items():
+                print(f"    First differing {name}:")
+                print(f"        {path_a} {_describe(block_a)}")
+                print(f"        {path_b} {_describe(block_b)}")
+                if block_a is not None and block_b is not None:
+                    print(f"        Differs at {_difference(block_a[1], block_b[1])}")
+    return same
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Compare the flights of two SD card images or mission files.")
+    arg_parser.add_argument("file_a")
+    arg_parser.add_argument("file_b")
+    arg_parser.add_argument("--chunk-sectors", type=int, default=CHUNK_SECTORS,
+                            help=f"sectors hashed together (default: {CHUNK_SECTORS})")
+    arg_parser.add_argument("--jobs", type=int, help="number of threads hashing each flight")
+    args = arg_parser.parse_args()
+
+    sys.exit(0 if diff_files(args.file_a, args.file_b, args.chunk_sectors, args.jobs) else 1)
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+# Import time benchmark of the library interface (cuinspace_telemetry.py), using python -X importtime.
+#
+# Each import is timed in a fresh interpreter a number of times. The time of an import is the total of the
+# cumulative times that -X importtime reports for the top level modules it imports, leaving out the ones
+# the interpreter imports at startup anyway. The median is reported. Also checks that making the handlers
+# that use NumPy doesn't import it, since they should only import it when they handle blocks. Exits with
+# 1 if importing the library takes longer than IMPORT_TARGET_FACTOR times as long as starting a bare
+# interpreter (also timed, so the target scales with the machine) or if NumPy is imported too early.
+#
+#   python3 import_bench.py --runs 9
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Most times as long as starting a bare interpreter importing cuinspace_telemetry may take
+IMPORT_TARGET_FACTOR = 3.0
+# Imports timed, along with the factor of the startup time each has to stay within (None to only report it)
+IMPORTS = {
+    "cuinspace_telemetry": IMPORT_TARGET_FACTOR,
+    # What parse_image imports before parsing
+    "cuinspace_telemetry, flight_parser, mission_v2, summary, parse_cache, handlers": None,
+}
+LAZY_CHECK = ("import cuinspace_telemetry, sys; "
+              "cuinspace_telemetry.make_handler_factories(0, downsample=100, pyramid=True); "
+              "print('numpy' in sys.modules)")
+
+
+def top_level_imports(code: str) -> dict[str, float]:
+    """ Cumulative ms of each top level module imported by running code in a fresh interpreter """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=Path(__file__).parent,
+                            capture_output=True, text=True, check=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented under the module that imported them
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def startup_ms() -> float:
+    """ Wall time in ms of starting a bare interpreter and exiting """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def import_ms(imports: str, startup: set) -> float:
+    times = top_level_imports(f"import {imports}")
+    return sum(ms for name, ms in times.items() if name not in startup)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark the import time of the library interface.")
+    arg_parser.add_argument("--runs", type=int, default=5, help="times each import is timed (default: 5)")
+    args = arg_parser.parse_args()
+
+    startup = set(top_level_imports("pass"))
+    baseline = statistics.median(startup_ms() for _ in range(args.runs))
+    print(f"Interpreter startup: {baseline:.1f} ms")
+    failed = False
+    for imports, factor in IMPORTS.items():
+        median = statistics.median(import_ms(imports, startup) for _ in range(args.runs))
+        verdict = ""
+        if factor is not None:
+            target = factor * baseline
+            verdict = f" (target {target:.1f} ms, {factor:g}x startup{', too slow' if median > target else ''})"
+            failed |= median > target
+        print(f"import {imports}: {median:.1f} ms{verdict}")
+
+    imported_numpy = subprocess.run([sys.executable, "-c", LAZY_CHECK], cwd=Path(__file__).parent,
+                                    capture_output=True, text=True, check=True).stdout.strip() == "True"
+    print(f"NumPy imported by making the handlers: {'yes' if imported_numpy else 'no'}")
+    failed |= imported_numpy
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,100 @@
+# Memory limit for parsing a flight, for machines where a parse has to stay within a fixed amount of
+# memory however long the flight is.
+#
+# Most of what a parse holds is bounded by the number of blocks in a batch, but the batches, the
+# handlers' buffers and queues and the time index are all sized for speed rather than memory. A
+# MemoryBudget first sets aside what doesn't depend on them: what a parse holds whatever the flight
+# (FIXED_BYTES) and the state each handler keeps between batches (BlockHandler.state_bytes, such as the
+# buckets of a downsampler). The rest of the limit is split between:
+#  - the reader's buffer (READER_SHARE)
+#  - decoded blocks waiting to be handed to handlers (BATCH_SHARE), flushed early once they would use
+#    more than their share. The memory a decoded block uses is measured from the first blocks of its
+#    class, as a multiple of its raw size.
+#  - the handlers' output buffers and queues, and what they make from a batch (HANDLER_SHARE), split
+#    evenly between them
+#  - the time index (INDEX_SHARE), which gets sparser as the flight goes on rather than growing
+# What's left over is headroom for the allocator, which doesn't hand freed memory back right away, so
+# the peak RSS of a parse is above the peak of what it has allocated. memory_check.py checks both peaks
+# stay under the limit.
+
+import sys
+from enum import Enum
+from types import FunctionType, ModuleType
+
+# Memory a parse uses whatever the flight and handlers
+FIXED_BYTES = 1024 * 1024
+# Memory used by each entry of a time index
+INDEX_ENTRY_BYTES = 96
+# Blocks of each class whose decoded size is measured
+MEASURED_BLOCKS = 8
+
+READER_SHARE = 0.05
+BATCH_SHARE = 0.2
+HANDLER_SHARE = 0.25
+INDEX_SHARE = 0.05
+
+# Smallest limit, enough for the largest possible block to be decoded
+MIN_MEMORY_LIMIT = 4 * 1024 * 1024
+
+# Block class -> [blocks measured, most memory used by one of them per raw byte]
+_decoded_ratios: dict[type, list] = dict()
+
+
+def deep_size(obj, seen: set = None) -> int:
+    """ Memory used by an object and everything it refers to, apart from what is shared (classes, enum
+    members, functions and modules) """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (type, Enum, FunctionType, ModuleType)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def decoded_size(block, raw_length: int) -> int:
+    """ Estimated memory used by a decoded block, from the most used per raw byte by the first
+    MEASURED_BLOCKS blocks of its class """
+    measured = _decoded_ratios.setdefault(type(getattr(block, "data", block)), [0, 0.0])
+    if measured[0] < MEASURED_BLOCKS:
+        measured[0] += 1
+        measured[1] = max(measured[1], deep_size(block) / raw_length)
+    return int(raw_length * measured[1])
+
+
+class MemoryBudget:
+    def __init__(self, limit: int, reserved: int = 0):
+        if limit < MIN_MEMORY_LIMIT:
+            raise ValueError(f"Memory limit must be at least {MIN_MEMORY_LIMIT // (1024 * 1024)} MB")
+        available = limit - FIXED_BYTES - reserved
+        if available < (limit - FIXED_BYTES) // 4:
+            raise ValueError(f"Memory limit of {limit / 1024 ** 2:.0f} MB is too small for the handlers, which "
+                             f"keep {reserved / 1024 ** 2:.1f} MB of state")
+        self.limit: int = limit
+        # Bytes set aside for the state of the handlers
+        self.reserved: int = reserved
+        self.reader_bytes: int = int((limit - FIXED_BYTES) * READER_SHARE)
+        # Memory the decoded blocks waiting for handlers can use at once
+        self.batch_bytes: int = int(available * BATCH_SHARE)
+        self.handler_bytes: int = int(available * HANDLER_SHARE)
+        self.index_entries: int = max(int(available * INDEX_SHARE / INDEX_ENTRY_BYTES), 16)
+
+    def reserve(self, nbytes: int):
+        """ The budget left once nbytes more are set aside. Raises ValueError if that leaves too little. """
+        return MemoryBudget(self.limit, self.reserved + nbytes)
+
+    def for_handlers(self, handlers: list):
+        """ The budget left once the state of handlers is set aside. Raises ValueError if that leaves too
+        little. """
+        return self.reserve(sum(handler.state_bytes() for handler in handlers))
+
+    def __str__(self):
+        return (f"{self.limit / 1024 ** 2:.0f} MB: {self.reader_bytes // 1024} KB reader buffer, "
+                f"{self.batch_bytes // 1024} KB of decoded blocks per batch, {self.handler_bytes // 1024} KB for "
+                f"handlers, {self.reserved // 1024} KB of handler state, {self.index_entries} time index entries")
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+# Checks that parsing with a memory limit stays within it, however long the flight.
+#
+# A large synthetic mission file is made, with one flight of the blocks that use the most memory once
+# decoded (KX134 and MPU9250 blocks with many samples, altitude, GNSS and status blocks and log messages),
+# or, if a file is given, of copies of its first flight (without its spacers). It is parsed in a child
+# process with --memory-limit's budget, once under tracemalloc to find the peak memory allocated by
+# Python, and once without to find how much the peak RSS grew over the parse. The parse uses the default
+# handlers and the timeline, and with --all-handlers also the downsampled outputs and pyramids (which use
+# NumPy, and whose state needs a larger limit). The child first parses a short flight so that the modules
+# the parse imports and what it caches count as part of the interpreter rather than the parse. By default
+# each of DEFAULT_CHECKS is run, and the exit code is 1 if any parse went over its limit, so this can run
+# unattended.
+#
+#   python3 memory_check.py
+#   python3 memory_check.py full --size 50 --limit 16 --all-handlers
+
+import argparse
+import json
+import struct
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from mission_filter import filter_flight
+from mission_v2 import open_mission
+from superblock import SuperBlock, Flight, find_superblock
+
+# Limits (MB) checked by default, and whether each is checked with all handlers
+DEFAULT_CHECKS = ((4, False), (8, False), (16, False), (16, True))
+# Size of the flight parsed before the measured one
+WARMUP_BYTES = 256 * 1024
+
+# Run in a child process so that nothing the parent has allocated counts
+CHILD = """
+import json, resource, sys, tracemalloc
+from pathlib import Path
+
+import cuinspace_telemetry
+from flight_parser import parse_flight
+from memory_budget import MemoryBudget
+from mission_v2 import open_mission
+from superblock import SuperBlock
+
+warmup, path, outdir, limit = sys.argv[1], sys.argv[2], Path(sys.argv[3]), int(sys.argv[4])
+trace, all_handlers = sys.argv[5] == "1", sys.argv[6] == "1"
+extras = {"downsample": 2000, "pyramid": True} if all_handlers else {}
+handler_factories = cuinspace_telemetry.make_handler_factories(0, **extras)
+memory = MemoryBudget(limit)
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss() -> int:
+    # Not ru_maxrss, which is carried over from the parent through exec
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+
+
+for i, mission in enumerate((warmup, path)):
+    with open_mission(mission, buffer_size=memory.reader_bytes) as file:
+        sb = SuperBlock.from_bytes(file.read(512))
+        if i == 1:
+            # Reset the peak RSS to the RSS now. If it can't be, the peak so far is at least the RSS now, so
+            # its growth is only ever overestimated.
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+            baseline = rss()
+            if trace:
+                tracemalloc.start()
+        parse_flight(file, outdir.joinpath(str(i)), 0, 0, sb.flights[0], handler_factories=handler_factories,
+                     memory=memory)
+peak = tracemalloc.get_traced_memory()[1] if trace else None
+json.dump({"traced_peak": peak, "rss_growth": peak_rss() - baseline}, sys.stdout)
+"""
+
+
+def _block(block_class: int, block_type: int, payload: bytes) -> bytes:
+    return struct.pack("<HH", block_class | (block_type << 6), len(payload) + 4) + payload
+
+
+def synthetic_blocks(mission_time: int) -> bytes:
+    """ The blocks logged in about 50 ms of a flight, starting at a mission time """
+    # KX134: 400 Hz, 64 g, 16 bit samples (bit 6 is the resolution)
+    kx134 = struct.pack("<IH", mission_time, 9 | (3 << 4) | (1 << 6)) + struct.pack("<hhh", 10, -20, 1024) * 20
+    kx134 += bytes(-len(kx134) % 4)
+    # MPU9250: 10 samples of accelerometer, gyroscope, magnetometer and temperature
+    sample = struct.pack(">hhhhhhh", 100, -100, 16384, 0, 10, 20, 30) + struct.pack("<hhhB", 1, 2, 3, 1 << 3)
+    mpu9250 = struct.pack("<II", mission_time, 9 | (1 << 8) | (1 << 9) | (1 << 11)) + sample * 10
+    mpu9250 += bytes(-len(mpu9250) % 4)
+    blocks = [
+        _block(1, 0x03, struct.pack("<Iiii", mission_time, 101325, 21000, 1500000)),
+        _block(1, 0x0B, kx134),
+        _block(1, 0x0A, mpu9250),
+    ]
+    if mission_time % 1024 < 52:
+        blocks += [
+            # Every sensor running, deployment state 1
+            _block(1, 0x01, struct.pack("<IIII", mission_time,
+                                        (2 << 16) | (2 << 19) | (2 << 22) | (2 << 25) | (1 << 28), 5, 0)),
+            _block(1, 0x06, struct.pack("<IiiIihhHHHBB", mission_time, 27000000, -45000000, 120000, 100000, 0, 0,
+                                        100, 100, 100, 7, 3)),
+            _block(2, 0x00, struct.pack("<I", mission_time) + b"Checking memory use".ljust(20, b"\0")),
+        ]
+    return b"".join(blocks)
+
+
+def make_synthetic_mission(out_path: Path, size: int) -> int:
+    """ Writes a mission file with one synthetic flight at least size bytes long. Returns the number of
+    sectors in the flight. """
+    with open(out_path, "wb") as out:
+        out.write(bytes(512))
+        total = 0
+        mission_time = 0
+        while total < size:
+            data = synthetic_blocks(mission_time)
+            out.write(data)
+            total += len(data)
+            mission_time += 51
+        # Pad the flight to a whole sector with a spacer
+        padding = -total % 512
+        if padding != 0:
+            out.write(_block(0, 0, bytes(padding - 4)) if padding >= 4 else bytes(padding))
+        sectors = (total + padding) // 512
+        out.seek(0)
+        out.write(SuperBlock(flights=[Flight(1, sectors, 1)]).to_bytes())
+    return sectors
+
+
+def make_mission(src_path, out_path: Path, size: int) -> int:
+    """ Writes a mission file with one flight made of copies of the first flight of src_path, at least size
+    bytes long. Returns the number of sectors in the flight. """
+    with open_mission(src_path) as src, open(out_path, "wb") as out:
+        superblock_addr = find_superblock(src)
+        if superblock_addr is None:
+            raise ValueError(f"No superblock found in {src_path}")
+        src.seek(superblock_addr * 512)
+        sb = SuperBlock.from_bytes(src.read(512))
+        if len(sb.flights) == 0:
+            raise ValueError(f"No flights in {src_path}")
+        flight = sb.flights[0]
+
+        out.write(bytes(512))
+        total = 0
+        while total * 512 < size:
+            total += filter_flight(src, superblock_addr, flight, out, set(), compact=True)
+        out.seek(0)
+        out.write(SuperBlock(flights=[Flight(1, total, flight.timestamp)]).to_bytes())
+    return total
+
+
+def run_parse(warmup: Path, path: Path, outdir: Path, limit: int, trace: bool, all_handlers: bool) -> dict:
+    result = subprocess.run([sys.executable, "-c", CHILD, str(warmup), str(path), str(outdir), str(limit),
+                             "1" if trace else "0", "1" if all_handlers else "0"],
+                            cwd=Path(__file__).parent, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Parse failed:\n{result.stderr}")
+    # The parse prints its own output first
+    return json.loads(result.stdout[result.stdout.rindex("{"):])
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Check that parsing with a memory limit stays within it.")
+    arg_parser.add_argument("infile", nargs="?",
+                            help="SD card image or mission file whose first flight is repeated (default: a "
+                                 "synthetic flight)")
+    arg_parser.add_argument("--size", type=float, default=8, metavar="MB",
+                            help="size of the flight to parse (default: 8 MB)")
+    default_checks = ", ".join(f"{limit} MB" + (" with all handlers" if all_handlers else "")
+                               for limit, all_handlers in DEFAULT_CHECKS)
+    arg_parser.add_argument("--limit", type=float, action="append", metavar="MB",
+                            help=f"memory limit to check, can be given more than once (default: {default_checks})")
+    arg_parser.add_argument("--all-handlers", action="store_true",
+                            help="also use the downsampling and pyramid handlers with the limits given")
+    args = arg_parser.parse_args()
+
+    checks = DEFAULT_CHECKS if args.limit is None else [(limit, args.all_handlers) for limit in args.limit]
+    try:
+        import numpy
+    except ImportError:
+        print("NumPy isn't installed, skipping the checks with all handlers")
+        checks = [(limit, False) for limit, all_handlers in checks if not all_handlers]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        mission = tmp.joinpath("large.mission")
+        size = int(args.size * 1024 ** 2)
+        if args.infile is None:
+            sectors = make_synthetic_mission(mission, size)
+        else:
+            sectors = make_mission(args.infile, mission, size)
+        warmup = tmp.joinpath("warmup.mission")
+        make_synthetic_mission(warmup, WARMUP_BYTES)
+
+        ok = True
+        for limit_mb, all_handlers in checks:
+            limit = int(limit_mb * 1024 ** 2)
+            print(f"Parsing a {sectors * 512 / 1024 ** 2:.0f} MB flight with a {limit_mb:g} MB limit"
+                  f"{' and all handlers' if all_handlers else ''}")
+            for trace, name, key in ((True, "Peak traced memory", "traced_peak"),
+                                     (False, "Peak RSS growth", "rss_growth")):
+                outdir = tmp.joinpath(f"{limit_mb:g}_{'all_' if all_handlers else ''}{'traced' if trace else 'rss'}")
+                used = run_parse(warmup, mission, outdir, limit, trace, all_handlers)[key]
+                within = used <= limit
+                ok = ok and within
+                print(f"  {name}: {used / 1024 ** 2:.1f} MB ({'ok' if within else 'over the limit'})")
+
+    sys.exit(0 if ok else 1)
@@ -14,3 +14,10 @@ def metres_to_feet(metres: float) -> float:
     """Returns the passed metres value in feet as a float."""
 
     return round(metres * 3.28, 1)
+
+
+def mt_to_ms(mt: int) -> float:
+
+    """Returns the passed mission time (1024 ticks per second) in milliseconds."""
+
+    return mt * (1000 / 1024)
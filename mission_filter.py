@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+# Rewrites a mission file (or the flights of an SD card image) keeping only some types of block.
+#
+# Only block headers are read, and the raw bytes of kept blocks are copied as they are, so the filter
+# runs at close to disk speed. Dropped blocks are either replaced by spacer blocks of the same length,
+# which keeps every flight the same size and every kept block at the same offset (so saved time indexes
+# still apply), or compacted out, in which case the flights shrink and the superblock's flight table is
+# rebuilt to match.
+#
+#   python3 mission_filter.py in.mission out.mission --drop kx134_1211_accel,mpu9250_imu [--compact]
+#   python3 mission_filter.py in.mission out.mission --keep altitude,gnss,status
+
+import argparse
+import struct
+from pathlib import Path
+
+from block import DataBlockSubtype
+from mission_v2 import open_mission
+from sd_block import SDBlockClass, LoggingMetadataBlockType, DiagnosticDataBlockType
+from superblock import SuperBlock, Flight, find_superblock
+
+HEADER = struct.Struct("<HH")
+# Class and type of spacer blocks
+SPACER_KEY = (SDBlockClass.LOGGING_METADATA, LoggingMetadataBlockType.SPACER)
+# Size of the reads of a flight's blocks
+READ_SIZE = 1024 * 1024
+
+
+def block_key(name: str) -> tuple[int, int]:
+    """ (class, type) of a block from its name, a telemetry data subtype (such as altitude or
+    kx134_1211_accel) or a diagnostic type (such as log_message) """
+    name = name.strip().upper()
+    if name in DataBlockSubtype.__members__:
+        return SDBlockClass.TELEMETRY_DATA, DataBlockSubtype[name]
+    if name in DiagnosticDataBlockType.__members__:
+        return SDBlockClass.DIAGNOSTIC_DATA, DiagnosticDataBlockType[name]
+    raise ValueError(f"Unknown block type: {name.lower()}")
+
+
+def spacer(length: int) -> bytes:
+    """ A spacer block of a length, including its header """
+    return HEADER.pack(SPACER_KEY[0] | (SPACER_KEY[1] << 6), length) + bytes(length - 4)
+
+
+def filter_flight(file, part_offset: int, flight: Flight, out, drop: set, compact: bool = False) -> int:
+    """ Writes the blocks of a flight to out, with blocks whose (class, type) is in drop replaced by
+    spacers or (if compact) left out along with the flight's spacers. Returns the number of sectors
+    written. """
+    flight_bytes = flight.num_blocks * 512
+    file.seek((part_offset + flight.first_block) * 512)
+
+    buf = b""
+    # Offset in the flight of the start of buf
+    start = 0
+    unread = flight_bytes
+    written = 0
+    done = False
+    while not done:
+        data = file.read(min(READ_SIZE, unread))
+        unread -= len(data)
+        buf += data
+
+        pos = 0
+        # Runs of kept blocks are copied in one go
+        run_start = 0
+        parts = []
+        while pos + 4 <= len(buf):
+            head, length = HEADER.unpack_from(buf, pos)
+            if length < 4 or start + pos + length > flight_bytes:
+                # End of the flight's blocks
+                done = True
+                break
+            if pos + length > len(buf):
+                break
+            key = (head & 0x3f, head >> 6)
+            if key in drop or (compact and key == SPACER_KEY):
+                parts.append(buf[run_start:pos])
+                if not compact:
+                    parts.append(spacer(length))
+                run_start = pos + length
+            pos += length
+        parts.append(buf[run_start:pos])
+        if len(data) == 0 or unread == 0 and pos + 4 > len(buf):
+            done = True
+
+        for part in parts:
+            out.write(part)
+            written += len(part)
+        buf = buf[pos:]
+        start += pos
+
+    if not compact:
+        # Copy whatever follows the blocks so the flight keeps its size
+        out.write(buf)
+        written += len(buf)
+        while unread > 0:
+            data = file.read(min(READ_SIZE, unread))
+            if len(data) == 0:
+                break
+            unread -= len(data)
+            out.write(data)
+            written += len(data)
+
+    # Fill the rest of the last sector with a spacer, which needs at least 4 bytes
+    pad = -written % 512
+    if 0 < pad < 4 or written == 0:
+        pad += 512
+    if pad != 0:
+        out.write(spacer(pad))
+        written += pad
+    return written // 512
+
+
+def filter_mission(infile: Path, outfile: Path, drop: set, compact: bool = False):
+    """ Writes a mission file with the flights of an SD card image or mission file, filtered by
+    filter_flight """
+    with open_mission(infile) as src, open(outfile, "wb") as out:
+        superblock_addr = find_superblock(src)
+        if superblock_addr is None:
+            raise ValueError(f"No superblock found in {infile}")
+        src.seek(superblock_addr * 512)
+        superblock = bytearray(src.read(512))
+        sb = SuperBlock.from_bytes(bytes(superblock))
+
+        # Flights are written one after the other from the sector after the superblock
+        out.write(superblock)
+        first_block = 1
+        flights = []
+        for flight in sb.flights:
+            num_blocks = filter_flight(src, superblock_addr, flight, out, drop, compact)
+            flights.append(Flight(first_block, num_blocks, flight.timestamp))
+            first_block += num_blocks
+
+        for i in range(32):
+            flight_start = 0x60 + (12 * i)
+            superblock[flight_start:flight_start + 12] = flights[i].to_bytes() if i < len(flights) else bytes(12)
+        out.seek(0)
+        out.write(superblock)
+    return SuperBlock.from_bytes(bytes(superblock))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Write a mission file with only some types of block.")
+    arg_parser.add_argument("infile", type=Path, help="SD card image or mission file")
+    arg_parser.add_argument("outfile", type=Path, help="mission file to write")
+    group = arg_parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--drop", metavar="TYPES",
+                       help="comma separated block types to drop, telemetry data subtypes (" +
+                            ", ".join(name.lower() for name in DataBlockSubtype.__members__) +
+                            ") or diagnostic types (" +
+                            ", ".join(name.lower() for name in DiagnosticDataBlockType.__members__) + ")")
+    group.add_argument("--keep", metavar="TYPES",
+                       help="comma separated telemetry data subtypes to keep, dropping all others "
+                            "(diagnostic blocks are kept)")
+    arg_parser.add_argument("--compact", action="store_true",
+                            help="leave dropped blocks and spacers out rather than replacing them with spacers")
+    args = arg_parser.parse_args()
+
+    try:
+        if args.drop is not None:
+            drop = set(block_key(name) for name in args.drop.split(","))
+        else:
+            keep = set(block_key(name) for name in args.keep.split(","))
+            drop = set((SDBlockClass.TELEMETRY_DATA, subtype) for subtype in DataBlockSubtype) - keep
+    except ValueError as e:
+        exit(str(e))
+
+    new_sb = filter_mission(args.infile, args.outfile, drop, args.compact)
+    print("NEW TELEMETRY FLIGHT DETAILS")
+    new_sb.output()
+    print(f"{args.infile} ({args.infile.stat().st_size} bytes) -> {args.outfile} "
+          f"({args.outfile.stat().st_size} bytes)")
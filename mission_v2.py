@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+# Version 2 of the telemetry mission file: compressed, seekable and indexed by mission time.
+#
+# A version 1 mission file is a superblock followed by the raw sectors of its flights. A version 2 file
+# holds the same superblock and sectors, but each flight is split into chunks of CHUNK_SECTORS sectors
+# that are compressed independently, followed by a footer that indexes the chunks:
+#
+#   "CUInSpv2" | superblock (512 bytes) | compressed chunks... | footer (JSON) | footer offset (u64) | "CUInSpv2"
+#
+# Each footer entry gives a chunk's flight, first sector and number of sectors, its offset and
+# compressed length in the file, and the first and last mission time of the telemetry blocks starting in
+# it. MissionV2File reads a version 2 file as if it were the version 1 file, only decompressing the
+# chunks that are read, and builds a flight's time index from the footer. A time window of a flight can
+# be parsed without decompressing the whole file.
+#
+# Run this module to convert between versions:
+#   python3 mission_v2.py compress in.mission out.mission
+#   python3 mission_v2.py decompress in.mission out.mission
+
+import argparse
+import io
+import json
+import shutil
+import struct
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+
+from misc.converter import mt_to_ms
+from sd_block import SDBlockClass
+from superblock import SuperBlock, Flight
+from time_index import TimeIndex, gen_block_headers
+
+MAGIC = b"CUInSpv2"
+# Offset of the footer and the magic, at the very end of the file
+TRAILER = struct.Struct("<Q8s")
+# Number of sectors compressed together
+CHUNK_SECTORS = 256
+# Number of decompressed chunks kept in memory by a reader
+CHUNK_CACHE_SIZE = 4
+
+
+def is_mission_v2(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_mission(path, buffer_size: int = -1):
+    """ Opens an SD card image or mission file for reading, reading version 2 mission files through
+    MissionV2File. If buffer_size is given, the file's buffer (or a version 2 file's decompressed
+    chunks) are kept within it. """
+    if is_mission_v2(path):
+        return MissionV2File(path, buffer_size)
+    return open(path, "rb", buffering=buffer_size)
+
+
+class MissionV2File(io.RawIOBase):
+    """ Reads a version 2 mission file as the version 1 file it was made from """
+
+    def __init__(self, path, buffer_size: int = -1):
+        super().__init__()
+        self.file = open(path, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a version 2 mission file")
+        self.superblock = self.file.read(512)
+
+        footer_end = self.file.seek(-TRAILER.size, io.SEEK_END)
+        footer_offset, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Version 2 mission file has no footer, it may be truncated")
+        self.file.seek(footer_offset)
+        footer = json.loads(self.file.read(footer_end - footer_offset))
+        self.chunk_sectors: int = footer["chunk_sectors"]
+        self.chunks: list[dict] = sorted(footer["chunks"], key=lambda c: c["sector"])
+        self._chunk_starts = [c["sector"] * 512 for c in self.chunks]
+
+        self.size = 512
+        if len(self.chunks) != 0:
+            self.size = (self.chunks[-1]["sector"] + self.chunks[-1]["sectors"]) * 512
+        self.pos = 0
+        self._cache = OrderedDict()
+        self.cache_size = CHUNK_CACHE_SIZE
+        if buffer_size > 0:
+            self.cache_size = max(buffer_size // (self.chunk_sectors * 512), 1)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.pos = offset
+        return self.pos
+
+    def _chunk_data(self, i: int) -> bytes:
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+
+        chunk = self.chunks[i]
+        self.file.seek(chunk["offset"])
+        data = zlib.decompress(self.file.read(chunk["length"]))
+        self._cache[i] = data
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        """ Reads up to size bytes at a position, stopping at the end of the superblock or chunk """
+        if pos < 512:
+            return self.superblock[pos:pos + size]
+
+        i = bisect_right(self._chunk_starts, pos) - 1
+        if i < 0 or pos >= self._chunk_starts[i] + (self.chunks[i]["sectors"] * 512):
+            # Not in any flight, read as zeros up to the next chunk
+            end = self._chunk_starts[i + 1] if i + 1 < len(self.chunks) else self.size
+            return bytes(min(size, end - pos))
+        start = pos - self._chunk_starts[i]
+        return self._chunk_data(i)[start:start + size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        parts = []
+        while size > 0 and self.pos < self.size:
+            data = self._read_at(self.pos, min(size, self.size - self.pos))
+            parts.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+    def time_index(self, flight: Flight) -> TimeIndex:
+        """ Time index of a flight from the footer, without reading any chunks """
+        index = TimeIndex(self.chunk_sectors)
+        for chunk in self.chunks:
+            if chunk["flight_block"] != flight.first_block or chunk["first_time"] is None:
+                continue
+            index.offsets.append(chunk["first_offset"])
+            index.times.append(chunk["first_time"])
+        return index
+
+
+def _chunk_times(file, flight: Flight, chunk_sectors: int) -> dict:
+    """ {chunk number: [offset in flight of the first telemetry block starting in it, first time, last
+    time]} for a flight of a version 1 mission file """
+    times = dict()
+    chunk_bytes = chunk_sectors * 512
+    for offset, block_class, _, _, mission_time in gen_block_headers(file, 0, flight):
+        if block_class != SDBlockClass.TELEMETRY_DATA or mission_time is None:
+            continue
+        t = mt_to_ms(mission_time)
+        entry = times.setdefault(offset // chunk_bytes, [offset, t, t])
+        entry[2] = t
+    return times
+
+
+def compress_mission(infile: Path, outfile: Path, chunk_sectors: int = CHUNK_SECTORS, level: int = 6):
+    """ Converts a version 1 mission file to version 2 """
+    with open(infile, "rb") as src, open(outfile, "wb") as out:
+        superblock = src.read(512)
+        sb = SuperBlock.from_bytes(superblock)
+        out.write(MAGIC)
+        out.write(superblock)
+
+        chunks = []
+        for flight_num, flight in enumerate(sb.flights):
+            times = _chunk_times(src, flight, chunk_sectors)
+            src.seek(flight.first_block * 512)
+            for i, sector in enumerate(range(0, flight.num_blocks, chunk_sectors)):
+                sectors = min(chunk_sectors, flight.num_blocks - sector)
+                data = zlib.compress(src.read(sectors * 512), level)
+                first_offset, first_time, last_time = times.get(i, (None, None, None))
+                chunks.append({"flight": flight_num, "flight_block": flight.first_block,
+                               "sector": flight.first_block + sector, "sectors": sectors,
+                               "offset": out.tell(), "length": len(data), "first_offset": first_offset,
+                               "first_time": first_time, "last_time": last_time})
+                out.write(data)
+
+        footer_offset = out.tell()
+        out.write(json.dumps({"version": 2, "chunk_sectors": chunk_sectors, "chunks": chunks}).encode())
+        out.write(TRAILER.pack(footer_offset, MAGIC))
+
+
+def decompress_mission(infile: Path, outfile: Path):
+    """ Converts a version 2 mission file back to version 1 """
+    with MissionV2File(infile) as src, open(outfile, "wb") as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Convert mission files between version 1 and 2.")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    compress_parser = subparsers.add_parser("compress", help="convert a version 1 mission file to version 2")
+    compress_parser.add_argument("infile", type=Path)
+    compress_parser.add_argument("outfile", type=Path)
+    compress_parser.add_argument("--chunk-sectors", type=int, default=CHUNK_SECTORS,
+                                 help=f"sectors compressed together (default: {CHUNK_SECTORS})")
+    compress_parser.add_argument("--level", type=int, default=6, choices=range(10), metavar="0-9",
+                                 help="zlib compression level (default: 6)")
+    decompress_parser = subparsers.add_parser("decompress", help="convert a version 2 mission file to version 1")
+    decompress_parser.add_argument("infile", type=Path)
+    decompress_parser.add_argument("outfile", type=Path)
+    args = arg_parser.parse_args()
+
+    if args.command == "compress":
+        compress_mission(args.infile, args.outfile, args.chunk_sectors, args.level)
+    else:
+        decompress_mission(args.infile, args.outfile)
+    in_size = args.infile.stat().st_size
+    out_size = args.outfile.stat().st_size
+    print(f"{args.infile} ({in_size} bytes) -> {args.outfile} ({out_size} bytes, {out_size / in_size:.1%})")
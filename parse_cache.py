@@ -0,0 +1,374 @@
+# Content-addressed cache of parsed flights.
+#
+# A flight's outputs only depend on its raw blocks, the parser version and the handlers it was parsed
+# with, so they are cached under a hash of those. Parsing the same flight again, whether from the same
+# image, a copy of the card or a mission file made from it, hard links the cached outputs into place
+# (copying them if links aren't possible) instead of parsing from scratch. The least recently used
+# entries are evicted once the cache is over its size limit.
+#
+# Hashing a flight reads all of it, so the key of a flight is remembered along with the identity of the
+# file it was read from (device, inode, size and modification time), and a flight in a file that hasn't
+# changed isn't hashed again. A flight that hasn't been seen before is only hashed up front if a cache entry
+# starts with the same sectors, otherwise it is hashed as it is parsed, so a miss reads it once.
+#
+# Only flight folders made by the cache or follow.py (whose summary has a cache_key) are replaced when out
+# of date. Folders parsed without the cache are left as they are, like parse_flight does.
+#
+# Cached outputs are hard linked, so editing an output file in place also edits the cached copy.
+# Run this module to list the entries in the cache or prune it.
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+from functools import partial
+from pathlib import Path
+
+from flight_parser import PARSER_VERSION, parse_flight
+from summary import flight_dict, follow_state_path, read_summary, summary_path, write_summary
+from superblock import Flight
+from time_index import index_path
+
+# Default cache directory, next to the out and missions directories
+CACHE_DIR = Path.cwd().joinpath("cache")
+# Default limit of the total size of the cache in bytes
+MAX_CACHE_SIZE = 2 * 1024 ** 3
+# Size of the reads used to hash a flight
+HASH_READ_SIZE = 1024 * 1024
+# Sectors at the start of a flight hashed to find cache entries it may match
+SAMPLE_SECTORS = 64
+# Folder in the cache of the keys of flights in files that have been parsed
+KEYS_DIR = "keys"
+
+
+def _factory_name(factory) -> str:
+    if isinstance(factory, partial):
+        return (f"{_factory_name(factory.func)}{factory.args!r}"
+                f"{sorted(factory.keywords.items())!r}")
+    return f"{factory.__module__}.{factory.__qualname__}"
+
+
+def _hash_flight_blocks(h, file, part_offset: int, flight: Flight):
+    file.seek((part_offset + flight.first_block) * 512)
+    remaining = flight.num_blocks * 512
+    while remaining > 0:
+        data = file.read(min(remaining, HASH_READ_SIZE))
+        if len(data) == 0:
+            break
+        h.update(data)
+        remaining -= len(data)
+
+
+def flight_hash(file, part_offset: int, flight: Flight) -> str:
+    """ Hash of a flight's raw blocks, the same wherever the flight is stored """
+    h = hashlib.blake2b(digest_size=20)
+    _hash_flight_blocks(h, file, part_offset, flight)
+    return h.hexdigest()
+
+
+def _key_hash(handler_factories):
+    """ Hash of the parser version and handlers, which the flight's blocks are then added to """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{PARSER_VERSION}\n".encode())
+    for factory in handler_factories:
+        h.update(f"{_factory_name(factory)}\n".encode())
+    return h
+
+
+def flight_key(file, part_offset: int, flight: Flight, handler_factories) -> str:
+    """ Cache key of a flight parsed with a set of handlers: a hash of its raw blocks, the parser version
+    and the handlers """
+    h = _key_hash(handler_factories)
+    _hash_flight_blocks(h, file, part_offset, flight)
+    return h.hexdigest()
+
+
+def sample_key(file, part_offset: int, flight: Flight, handler_factories) -> str:
+    """ Hash of the first SAMPLE_SECTORS sectors and length of a flight and the handlers, which a flight
+    has in common with any cache entry it matches """
+    h = _key_hash(handler_factories)
+    h.update(f"{flight.num_blocks}\n".encode())
+    _hash_flight_blocks(h, file, part_offset, Flight(flight.first_block, min(flight.num_blocks, SAMPLE_SECTORS),
+                                                     flight.timestamp))
+    return h.hexdigest()
+
+
+def _file_identity(file) -> str | None:
+    """ Device, inode, size and modification time of the file a flight is read from (through any wrappers
+    like MissionV2File), or None if it isn't a file on disk """
+    while file is not None:
+        try:
+            st = os.fstat(file.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            file = getattr(file, "file", None)
+            continue
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+    return None
+
+
+class _HashingReader:
+    """ Wraps a file while a flight is parsed from it, hashing the flight's bytes as they are read in order """
+
+    def __init__(self, file, part_offset: int, flight: Flight, h):
+        self.file = file
+        self.h = h
+        self.pos: int = file.tell()
+        # Next byte of the flight to hash, and the end of the flight
+        self.next: int = (part_offset + flight.first_block) * 512
+        self.end: int = self.next + flight.num_blocks * 512
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = self.file.seek(offset, whence)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if self.pos == self.next and self.pos < self.end:
+            part = data[:self.end - self.pos]
+            self.h.update(part)
+            self.next += len(part)
+        self.pos += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def hexdigest(self) -> str:
+        """ Hash of the whole flight, reading whatever the parse didn't read in order """
+        self.file.seek(self.next)
+        while self.next < self.end:
+            data = self.file.read(min(self.end - self.next, HASH_READ_SIZE))
+            if len(data) == 0:
+                break
+            self.h.update(data)
+            self.next += len(data)
+        return self.h.hexdigest()
+
+
+def _link_tree(src: Path, dst: Path):
+    """ Recreates a directory tree with every file hard linked, or copied if it can't be linked """
+    dst.mkdir(parents=True, exist_ok=True)
+    for path in src.iterdir():
+        target = dst.joinpath(path.name)
+        if path.is_dir():
+            _link_tree(path, target)
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copy2(path, target)
+
+
+def _tree_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+class ParseCache:
+    def __init__(self, path: Path = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+        self.path: Path = path
+        self.max_size: int = max_size
+
+    def entry_path(self, key: str) -> Path:
+        return self.path.joinpath(key)
+
+    def entries(self) -> list[dict]:
+        """ Info about each entry in the cache, least recently used first """
+        entries = []
+        if not self.path.is_dir():
+            return entries
+        for path in self.path.iterdir():
+            try:
+                with open(path.joinpath("entry.json"), "r") as f:
+                    entry = json.load(f)
+                entry["last_used"] = path.joinpath("entry.json").stat().st_mtime
+            except (OSError, ValueError):
+                # Not an entry, or one that was never finished
+                continue
+            entry["key"] = path.name
+            entries.append(entry)
+        entries.sort(key=lambda e: e["last_used"])
+        return entries
+
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self.entries())
+
+    def _known_key_path(self, identity: str, part_offset: int, flight: Flight, handler_factories) -> Path:
+        h = _key_hash(handler_factories)
+        h.update(f"{identity}\n{part_offset}\n{flight.first_block}\n{flight.num_blocks}\n".encode())
+        return self.path.joinpath(KEYS_DIR, h.hexdigest())
+
+    def known_key(self, file, part_offset: int, flight: Flight, handler_factories) -> str | None:
+        """ Key of a flight remembered from an earlier parse of the same, unchanged, file, or None """
+        identity = _file_identity(file)
+        if identity is None:
+            return None
+        try:
+            return self._known_key_path(identity, part_offset, flight, handler_factories).read_text()
+        except OSError:
+            return None
+
+    def remember_key(self, file, part_offset: int, flight: Flight, handler_factories, key: str):
+        identity = _file_identity(file)
+        if identity is None:
+            return
+        path = self._known_key_path(identity, part_offset, flight, handler_factories)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(key)
+        tmp.replace(path)
+
+    def has_sample(self, sample: str) -> bool:
+        """ Whether any entry is of a flight with the given sample_key """
+        return any(entry.get("sample") == sample for entry in self.entries())
+
+    def restore(self, key: str, imagedir: Path, flight_num: int, flight: Flight) -> bool:
+        """ Links the cached outputs of a flight into its flight folder, returns False on a miss """
+        entry = self.entry_path(key)
+        if not entry.joinpath("entry.json").is_file():
+            return False
+
+        _link_tree(entry.joinpath("flight"), imagedir.joinpath(f"flight_{flight_num}"))
+        # The outputs are linked to the cache's, so a follow must never carry on appending to them
+        follow_state_path(imagedir, flight_num).unlink(missing_ok=True)
+        shutil.copyfile(entry.joinpath("time_index.json"), index_path(imagedir, flight_num))
+        # The same blocks may be at a different place in this image, so the summary gets this flight's entry
+        with open(entry.joinpath("summary.json"), "r") as f:
+            summary = json.load(f)
+        summary["flight"] = flight_dict(flight)
+        write_summary(imagedir, flight_num, summary)
+
+        os.utime(entry.joinpath("entry.json"))
+        return True
+
+    def store(self, key: str, imagedir: Path, flight_num: int, sample: str = None):
+        """ Adds the outputs of a parsed flight (with the given sample_key) to the cache, then evicts entries
+        if it is too large """
+        entry = self.entry_path(key)
+        if entry.exists():
+            return
+
+        # Build the entry to the side so a partly written one is never used, named after this process since
+        # several may be storing the same flight at once
+        tmp = self.path.joinpath(f"{key}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        _link_tree(imagedir.joinpath(f"flight_{flight_num}"), tmp.joinpath("flight"))
+        shutil.copyfile(index_path(imagedir, flight_num), tmp.joinpath("time_index.json"))
+        shutil.copyfile(summary_path(imagedir, flight_num), tmp.joinpath("summary.json"))
+        with open(tmp.joinpath("entry.json"), "w") as f:
+            json.dump({"size": _tree_size(tmp), "created": time.time(), "parser_version": PARSER_VERSION,
+                       "source": str(imagedir.joinpath(f"flight_{flight_num}")), "sample": sample}, f)
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # Another process stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not entry.exists():
+                raise
+            return
+
+        self.prune(self.max_size, keep=key)
+
+    def prune(self, max_size: int, keep: str = None) -> int:
+        """ Removes the least recently used entries (apart from keep) until the cache is at most max_size
+        bytes, returns the number of entries removed """
+        entries = self.entries()
+        total = sum(entry["size"] for entry in entries)
+        removed = 0
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry["key"] == keep:
+                continue
+            shutil.rmtree(self.entry_path(entry["key"]), ignore_errors=True)
+            total -= entry["size"]
+            removed += 1
+
+        # Forget the keys of flights whose entries are gone
+        keys_dir = self.path.joinpath(KEYS_DIR)
+        if removed != 0 and keys_dir.is_dir():
+            for path in keys_dir.iterdir():
+                try:
+                    if not self.entry_path(path.read_text()).exists():
+                        path.unlink()
+                except OSError:
+                    pass
+        return removed
+
+
+def parse_flight_cached(cache: ParseCache, file, imagedir: Path, part_offset, flight_num, flight: Flight,
+                        handler_factories, progress=None, memory=None):
+    """ Parses a flight like parse_flight, reusing cached outputs if the same flight has been parsed with
+    the same handlers before. A flight folder made by an earlier cached parse is kept if it is up to date,
+    and parsed again if it was made from different blocks or with different handlers. Other flight folders
+    are kept as they are. """
+    key = cache.known_key(file, part_offset, flight, handler_factories)
+    flightdir = imagedir.joinpath(f"flight_{flight_num}")
+
+    if flightdir.exists():
+        summary = read_summary(imagedir, flight_num)
+        if summary is None or "cache_key" not in summary:
+            print(f"Flight {flight_num} has already been parsed. Not parsing again.")
+            return
+        if key is None:
+            key = flight_key(file, part_offset, flight, handler_factories)
+            cache.remember_key(file, part_offset, flight, handler_factories, key)
+        if summary["cache_key"] == key and summary.get("flight") == flight_dict(flight):
+            print(f"Flight {flight_num} has already been parsed and is up to date.")
+            return
+        print(f"Flight {flight_num} was parsed from different data or with different options, parsing again.")
+        shutil.rmtree(flightdir)
+        follow_state_path(imagedir, flight_num).unlink(missing_ok=True)
+
+    sample = sample_key(file, part_offset, flight, handler_factories)
+    if key is None and cache.has_sample(sample):
+        # Probably cached from another copy of the flight
+        key = flight_key(file, part_offset, flight, handler_factories)
+        cache.remember_key(file, part_offset, flight, handler_factories, key)
+    if key is not None and cache.restore(key, imagedir, flight_num, flight):
+        print(f"############### Flight {flight_num} ###############")
+        print(f"Restored from cache, output to {flightdir}.")
+        return
+
+    reader = None
+    if key is None:
+        reader = _HashingReader(file, part_offset, flight, _key_hash(handler_factories))
+    parse_flight(reader or file, imagedir, part_offset, flight_num, flight, handler_factories=handler_factories,
+                 progress=progress, memory=memory)
+    if reader is not None:
+        key = reader.hexdigest()
+        cache.remember_key(file, part_offset, flight, handler_factories, key)
+    summary = read_summary(imagedir, flight_num)
+    if summary is None:
+        return
+    summary["cache_key"] = key
+    write_summary(imagedir, flight_num, summary)
+    cache.store(key, imagedir, flight_num, sample)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Inspect or prune the cache of parsed flights.")
+    arg_parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR, help="cache directory (default: ./cache)")
+    subparsers = arg_parser.add_subparsers(dest="command")
+    subparsers.add_parser("info", help="list the cached flights (the default)")
+    prune_parser = subparsers.add_parser("prune", help="remove the least recently used flights")
+    prune_parser.add_argument("max_size", type=float, help="size in MB to prune the cache down to (0 to clear)")
+    args = arg_parser.parse_args()
+
+    cache = ParseCache(args.cache_dir)
+    if args.command == "prune":
+        removed = cache.prune(int(args.max_size * 1024 ** 2))
+        print(f"Removed {removed} entr{'ies' if removed != 1 else 'y'}, cache is now {cache.size() / 1024 ** 2:.1f} MB.")
+    else:
+        entries = cache.entries()
+        for entry in reversed(entries):
+            last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"]))
+            print(f"{entry['key'][:16]}  {entry['size'] / 1024 ** 2:9.1f} MB  last used {last_used}  "
+                  f"from {entry['source']}")
+        print(f"{len(entries)} entr{'ies' if len(entries) != 1 else 'y'}, "
+              f"{sum(e['size'] for e in entries) / 1024 ** 2:.1f} MB in {cache.path}")
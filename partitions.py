@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+# SD card images with more than one CU InSpace partition, where a flight that fills up one partition
+# carries on in the next.
+#
+# Each CU InSpace partition in the MBR has its own superblock. When logging runs out of room in a
+# partition it carries on in the next one, whose superblock has the continued flag set: its first flight is
+# the rest of the last flight of the partition before it. StitchedImage reads such an image as if it were a
+# version 1 mission file, whose superblock lists the flights of every partition with each continued flight
+# joined to the one it continues. A flight's sectors are mapped onto the partitions they are in rather
+# than copied, so the parser and the other tools handle a stitched flight like any other. The partitions'
+# superblocks are read in parallel, each by its own thread and file handle.
+#
+#   python3 partitions.py full
+
+import argparse
+import io
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+from mbr import MBR
+from mission_v2 import open_mission
+from superblock import CUINSPACE_PARTITION_TYPE, MAX_FLIGHTS, SuperBlock, Flight
+
+
+class Partition:
+    def __init__(self, number: int, first_sector: int, num_sectors: int, superblock: SuperBlock = None):
+        self.number: int = number
+        # Sector of the partition's superblock in the image
+        self.first_sector: int = first_sector
+        self.num_sectors: int = num_sectors
+        # None if the partition's superblock isn't valid
+        self.superblock: SuperBlock = superblock
+
+
+class StitchedFlight:
+    """ A flight made of one or more flights in consecutive partitions """
+
+    def __init__(self, timestamp: int):
+        self.timestamp: int = timestamp
+        # (sector in the image, number of sectors) of each part of the flight
+        self.extents: list[tuple[int, int]] = []
+        # (partition number, flight number in the partition) of each part
+        self.parts: list[tuple[int, int]] = []
+
+    @property
+    def num_blocks(self) -> int:
+        return sum(num_sectors for _, num_sectors in self.extents)
+
+    def add(self, partition: Partition, flight_num: int, flight: Flight):
+        self.extents.append((partition.first_sector + flight.first_block, flight.num_blocks))
+        self.parts.append((partition.number, flight_num))
+
+
+def find_partitions(file) -> list:
+    """ The CU InSpace partitions in an image's MBR, in the order they are on the card (empty if the file has
+    no MBR) """
+    file.seek(0)
+    try:
+        mbr = MBR(file.read(512))
+    except ValueError:
+        return []
+    return sorted((part for part in mbr.partitions if part.type == CUINSPACE_PARTITION_TYPE),
+                  key=lambda part: part.first_sector_lba)
+
+
+def _read_partition(path, number: int, first_sector: int, num_sectors: int) -> Partition:
+    with open(path, "rb") as file:
+        file.seek(first_sector * 512)
+        try:
+            superblock = SuperBlock.from_bytes(file.read(512))
+        except ValueError:
+            superblock = None
+    return Partition(number, first_sector, num_sectors, superblock)
+
+
+def read_partitions(path, jobs: int = None) -> list[Partition]:
+    """ The CU InSpace partitions of an image with their superblocks, read in parallel """
+    with open(path, "rb") as file:
+        mbr_partitions = find_partitions(file)
+    with ThreadPoolExecutor(jobs or max(len(mbr_partitions), 1)) as executor:
+        return list(executor.map(lambda p: _read_partition(path, p[0], p[1].first_sector_lba, p[1].num_sectors),
+                                 enumerate(mbr_partitions)))
+
+
+def stitch_flights(partitions: list[Partition]) -> list[StitchedFlight]:
+    """ The flights of every partition, the first flight of a continued partition joined to the last flight
+    of the partition before it """
+    flights = []
+    # Whether the last flight can be continued, i.e. it was the last flight of the partition just before
+    open_flight = False
+    for partition in partitions:
+        if partition.superblock is None:
+            print(f"Partition {partition.number} at sector {partition.first_sector} has no valid superblock.")
+            open_flight = False
+            continue
+        for i, flight in enumerate(partition.superblock.flights):
+            if i == 0 and partition.superblock.continued:
+                if open_flight:
+                    flights[-1].add(partition, i, flight)
+                    continue
+                print(f"Partition {partition.number} continues a flight from a partition that isn't there, "
+                      f"its first flight is kept on its own.")
+            flights.append(StitchedFlight(flight.timestamp))
+            flights[-1].add(partition, i, flight)
+        open_flight = len(partition.superblock.flights) != 0
+    return flights
+
+
+class StitchedImage(io.RawIOBase):
+    """ Reads an image with several CU InSpace partitions as a version 1 mission file of its stitched
+    flights: a superblock in sector 0 followed by each flight's sectors, read from wherever they are in
+    the image """
+
+    def __init__(self, path, buffer_size: int = -1, jobs: int = None):
+        super().__init__()
+        self.partitions: list[Partition] = read_partitions(path, jobs)
+        self.flights: list[StitchedFlight] = stitch_flights(self.partitions)
+        if len(self.flights) > MAX_FLIGHTS:
+            raise ValueError(f"{len(self.flights)} flights after stitching, more than a superblock can list")
+
+        first = next((p.superblock for p in self.partitions if p.superblock is not None), None)
+        # Start of each mapped range in the stitched file, and (start in the image, bytes) of each
+        self._starts: list[int] = []
+        self._ranges: list[tuple[int, int]] = []
+        superblock_flights = []
+        sector = 1
+        for flight in self.flights:
+            superblock_flights.append(Flight(sector, flight.num_blocks, flight.timestamp))
+            for image_sector, num_sectors in flight.extents:
+                self._starts.append(sector * 512)
+                self._ranges.append((image_sector * 512, num_sectors * 512))
+                sector += num_sectors
+        self.superblock = SuperBlock(first.version if first is not None else 1, False, sector,
+                                     superblock_flights).to_bytes()
+        self.size: int = sector * 512
+
+        self.file = open(path, "rb", buffering=buffer_size)
+        self.pos: int = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.pos = offset
+        return self.pos
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        """ Reads up to size bytes at a position, stopping at the end of the superblock or a mapped range """
+        if pos < 512:
+            return bytes(self.superblock[pos:pos + size])
+
+        i = bisect_right(self._starts, pos) - 1
+        image_start, length = self._ranges[i]
+        start = pos - self._starts[i]
+        self.file.seek(image_start + start)
+        data = self.file.read(min(size, length - start))
+        # Past the end of a truncated image, read as zeros
+        return data if len(data) != 0 else bytes(min(size, length - start))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        parts = []
+        while size > 0 and self.pos < self.size:
+            data = self._read_at(self.pos, min(size, self.size - self.pos))
+            parts.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_image(path, buffer_size: int = -1):
+    """ Opens an SD card image or mission file like open_mission, stitching its flights together if it has
+    more than one CU InSpace partition """
+    with open(path, "rb") as file:
+        num_partitions = len(find_partitions(file))
+    if num_partitions > 1:
+        return StitchedImage(path, buffer_size)
+    return open_mission(path, buffer_size)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="List the CU InSpace partitions of an SD card image and the "
+                                                     "flights stitched across them.")
+    arg_parser.add_argument("infile", help="SD card image")
+    arg_parser.add_argument("--jobs", type=int, help="partitions read at once (default: all of them)")
+    args = arg_parser.parse_args()
+
+    partitions = read_partitions(args.infile, args.jobs)
+    if len(partitions) == 0:
+        exit(f"No CU InSpace partitions found in {args.infile}")
+    for partition in partitions:
+        sb = partition.superblock
+        if sb is None:
+            print(f"Partition {partition.number}: sector {partition.first_sector}, {partition.num_sectors} sectors, "
+                  f"no valid superblock")
+            continue
+        print(f"Partition {partition.number}: sector {partition.first_sector}, {partition.num_sectors} sectors, "
+              f"{len(sb.flights)} flight{'s' if len(sb.flights) != 1 else ''}"
+              f"{', continued from the partition before' if sb.continued else ''}")
+    print()
+    for i, flight in enumerate(stitch_flights(partitions)):
+        parts = ", ".join(f"partition {p} flight {f}" for p, f in flight.parts)
+        print(f"Flight {i} -> length: {flight.num_blocks}, time: {flight.timestamp}, from {parts}")
@@ -0,0 +1,109 @@
+# Counters and timers for finding where the time goes when parsing a flight.
+#
+# parse_flight takes an optional Profiler and, when given one, times reading blocks, decoding them (in
+# total and for each block type) and each handler's batches, counting the bytes, blocks and samples that
+# went through each. Without a Profiler the only cost is checking for one. For function level detail,
+# cprofile_call runs a parse under cProfile and saves a pstats file.
+
+import json
+from pathlib import Path
+from time import perf_counter
+
+# Per stage and per block type totals: calls, seconds, bytes, blocks, samples
+FIELDS = ("calls", "seconds", "bytes", "blocks", "samples")
+
+
+def block_samples(block) -> int:
+    """ Number of sensor samples in a decoded block, 1 for single sample telemetry and 0 for others """
+    data = getattr(block, "data", None)
+    if data is None:
+        return 0
+    samples = getattr(data, "samples", None)
+    return len(samples) if samples is not None else 1
+
+
+class Profiler:
+    def __init__(self):
+        self.stages: dict[str, list] = dict()
+        self.block_types: dict[str, list] = dict()
+        self.wall: float = 0.0
+
+    @staticmethod
+    def _add(totals: dict, name: str, seconds: float, nbytes: int, blocks: int, samples: int):
+        t = totals.get(name)
+        if t is None:
+            t = totals[name] = [0, 0.0, 0, 0, 0]
+        t[0] += 1
+        t[1] += seconds
+        t[2] += nbytes
+        t[3] += blocks
+        t[4] += samples
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0, blocks: int = 0, samples: int = 0):
+        self._add(self.stages, stage, seconds, nbytes, blocks, samples)
+
+    def add_block_type(self, name: str, seconds: float, nbytes: int = 0, samples: int = 0):
+        self._add(self.block_types, name, seconds, nbytes, 1, samples)
+
+    def time_iter(self, stage: str, iterable):
+        """ Passes on the items of an iterable of raw blocks, timing how long each takes to get """
+        it = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(stage, perf_counter() - start)
+                return
+            self.add(stage, perf_counter() - start, len(item), 1)
+            yield item
+
+    def merge(self, other: "Profiler"):
+        for totals, other_totals in ((self.stages, other.stages), (self.block_types, other.block_types)):
+            for name, values in other_totals.items():
+                t = totals.setdefault(name, [0, 0.0, 0, 0, 0])
+                for i, v in enumerate(values):
+                    t[i] += v
+        self.wall += other.wall
+
+    def report(self) -> dict:
+        """ Totals as a dict, with the time not spent in any stage as the "other" stage """
+        stages = dict((name, dict(zip(FIELDS, values))) for name, values in self.stages.items())
+        stages["other"] = {"calls": 0, "seconds": max(self.wall - sum(v[1] for v in self.stages.values()), 0.0),
+                           "bytes": 0, "blocks": 0, "samples": 0}
+        return {"wall_seconds": self.wall, "stages": stages,
+                "block_types": dict((name, dict(zip(FIELDS, values))) for name, values in self.block_types.items())}
+
+    def format(self) -> str:
+        """ Human readable table of the totals """
+        report = self.report()
+        wall = report["wall_seconds"] or 1e-12
+        lines = [f"Total: {report['wall_seconds']:.3f} s"]
+        for title, totals in (("Stage", report["stages"]), ("Decode by block type", report["block_types"])):
+            lines.append(f"{title:<40} {'seconds':>9} {'%':>6} {'blocks':>9} {'MB':>8} {'MB/s':>8} {'samples':>9}")
+            for name, t in sorted(totals.items(), key=lambda item: -item[1]["seconds"]):
+                rate = t["bytes"] / 1e6 / t["seconds"] if t["seconds"] > 0 else 0
+                lines.append(f"{name:<40} {t['seconds']:9.3f} {100 * t['seconds'] / wall:6.1f} {t['blocks']:9} "
+                             f"{t['bytes'] / 1e6:8.2f} {rate:8.1f} {t['samples']:9}")
+        return "\n".join(lines)
+
+
+def write_profile(path: Path, profiles: dict):
+    """ Saves {flight number: Profiler} and their total as JSON """
+    total = Profiler()
+    for profiler in profiles.values():
+        total.merge(profiler)
+    with open(path, "w") as f:
+        json.dump({"flights": dict((str(n), p.report()) for n, p in profiles.items()), "total": total.report()},
+                  f, indent=2)
+
+
+def cprofile_call(path: Path, func, *args, **kwargs):
+    """ Calls a function under cProfile, saving its stats to a pstats file """
+    import cProfile
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(path)
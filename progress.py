@@ -0,0 +1,119 @@
+# Progress and throughput reporting for long parses.
+#
+# Work is counted by ProgressCounters, one for each thread or shard doing the work (a serial parse has
+# one), which only add to their own totals. A counter checks the clock as it goes and, at most once every
+# interval seconds, the Progress it belongs to sums every counter and reports the totals: a status line
+# for people and, if asked for, a JSON line per report for job schedulers.
+
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+# Default seconds between reports
+REPORT_INTERVAL = 1.0
+
+
+class ProgressCounter:
+    def __init__(self, progress: "Progress"):
+        self.progress: Progress = progress
+        self.bytes: int = 0
+        # Bytes skipped rather than read, which don't count towards the rate
+        self.skipped: int = 0
+        self.blocks: int = 0
+        self.samples: Counter = Counter()
+
+    def add(self, nbytes: int, blocks: int = 1):
+        """ Counts blocks read, reporting if it is time to """
+        self.bytes += nbytes
+        self.blocks += blocks
+        if time.monotonic() >= self.progress.next_report:
+            self.progress.report()
+
+    def add_samples(self, sensor: str, samples: int):
+        if samples != 0:
+            self.samples[sensor] += samples
+
+
+class Progress:
+    """ Progress of reading total_bytes bytes, reported to out (if not None) as a status line and to
+    json_out (if not None) as JSON lines """
+
+    def __init__(self, total_bytes: int, label: str = "", interval: float = REPORT_INTERVAL, out=sys.stderr,
+                 json_out=None):
+        self.total_bytes: int = total_bytes
+        self.label: str = label
+        self.interval: float = interval
+        self.out = out
+        self.json_out = json_out
+        self.counters: list[ProgressCounter] = []
+        self.start: float = time.monotonic()
+        self.next_report: float = self.start + interval
+        self._lock = threading.Lock()
+        # Status lines are redrawn in place on a terminal
+        self._tty = out is not None and hasattr(out, "isatty") and out.isatty()
+
+    def counter(self, initial_bytes: int = 0) -> ProgressCounter:
+        """ A new counter for a thread or shard, starting from bytes that were skipped rather than read """
+        counter = ProgressCounter(self)
+        counter.bytes = initial_bytes
+        counter.skipped = initial_bytes
+        with self._lock:
+            self.counters.append(counter)
+        return counter
+
+    def totals(self) -> dict:
+        now = time.monotonic()
+        elapsed = max(now - self.start, 1e-9)
+        nbytes = sum(c.bytes for c in self.counters)
+        blocks = sum(c.blocks for c in self.counters)
+        samples = Counter()
+        for c in self.counters:
+            samples.update(c.samples)
+        rate = (nbytes - sum(c.skipped for c in self.counters)) / elapsed
+        return {
+            "label": self.label,
+            "elapsed": elapsed,
+            "bytes": nbytes,
+            "total_bytes": self.total_bytes,
+            "fraction": nbytes / self.total_bytes if self.total_bytes else 1.0,
+            "blocks": blocks,
+            "blocks_per_s": blocks / elapsed,
+            "mb_per_s": rate / 1e6,
+            "samples_per_s": dict((sensor, n / elapsed) for sensor, n in samples.items()),
+            "eta": (self.total_bytes - nbytes) / rate if rate > 0 else None,
+        }
+
+    def report(self, final: bool = False):
+        # Only one thread reports at a time, the others carry on
+        if not self._lock.acquire(blocking=final):
+            return
+        try:
+            if not final and time.monotonic() < self.next_report:
+                return
+            totals = self.totals()
+            totals["done"] = final
+            if self.out is not None:
+                self._write_status(totals, final)
+            if self.json_out is not None:
+                self.json_out.write(json.dumps(totals) + "\n")
+                self.json_out.flush()
+            self.next_report = time.monotonic() + self.interval
+        finally:
+            self._lock.release()
+
+    def _write_status(self, t: dict, final: bool):
+        eta = f", ETA {t['eta']:.0f} s" if t["eta"] is not None and not final else ""
+        line = (f"{self.label + ': ' if self.label else ''}{100 * t['fraction']:5.1f}% "
+                f"{t['bytes'] / 1e6:.1f}/{t['total_bytes'] / 1e6:.1f} MB, {t['blocks_per_s']:.0f} blocks/s, "
+                f"{t['mb_per_s']:.2f} MB/s, {sum(t['samples_per_s'].values()):.0f} samples/s{eta}")
+        if self._tty:
+            self.out.write("\r\x1b[K" + line + ("\n" if final else ""))
+        else:
+            self.out.write(line + "\n")
+        self.out.flush()
+
+    def close(self):
+        """ Reports the final totals """
+        self.report(final=True)
@@ -0,0 +1,211 @@
+# Multi-resolution min/max/mean pyramids of high rate sensor streams, for zooming from a whole flight
+# down to single samples.
+#
+# Level 0 of a pyramid holds every sample, each level above it holds the min, max and mean of each
+# column over PYRAMID_FACTOR records of the level below. Each level is a file of fixed size records, so
+# a query can start at the small top level and read only the records covering a time range at each
+# level on the way down to the one with enough resolution for the requested width.
+
+import json
+from pathlib import Path
+
+from data_block import KX134AccelerometerDataBlock, MPU9250IMUDataBlock
+from handlers import BlockHandler
+from timeline import STREAM_FIELDS, gen_block_samples
+
+# Number of records of a level that are combined into one record of the level above it
+PYRAMID_FACTOR = 8
+# Most levels a pyramid is expected to have (enough for 8 ** 12 samples), used to bound its memory
+MAX_LEVELS = 12
+# Buffer size of each level's file
+LEVEL_BUFFER_BYTES = 8192
+
+
+def level_dtype(level: int, num_columns: int):
+    import numpy as np
+
+    if level == 0:
+        return np.dtype([("t", "<f8"), ("value", "<f4", (num_columns,))])
+    return np.dtype([("t_start", "<f8"), ("t_end", "<f8"), ("count", "<u4"), ("min", "<f4", (num_columns,)),
+                     ("max", "<f4", (num_columns,)), ("mean", "<f4", (num_columns,))])
+
+
+def _combine(records, level: int, factor: int):
+    """ Combines groups of factor records of a level (the last group may be smaller) into records of the
+    level above it """
+    import numpy as np
+
+    num_columns = records.dtype["value" if level == 0 else "min"].shape[0]
+    starts = np.arange(0, len(records), factor)
+    out = np.empty(len(starts), dtype=level_dtype(level + 1, num_columns))
+    ends = np.append(starts[1:], len(records)) - 1
+
+    if level == 0:
+        out["t_start"] = records["t"][starts]
+        out["t_end"] = records["t"][ends]
+        out["count"] = np.diff(np.append(starts, len(records)))
+        out["min"] = np.minimum.reduceat(records["value"], starts, axis=0)
+        out["max"] = np.maximum.reduceat(records["value"], starts, axis=0)
+        out["mean"] = np.add.reduceat(records["value"].astype(np.float64), starts, axis=0) / out["count"][:, None]
+    else:
+        counts = records["count"].astype(np.float64)
+        out["t_start"] = records["t_start"][starts]
+        out["t_end"] = records["t_end"][ends]
+        out["count"] = np.add.reduceat(records["count"], starts)
+        out["min"] = np.minimum.reduceat(records["min"], starts, axis=0)
+        out["max"] = np.maximum.reduceat(records["max"], starts, axis=0)
+        out["mean"] = (np.add.reduceat(records["mean"] * counts[:, None], starts, axis=0) /
+                       out["count"][:, None])
+    return out
+
+
+class PyramidBuilder:
+    """ Builds the pyramid of one stream in a directory from chunks of samples in time order """
+
+    def __init__(self, path: Path, columns: tuple, factor: int = PYRAMID_FACTOR):
+        self.path: Path = path
+        self.columns: tuple = columns
+        self.factor: int = factor
+        self.files = []
+        # Records of each level not yet combined into the level above
+        self.carry = []
+        self.counts = []
+        self.first_time = None
+        self.last_time = None
+
+    def _append(self, level: int, records):
+        import numpy as np
+
+        if level == len(self.files):
+            self.files.append(open(self.path.joinpath(f"level_{level}.bin"), "wb", buffering=LEVEL_BUFFER_BYTES))
+            self.carry.append(np.empty(0, dtype=records.dtype))
+            self.counts.append(0)
+        self.files[level].write(records.tobytes())
+        self.counts[level] += len(records)
+
+        # Combine every full group of records into the level above
+        carry = np.concatenate((self.carry[level], records))
+        full = (len(carry) // self.factor) * self.factor
+        self.carry[level] = carry[full:]
+        if full != 0:
+            self._append(level + 1, _combine(carry[:full], level, self.factor))
+
+    def push(self, t, values):
+        """ Adds a chunk of samples, t has a time (ms) per sample and values a row per sample """
+        import numpy as np
+
+        if len(t) == 0:
+            return
+        records = np.empty(len(t), dtype=level_dtype(0, len(self.columns)))
+        records["t"] = t
+        records["value"] = values
+        if self.first_time is None:
+            self.first_time = float(records["t"][0])
+        self.last_time = float(records["t"][-1])
+        self._append(0, records)
+
+    def close(self):
+        """ Combines what is left of each level until the top level has a single record """
+        level = 0
+        while level < len(self.files) and self.counts[level] > 1:
+            if len(self.carry[level]) != 0:
+                carry, self.carry[level] = self.carry[level], self.carry[level][:0]
+                self._append(level + 1, _combine(carry, level, self.factor))
+            level += 1
+
+        for f in self.files:
+            f.close()
+        with open(self.path.joinpath("meta.json"), "w") as f:
+            json.dump({"columns": list(self.columns), "factor": self.factor, "counts": self.counts,
+                       "first_time": self.first_time, "last_time": self.last_time}, f)
+
+
+def _read_records(path: Path, level: int, dtype, start: int, stop: int):
+    import numpy as np
+
+    with open(path.joinpath(f"level_{level}.bin"), "rb") as f:
+        f.seek(start * dtype.itemsize)
+        return np.frombuffer(f.read((stop - start) * dtype.itemsize), dtype=dtype)
+
+
+def query_pyramid(path: Path, t0: float, t1: float, width: int):
+    """ Returns (level, records) for the records of a stream's pyramid between mission times t0 and t1
+    (ms), from the coarsest level that still has at least width records in that range (level 0 holds
+    the samples themselves). Only the records covering the range are read from each level. """
+    import numpy as np
+
+    with open(path.joinpath("meta.json"), "r") as f:
+        meta = json.load(f)
+    counts = meta["counts"]
+    factor = meta["factor"]
+    num_columns = len(meta["columns"])
+    if len(counts) == 0 or counts[0] == 0:
+        return 0, np.empty(0, dtype=level_dtype(0, num_columns))
+
+    # Pick the level from the average sample rate, so no reads are needed to do so
+    duration = max(meta["last_time"] - meta["first_time"], 1e-9)
+    estimate = counts[0] * (min(t1, meta["last_time"]) - max(t0, meta["first_time"])) / duration
+    target = 0
+    while target + 1 < len(counts) and estimate / (factor ** (target + 1)) >= width:
+        target += 1
+
+    # Walk down from the top level, narrowing the range of records to read at each level
+    top = len(counts) - 1
+    start, stop = 0, counts[top]
+    for level in range(top, target - 1, -1):
+        dtype = level_dtype(level, num_columns)
+        records = _read_records(path, level, dtype, start, stop)
+        t_start = records["t"] if level == 0 else records["t_start"]
+        t_end = records["t"] if level == 0 else records["t_end"]
+        first = start + int(np.searchsorted(t_end, t0, side="left"))
+        last = start + int(np.searchsorted(t_start, t1, side="right"))
+        if level == target:
+            return level, records[first - start:last - start]
+        start, stop = first * factor, max(first * factor, min(last * factor, counts[level - 1]))
+
+
+class PyramidHandler(BlockHandler):
+    """ Builds the pyramid of a sensor stream in the flight's pyramid directory """
+
+    stream: str = None
+
+    def __init__(self):
+        self.builder = None
+
+    def state_bytes(self) -> int:
+        # Each level's file buffer and the records carried to be combined into the level above it
+        num_columns = len(STREAM_FIELDS[self.stream])
+        record_bytes = 32 + 12 * num_columns
+        return MAX_LEVELS * (LEVEL_BUFFER_BYTES + 2 * PYRAMID_FACTOR * record_bytes)
+
+    def open(self, flightdir: Path):
+        path = flightdir.joinpath("pyramid", self.stream)
+        path.mkdir(parents=True, exist_ok=True)
+        self.builder = PyramidBuilder(path, STREAM_FIELDS[self.stream])
+
+    def consume_batch(self, blocks):
+        times = []
+        values = []
+        for block in blocks:
+            for time, _, v in gen_block_samples(block):
+                times.append(time)
+                values.append(v)
+        self.builder.push(times, values)
+
+    def close(self):
+        self.builder.close()
+
+
+class KX134PyramidHandler(PyramidHandler):
+    """ KX134AccelerometerDataBlock """
+    block_types = (KX134AccelerometerDataBlock,)
+    stream = "kx134_accelerometer"
+
+
+class MPU9250PyramidHandler(PyramidHandler):
+    """ MPU9250IMUDataBlock """
+    block_types = (MPU9250IMUDataBlock,)
+    stream = "mpu9250_imu"
+
+
+PYRAMID_HANDLERS = [KX134PyramidHandler, MPU9250PyramidHandler]
@@ -0,0 +1,136 @@
+# Decoding of the radio packets logged in diagnostic radio packet blocks.
+#
+# A packet is a 12 byte header followed by radio blocks:
+#  - packet header: the callsign (6 ASCII bytes), a little endian 16 bit field holding the packet's length
+#    in 4 byte words (bits 0-5), the format version (bits 6-10) and the source address (bits 11-14), and a
+#    little endian 32 bit packet number
+#  - block header: a little endian 32 bit field holding the block's length (including its header) in 4 byte
+#    words minus 1 (bits 0-4), whether a signal report follows (bit 5), the RadioBlockType (bits 6-9), the
+#    subtype (bits 10-15, a ControlBlockSubtype, CommandBlockSubtype or DataBlockSubtype) and the
+#    destination DeviceAddress (bits 16-19)
+# Data block payloads are laid out like telemetry data blocks on the SD card and are decoded by
+# DataBlock.parse.
+#
+# Packets are decoded a batch at a time. The headers of a batch are unpacked together, with NumPy when it
+# is installed (imported the first time a batch is unpacked), and then each packet's blocks are walked.
+
+import struct
+from enum import IntEnum
+
+from block import (BlockException, DeviceAddress, RadioBlockType, ControlBlockSubtype, CommandBlockSubtype,
+                   DataBlockSubtype)
+from data_block import DataBlock
+
+PACKET_HEADER = struct.Struct("<6sHI")
+BLOCK_HEADER = struct.Struct("<I")
+
+# Subtype enum of each radio block type
+SUBTYPES = {
+    RadioBlockType.CONTROL: ControlBlockSubtype,
+    RadioBlockType.COMMAND: CommandBlockSubtype,
+    RadioBlockType.DATA: DataBlockSubtype,
+}
+
+# NumPy once the first batch of headers has been unpacked, False if it isn't installed
+_numpy = None
+
+
+def _enum_name(enum: type[IntEnum], value: int) -> str:
+    try:
+        return enum(value).name.lower()
+    except ValueError:
+        return f"unknown_{value}"
+
+
+def device_name(address: int) -> str:
+    try:
+        return str(DeviceAddress(address))
+    except ValueError:
+        return "UNKNOWN"
+
+
+def _load_numpy():
+    """ NumPy, imported the first time it's needed, or False if it isn't installed """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def callsign(raw: bytes) -> str:
+    """ A packet's callsign from the bytes in its header, without the NUL or space padding after it """
+    return raw.rstrip(b"\0 ").decode("ascii", "replace")
+
+
+def unpack_packet_headers(headers: bytes) -> dict[str, list]:
+    """ Columns (callsign, length, version, source and packet_number) of packet headers packed one after
+    the other """
+    np = _load_numpy()
+    if not np:
+        rows = list(PACKET_HEADER.iter_unpack(headers))
+        return {
+            "callsign": [callsign(row[0]) for row in rows],
+            "length": [(row[1] & 0x3f) * 4 for row in rows],
+            "version": [(row[1] >> 6) & 0x1f for row in rows],
+            "source": [(row[1] >> 11) & 0xf for row in rows],
+            "packet_number": [row[2] for row in rows],
+        }
+
+    a = np.frombuffer(headers, dtype=np.dtype([("callsign", "S6"), ("fields", "<u2"), ("number", "<u4")]))
+    fields = a["fields"]
+    return {
+        # Trailing NULs are already dropped by the S6 dtype
+        "callsign": [callsign(c) for c in a["callsign"].tolist()],
+        "length": ((fields & 0x3f) * 4).tolist(),
+        "version": ((fields >> 6) & 0x1f).tolist(),
+        "source": ((fields >> 11) & 0xf).tolist(),
+        "packet_number": a["number"].tolist(),
+    }
+
+
+class RadioBlock:
+    def __init__(self, block_type: int, subtype: int, destination: int, signal_report: bool, payload: bytes):
+        self.block_type: int = block_type
+        self.subtype: int = subtype
+        self.destination: int = destination
+        self.signal_report: bool = signal_report
+        self.payload: bytes = payload
+        # Decoded payload of data blocks, or why it couldn't be decoded
+        self.data: DataBlock = None
+        self.error: str = None
+        if block_type == RadioBlockType.DATA:
+            try:
+                self.data = DataBlock.parse(subtype, payload)
+            except (BlockException, ValueError, struct.error) as e:
+                self.error = str(e)
+
+    @property
+    def type_name(self) -> str:
+        """ Name of the block's type and subtype, such as data_altitude or command_deploy_parachute """
+        type_name = _enum_name(RadioBlockType, self.block_type)
+        subtypes = SUBTYPES.get(self.block_type)
+        if subtypes is None:
+            return type_name
+        return f"{type_name}_{_enum_name(subtypes, self.subtype)}"
+
+    def __str__(self):
+        contents = self.data if self.data is not None else self.payload.hex()
+        return f"Radio block {self.type_name} to {device_name(self.destination)} -> {contents}"
+
+
+def gen_radio_blocks(blocks: bytes):
+    """ Generates the RadioBlocks in the bytes following a packet header, stopping at the first block that
+    runs past the end """
+    offset = 0
+    while offset + BLOCK_HEADER.size <= len(blocks):
+        head = BLOCK_HEADER.unpack_from(blocks, offset)[0]
+        length = ((head & 0x1f) + 1) * 4
+        if offset + length > len(blocks):
+            return
+        yield RadioBlock((head >> 6) & 0xf, (head >> 10) & 0x3f, (head >> 16) & 0xf, bool(head & 0x20),
+                         blocks[offset + BLOCK_HEADER.size:offset + length])
+        offset += length
@@ -0,0 +1,333 @@
+#! /usr/bin/env python3
+# Recovers the flight table of an SD card image (or a device) whose superblock is damaged, by scanning the
+# blocks on the card.
+#
+# The partition is swept in large chunks, each mapped with mmap. Only the first two words of each sector
+# are examined: a sector is unwritten if it is all zeros or all 0xFF, and otherwise the first word is
+# checked for a known block header and, for blocks that have one, the second is its mission time. With
+# NumPy this is done for a whole chunk at once. Flights are laid out one after the other, so a flight
+# starts at the beginning of a run of written sectors or where the mission time goes back to zero (with
+# RESET_MS of tolerance, as multi-sample blocks are logged after their samples were taken). A new flight
+# is taken to start at the sector after the last timestamped sector of the one before. The chain of
+# blocks at the start of each flight is then walked to check it is valid, moving the start forward a
+# sector at a time if it isn't. Runs without any timestamped blocks aren't flights.
+#
+# The recovered flights can be written to a new superblock (--output) or into the image itself (--write).
+# The time each flight was logged isn't recorded in the blocks, so flights are given the placeholder
+# timestamps --timestamp, --timestamp + 1 and so on.
+#
+#   python3 recovery.py full
+#   python3 recovery.py full --output sb.repaired
+
+import argparse
+import mmap
+import os
+import struct
+import time
+
+from mbr import MBR
+from misc.converter import mt_to_ms
+from sd_block import SDBlock, SDBlockClass
+from superblock import CUINSPACE_PARTITION_TYPE, MAX_FLIGHTS, SuperBlock, Flight
+
+# Bytes mapped and scanned at once
+SCAN_CHUNK_BYTES = 64 * 1024 * 1024
+# Mission times going back by more than this (ms) start a new flight
+RESET_MS = 1000
+# Blocks walked to check a flight's start
+CHAIN_CHECK_BLOCKS = 64
+
+ZERO_SECTOR = bytes(512)
+ERASED_SECTOR = b"\xff" * 512
+
+
+def _known_headers() -> bytearray:
+    """ Table of whether the low 16 bits of a header word (the block class and type) are a known block """
+    table = bytearray(1 << 16)
+    for block_class in SDBlockClass:
+        for block_type in range(1 << 10):
+            if SDBlock.lookup_class(block_class, block_type) is not None:
+                table[block_class | (block_type << 6)] = 1
+    return table
+
+
+KNOWN_HEADERS = _known_headers()
+
+
+class RecoveredFlight:
+    def __init__(self, first_sector: int, first_time: float = None):
+        self.first_sector: int = first_sector
+        self.end_sector: int = first_sector
+        # Mission times (ms) of the first and last timestamped sectors, and the last of those sectors
+        self.first_time: float = first_time
+        self.last_time: float = None
+        self.last_timed_sector: int = None
+
+    @property
+    def num_sectors(self) -> int:
+        return self.end_sector - self.first_sector
+
+
+class ChunkEvents:
+    """ What the flight builder needs from a chunk of sectors: where runs of written sectors start and end,
+    and timestamped sectors (sector, mission time in ms, whether the time went back) """
+
+    def __init__(self):
+        self.run_starts: list[int] = []
+        self.run_ends: list[int] = []
+        self.times: list[tuple[int, float, bool]] = []
+
+
+def _header_ok(header: int) -> bool:
+    length = header >> 16
+    return KNOWN_HEADERS[header & 0xffff] == 1 and length >= 4 and length % 4 == 0
+
+
+def scan_chunk_python(data, first_sector: int, written: bool, last_time: float) -> ChunkEvents:
+    """ Scans a chunk of whole sectors sector by sector, given whether the sector before it was written and
+    the last mission time before it (or None) """
+    events = ChunkEvents()
+    for i in range(len(data) // 512):
+        offset = i * 512
+        header, mission_time = struct.unpack_from("<II", data, offset)
+        sector_written = True
+        if header == 0 or header == 0xffffffff:
+            sector = data[offset:offset + 512]
+            sector_written = sector != ZERO_SECTOR and sector != ERASED_SECTOR
+        if sector_written != written:
+            (events.run_starts if sector_written else events.run_ends).append(first_sector + i)
+            written = sector_written
+        if not sector_written or not _header_ok(header) or header & 0x3f == SDBlockClass.LOGGING_METADATA \
+                or header >> 16 < 8:
+            continue
+        t = mt_to_ms(mission_time)
+        events.times.append((first_sector + i, t, last_time is not None and t < last_time - RESET_MS))
+        last_time = t
+    return events
+
+
+def scan_chunk_numpy(data, first_sector: int, written: bool, last_time: float) -> ChunkEvents:
+    """ Scans a chunk of whole sectors like scan_chunk_python, all sectors at once. Only the timestamped
+    sectors the flight builder needs are kept: the first and last of the chunk, those around a time going
+    back, and the first and last of each run of written sectors. """
+    import numpy as np
+
+    words = np.frombuffer(data, dtype="<u4").reshape(-1, 128)
+    headers = words[:, 0]
+    sector_written = np.ones(len(words), dtype=bool)
+    for fill in (0, 0xffffffff):
+        candidates = np.flatnonzero(headers == fill)
+        sector_written[candidates] = ~(words[candidates] == fill).all(axis=1)
+
+    change = np.diff(sector_written.astype(np.int8), prepend=np.int8(written))
+    events = ChunkEvents()
+    run_starts = np.flatnonzero(change == 1)
+    run_ends = np.flatnonzero(change == -1)
+    events.run_starts = (run_starts + first_sector).tolist()
+    events.run_ends = (run_ends + first_sector).tolist()
+
+    lengths = headers >> 16
+    timed = (sector_written & (np.frombuffer(KNOWN_HEADERS, dtype=np.uint8)[headers & 0xffff] == 1)
+             & (lengths >= 8) & (lengths % 4 == 0) & (headers & 0x3f != SDBlockClass.LOGGING_METADATA))
+    index = np.flatnonzero(timed)
+    if len(index) == 0:
+        return events
+    times = words[index, 1] * (1000 / 1024)
+    previous = np.empty_like(times)
+    previous[0] = last_time if last_time is not None else np.nan
+    previous[1:] = times[:-1]
+    resets = times < previous - RESET_MS
+
+    keep = resets.copy()
+    keep[:-1] |= resets[1:]
+    keep[0] = keep[-1] = True
+    after_starts = np.searchsorted(index, run_starts)
+    keep[after_starts[after_starts < len(index)]] = True
+    before_ends = np.searchsorted(index, run_ends) - 1
+    keep[before_ends[before_ends >= 0]] = True
+
+    kept = np.flatnonzero(keep)
+    events.times = list(zip((index[kept] + first_sector).tolist(), times[kept].tolist(), resets[kept].tolist()))
+    return events
+
+
+def check_chain(file, sector: int, end_sector: int, num_blocks: int = CHAIN_CHECK_BLOCKS) -> bool:
+    """ Whether a valid chain of blocks starts at a sector: num_blocks known blocks one after the other (or
+    as many as there are before end_sector) """
+    end = end_sector * 512
+    file.seek(sector * 512)
+    data = file.read(min(end - sector * 512, num_blocks * 1024))
+    offset = 0
+    for _ in range(num_blocks):
+        if offset + 4 > len(data) or sector * 512 + offset >= end:
+            return offset != 0
+        header = struct.unpack_from("<I", data, offset)[0]
+        if header == 0 and offset % 512 != 0:
+            # The rest of the sector is unwritten, the chain carries on in the next one
+            offset += 512 - offset % 512
+            continue
+        if not _header_ok(header):
+            return False
+        offset += header >> 16
+    return True
+
+
+def scan_partition(path, part_offset: int, end_sector: int = None, use_numpy: bool = None, progress=None):
+    """ Scans a partition from the sector after its superblock to end_sector (or the end of the file) and
+    returns the flights found in it, as RecoveredFlights. NumPy is used if it is installed, unless use_numpy
+    is False. progress is called with the number of sectors scanned after each chunk. """
+    if use_numpy is None:
+        try:
+            import numpy
+            use_numpy = True
+        except ImportError:
+            use_numpy = False
+    scan_chunk = scan_chunk_numpy if use_numpy else scan_chunk_python
+
+    flights: list[RecoveredFlight] = []
+    current: RecoveredFlight = None
+
+    def finish(end: int):
+        current.end_sector = end
+        if current.first_time is not None:
+            flights.append(current)
+
+    with open(path, "rb", buffering=0) as file:
+        size = file.seek(0, os.SEEK_END)
+        end = min(end_sector * 512, size) if end_sector is not None else size
+        end -= end % 512
+        start = (part_offset + 1) * 512
+        written = False
+        last_time = None
+
+        # Chunks start at multiples of the mmap granularity, which is a whole number of sectors
+        chunk_start = start - start % mmap.ALLOCATIONGRANULARITY
+        while chunk_start < end:
+            length = min(SCAN_CHUNK_BYTES, end - chunk_start)
+            with mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ, offset=chunk_start) as mapped:
+                skip = max(start - chunk_start, 0)
+                view = memoryview(mapped)[skip:]
+                try:
+                    events = scan_chunk(view, (chunk_start + skip) // 512, written, last_time)
+                finally:
+                    view.release()
+            chunk_start += length
+            if progress is not None:
+                progress((chunk_start - start) // 512)
+
+            ordered = sorted([(s, 0, None) for s in events.run_starts] + [(s, 2, None) for s in events.run_ends]
+                             + [(s, 1, (t, reset)) for s, t, reset in events.times])
+            for sector, kind, timed in ordered:
+                if kind == 0:
+                    current = RecoveredFlight(sector)
+                    written = True
+                elif kind == 2:
+                    finish(sector)
+                    current = None
+                    written = False
+                else:
+                    t, reset = timed
+                    if reset and current.last_timed_sector is not None:
+                        boundary = current.last_timed_sector + 1
+                        finish(boundary)
+                        current = RecoveredFlight(boundary)
+                    if current.first_time is None:
+                        current.first_time = t
+                    current.last_time = t
+                    current.last_timed_sector = sector
+                    last_time = t
+        if current is not None:
+            finish(end // 512)
+
+        # Move the start of flights that don't start with a valid chain of blocks forward
+        for i, flight in enumerate(flights):
+            start = flight.first_sector
+            while flight.first_sector < flight.end_sector and not check_chain(file, flight.first_sector,
+                                                                              flight.end_sector):
+                flight.first_sector += 1
+            # A flight split from the one before it at a time reset starts where that one ends, so the
+            # sectors skipped belong to the end of that one
+            if i > 0 and flights[i - 1].end_sector == start:
+                flights[i - 1].end_sector = flight.first_sector
+    return [flight for flight in flights if flight.num_sectors != 0]
+
+
+def find_partition(path) -> tuple[int, int | None]:
+    """ Sector of the superblock of the first CU InSpace partition and the sector after its end, or (0, None)
+    if the file has no MBR (a mission file) """
+    with open(path, "rb") as file:
+        try:
+            mbr = MBR(file.read(512))
+        except ValueError:
+            return 0, None
+    part = next((part for part in mbr.partitions if part.type == CUINSPACE_PARTITION_TYPE), None)
+    if part is None:
+        raise ValueError("No CUInSpace partition found in MBR.")
+    return part.first_sector_lba, part.first_sector_lba + part.num_sectors
+
+
+def recovered_superblock(flights: list[RecoveredFlight], part_offset: int, partition_length: int,
+                         timestamp: int = 1) -> SuperBlock:
+    """ Superblock listing recovered flights (at most MAX_FLIGHTS of them), with placeholder timestamps
+    counting up from timestamp """
+    return SuperBlock(1, False, partition_length,
+                      [Flight(flight.first_sector - part_offset, flight.num_sectors, timestamp + i)
+                       for i, flight in enumerate(flights[:MAX_FLIGHTS])])
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Rebuild the flight table of an SD card image or device with a "
+                                                     "damaged superblock by scanning its blocks.")
+    arg_parser.add_argument("infile", help="SD card image or device")
+    arg_parser.add_argument("--partition-sector", type=int, metavar="SECTOR",
+                            help="sector of the partition's superblock (default: from the MBR)")
+    arg_parser.add_argument("--timestamp", type=int, default=1,
+                            help="placeholder timestamp of the first flight, the others count up from it "
+                                 "(default: 1)")
+    arg_parser.add_argument("--no-numpy", action="store_true", help="scan without NumPy even if it is installed")
+    group = arg_parser.add_mutually_exclusive_group()
+    group.add_argument("--output", metavar="PATH", help="write the repaired superblock to a file")
+    group.add_argument("--write", action="store_true",
+                       help="write the repaired superblock into the image, replacing the damaged one")
+    args = arg_parser.parse_args()
+
+    try:
+        part_offset, end_sector = find_partition(args.infile)
+    except ValueError as e:
+        exit(str(e))
+    if args.partition_sector is not None:
+        part_offset, end_sector = args.partition_sector, None
+
+    start = time.perf_counter()
+    flights = scan_partition(args.infile, part_offset, end_sector, use_numpy=False if args.no_numpy else None)
+    seconds = time.perf_counter() - start
+    # The scan stops at the end of the partition or of the file, whichever comes first (a device's size is
+    # only found by seeking to its end)
+    with open(args.infile, "rb") as file:
+        file_sectors = file.seek(0, os.SEEK_END) // 512
+    scan_end = min(end_sector, file_sectors) if end_sector is not None else file_sectors
+    scanned = max(scan_end - part_offset - 1, 0)
+    print(f"Scanned {scanned} sectors ({scanned * 512 / 1e9:.2f} GB) in {seconds:.2f} s "
+          f"({scanned * 512 / 1e6 / max(seconds, 1e-9):.0f} MB/s)")
+    print(f"Found {len(flights)} flight{'s' if len(flights) != 1 else ''}:")
+    for i, flight in enumerate(flights):
+        duration = (flight.last_time - flight.first_time) / 1000
+        print(f"Flight {i} -> start: {flight.first_sector - part_offset}, length: {flight.num_sectors}, "
+              f"mission time {flight.first_time / 1000:.3f} s to {flight.last_time / 1000:.3f} s ({duration:.3f} s)")
+    if len(flights) > MAX_FLIGHTS:
+        print(f"Only the first {MAX_FLIGHTS} flights fit in a superblock.")
+    if len(flights) == 0:
+        exit(1)
+
+    last_sector = flights[-1].end_sector
+    partition_length = end_sector - part_offset if end_sector is not None else last_sector - part_offset
+    superblock = recovered_superblock(flights, part_offset, partition_length, args.timestamp)
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(superblock.to_bytes())
+        print(f"Repaired superblock written to {args.output}")
+    elif args.write:
+        with open(args.infile, "r+b") as f:
+            f.seek(part_offset * 512)
+            f.write(superblock.to_bytes())
+        print(f"Repaired superblock written to sector {part_offset} of {args.infile}")
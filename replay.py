@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+# Replays a flight from a mission file (or SD card image) as if the rocket were flying, for testing ground
+# station software.
+#
+# Blocks are released in the order they were logged, each at its mission time scaled by a speed factor
+# (1 for real time, 10 for ten times as fast, or max for as fast as the output can take them), and written
+# as their raw bytes to stdout, a file or pipe, or a TCP or Unix socket. Blocks that aren't telemetry data
+# are released with the telemetry before them, and since multi-sample blocks are logged after the samples
+# in them were taken, a block is never released before one logged earlier.
+#
+# Release times are all computed from the time the first block was released rather than from the previous
+# release, so being late for one block (or sleeping a little too long) doesn't push back the rest. Each
+# release sleeps until just before its time and spins for the rest, and how late each release was is
+# recorded: at the end, the jitter and the rate the replay kept up are printed to stderr.
+#
+#   python3 replay.py all.mission --speed 10 --connect localhost:9000
+#   python3 replay.py all.mission --speed max --output /dev/null
+
+import argparse
+import math
+import socket
+import struct
+import sys
+import time
+
+from cuinspace_telemetry import image_dir
+from flight_parser import gen_raw_blocks
+from misc.converter import mt_to_ms
+from mission_v2 import open_mission
+from sd_block import SDBlockClass
+from superblock import SuperBlock, Flight, find_superblock
+from time_index import load_or_build_index
+
+# Time before a release that waiting switches from sleeping to spinning
+SPIN_SECONDS = 0.0005
+# Releases later than this are counted as late
+LATE_SECONDS = 0.005
+# Bytes written at once when replaying as fast as possible
+MAX_SPEED_CHUNK = 256 * 1024
+
+
+def gen_timed_blocks(file, part_offset: int, flight: Flight, offset: int = 0):
+    """ Generates (mission time in ms, raw bytes) for each block of a flight from a byte offset in it. Blocks
+    that aren't telemetry data have the time of the telemetry before them (None before the first). """
+    file.seek((part_offset + flight.first_block) * 512 + offset)
+    mission_time = None
+    for rawblock in gen_raw_blocks(file, flight.num_blocks, offset):
+        if rawblock[0] & 0x3f == SDBlockClass.TELEMETRY_DATA and len(rawblock) >= 8:
+            mission_time = mt_to_ms(struct.unpack_from("<I", rawblock, 4)[0])
+        yield mission_time, rawblock
+
+
+def wait_until(deadline: float):
+    """ Waits until perf_counter() reaches deadline, sleeping for most of it and spinning for the rest """
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_SECONDS:
+        time.sleep(remaining - SPIN_SECONDS)
+    while time.perf_counter() < deadline:
+        pass
+
+
+class ReplayStats:
+    def __init__(self):
+        self.blocks: int = 0
+        self.bytes: int = 0
+        self.releases: int = 0
+        # Seconds each release was late by
+        self.lateness: list[float] = []
+        self.first_time = None
+        self.last_time = None
+        self.wall: float = 0.0
+
+    def add(self, blocks: int, nbytes: int, mission_time: float = None, lateness: float = None):
+        self.blocks += blocks
+        self.bytes += nbytes
+        self.releases += 1
+        if mission_time is not None:
+            if self.first_time is None:
+                self.first_time = mission_time
+            self.last_time = mission_time
+        if lateness is not None:
+            self.lateness.append(lateness)
+
+    def report(self) -> dict:
+        mission_seconds = (self.last_time - self.first_time) / 1000 if self.first_time is not None else 0.0
+        wall = self.wall or 1e-12
+        report = {
+            "blocks": self.blocks,
+            "bytes": self.bytes,
+            "releases": self.releases,
+            "wall_seconds": self.wall,
+            "mission_seconds": mission_seconds,
+            "speed": mission_seconds / wall,
+            "blocks_per_s": self.blocks / wall,
+            "mb_per_s": self.bytes / 1e6 / wall,
+        }
+        if len(self.lateness) != 0:
+            lateness = sorted(self.lateness)
+            report["jitter_ms"] = {
+                "mean": 1000 * sum(lateness) / len(lateness),
+                "p50": 1000 * lateness[len(lateness) // 2],
+                "p99": 1000 * lateness[min(math.ceil(len(lateness) * 0.99), len(lateness)) - 1],
+                "max": 1000 * lateness[-1],
+            }
+            report["late_releases"] = sum(1 for t in lateness if t > LATE_SECONDS)
+        return report
+
+    def format(self) -> str:
+        r = self.report()
+        lines = [f"Replayed {r['blocks']} blocks ({r['bytes'] / 1e6:.2f} MB, {r['mission_seconds']:.1f} s of "
+                 f"mission time) in {r['wall_seconds']:.2f} s: {r['speed']:.2f}x real time, "
+                 f"{r['blocks_per_s']:.0f} blocks/s, {r['mb_per_s']:.2f} MB/s"]
+        if "jitter_ms" in r:
+            j = r["jitter_ms"]
+            lines.append(f"Release jitter over {r['releases']} releases: mean {j['mean']:.3f} ms, "
+                         f"p50 {j['p50']:.3f} ms, p99 {j['p99']:.3f} ms, max {j['max']:.3f} ms, "
+                         f"{r['late_releases']} more than {LATE_SECONDS * 1000:g} ms late")
+        return "\n".join(lines)
+
+
+def replay(blocks, out, speed: float = None, window: tuple[float, float] = None) -> ReplayStats:
+    """ Writes blocks from gen_timed_blocks to out, each at its mission time divided by speed from the first
+    one, or as fast as possible if speed is None. Only blocks in a window (t0, t1) of mission times in ms
+    are replayed if one is given. Returns the replay's stats. """
+    stats = ReplayStats()
+    start = time.perf_counter()
+    t0 = None
+    # Blocks released together, at the same time
+    group = []
+    group_bytes = 0
+    group_time = None
+
+    def release(lateness=None):
+        out.write(b"".join(group))
+        if speed is not None:
+            out.flush()
+        stats.add(len(group), group_bytes, group_time, lateness)
+
+    for mission_time, rawblock in blocks:
+        if window is not None:
+            if mission_time is None or mission_time < window[0]:
+                continue
+            if mission_time > window[1]:
+                break
+
+        if mission_time is not None and t0 is None:
+            t0 = stats.first_time = mission_time
+            if speed is not None:
+                start = time.perf_counter()
+
+        if speed is None:
+            group.append(rawblock)
+            group_bytes += len(rawblock)
+            group_time = mission_time if mission_time is not None else group_time
+            if group_bytes >= MAX_SPEED_CHUNK:
+                release()
+                group, group_bytes = [], 0
+            continue
+
+        # Never release a block before one logged earlier
+        if mission_time is not None and (group_time is None or mission_time > group_time):
+            if len(group) != 0 and group_time is not None:
+                target = start + (group_time - t0) / 1000 / speed
+                wait_until(target)
+                release(time.perf_counter() - target)
+                group, group_bytes = [], 0
+            group_time = mission_time
+        group.append(rawblock)
+        group_bytes += len(rawblock)
+
+    if len(group) != 0:
+        if speed is not None and group_time is not None:
+            target = start + (group_time - t0) / 1000 / speed
+            wait_until(target)
+            release(time.perf_counter() - target)
+        else:
+            release()
+    out.flush()
+    stats.wall = time.perf_counter() - start
+    return stats
+
+
+def open_output(output: str = None, connect: str = None, unix: str = None):
+    """ Opens where replayed blocks are written: a TCP socket to connect to (host:port), a Unix socket, a
+    file or pipe, or stdout """
+    if connect is not None:
+        host, _, port = connect.rpartition(":")
+        return socket.create_connection((host or "localhost", int(port))).makefile("wb")
+    if unix is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix)
+        return sock.makefile("wb")
+    if output is not None and output != "-":
+        return open(output, "wb")
+    return sys.stdout.buffer
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Replay a flight's blocks at the pace they were logged.")
+    arg_parser.add_argument("infile", help="mission file or SD card image")
+    arg_parser.add_argument("--flight", type=int, default=0, help="flight to replay (default: 0)")
+    arg_parser.add_argument("--speed", default="1",
+                            help="speed factor, such as 1 for real time or 10, or max for as fast as possible "
+                                 "(default: 1)")
+    arg_parser.add_argument("--window", nargs=2, type=float, metavar=("T0", "T1"),
+                            help="only replay blocks with a mission time between T0 and T1 (ms)")
+    group = arg_parser.add_mutually_exclusive_group()
+    group.add_argument("--output", metavar="PATH", help="file or pipe to write to (default: stdout)")
+    group.add_argument("--connect", metavar="HOST:PORT", help="TCP socket to write to")
+    group.add_argument("--unix", metavar="PATH", help="Unix socket to write to")
+    args = arg_parser.parse_args()
+
+    try:
+        speed = None if args.speed == "max" else float(args.speed)
+        if speed is not None and speed <= 0:
+            raise ValueError
+    except ValueError:
+        exit(f"Invalid speed: {args.speed}")
+
+    with open_mission(args.infile) as file:
+        superblock_addr = find_superblock(file)
+        if superblock_addr is None:
+            exit(f"No superblock found in {args.infile}")
+        file.seek(superblock_addr * 512)
+        flights = SuperBlock.from_bytes(file.read(512)).flights
+        if not 0 <= args.flight < len(flights):
+            exit(f"No flight {args.flight}, {args.infile} has {len(flights)}")
+        flight = flights[args.flight]
+
+        offset = 0
+        if args.window is not None:
+            imagedir = image_dir(args.infile)
+            offset = load_or_build_index(file, imagedir, superblock_addr, args.flight, flight).seek_offset(
+                args.window[0])
+
+        out = open_output(args.output, args.connect, args.unix)
+        try:
+            stats = replay(gen_timed_blocks(file, superblock_addr, flight, offset), out, speed, args.window)
+        except (BrokenPipeError, ConnectionError) as e:
+            exit(f"Output closed: {e}")
+        except KeyboardInterrupt:
+            exit(1)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+    print(stats.format(), file=sys.stderr)
@@ -2,7 +2,11 @@ import struct
 from abc import ABC, abstractmethod
 from enum import IntEnum
 
-from data_block import DataBlock
+from block import DataBlockSubtype
+from data_block import (DataBlock, DebugMessageDataBlock, StatusDataBlock, StartupMessageDataBlock,
+                        AltitudeDataBlock, AccelerationDataBlock, AngularVelocityDataBlock,
+                        GNSSLocationBlock, GNSSMetadataBlock, MPU9250IMUDataBlock,
+                        KX134AccelerometerDataBlock)
 
 
 class SDBlockException(Exception):
@@ -97,6 +101,37 @@ class SDBlock(ABC):
 
         return struct.unpack("<H", data[2:4])[0]
 
+    @classmethod
+    def parse_header(cls, data):
+        """ Helper to get block class, type and length without parsing the payload """
+
+        if len(data) < 4:
+            raise SDBlockException(f"Block must be at least 4 bytes long ({len(data)} bytes "
+                                   f"read)")
+
+        block_head = struct.unpack("<HH", data[0:4])
+        return block_head[0] & 0x3f, block_head[0] >> 6, block_head[1]
+
+    @staticmethod
+    def lookup_class(block_class, block_type):
+        """ Class a block with the given header decodes to (the data block class for telemetry data), or
+        None if unknown. Lets callers route blocks without decoding their payloads. """
+        match block_class:
+            case SDBlockClass.LOGGING_METADATA:
+                if block_type == LoggingMetadataBlockType.SPACER:
+                    return LoggingMetadataSpacerBlock
+            case SDBlockClass.TELEMETRY_DATA:
+                return TELEMETRY_DATA_CLASSES.get(block_type)
+            case SDBlockClass.DIAGNOSTIC_DATA:
+                match block_type:
+                    case DiagnosticDataBlockType.LOG_MESSAGE:
+                        return DiagnosticDataLogMessageBlock
+                    case DiagnosticDataBlockType.OUTGOING_RADIO_PACKET:
+                        return DiagnosticDataOutgoingRadioPacketBlock
+                    case DiagnosticDataBlockType.INCOMING_RADIO_PACKET:
+                        return DiagnosticDataIncomingRadioPacketBlock
+        return None
+
 
 #
 #   Logging Metadata
@@ -191,6 +226,21 @@ class TelemetryDataBlock(SDBlock):
         return f"{self.type_desc()} -> {self.data}"
 
 
+# Data block class for each telemetry data subtype, mirrors DataBlock.parse
+TELEMETRY_DATA_CLASSES = {
+    DataBlockSubtype.DEBUG_MESSAGE: DebugMessageDataBlock,
+    DataBlockSubtype.STATUS: StatusDataBlock,
+    DataBlockSubtype.STARTUP_MESSAGE: StartupMessageDataBlock,
+    DataBlockSubtype.ALTITUDE: AltitudeDataBlock,
+    DataBlockSubtype.ACCELERATION: AccelerationDataBlock,
+    DataBlockSubtype.GNSS: GNSSLocationBlock,
+    DataBlockSubtype.GNSS_META: GNSSMetadataBlock,
+    DataBlockSubtype.MPU9250_IMU: MPU9250IMUDataBlock,
+    DataBlockSubtype.KX134_1211_ACCEL: KX134AccelerometerDataBlock,
+    DataBlockSubtype.ANGULAR_VELOCITY: AngularVelocityDataBlock,
+}
+
+
 #
 #   Diagnostic Data
 #
@@ -265,12 +315,15 @@ class DiagnosticDataRadioPacketBlock(DiagnosticDataBlock):
 
     @property
     def length(self):
-        return 4 + ((len(self.packet) + 3) & ~0x3)
+        return 8 + ((len(self.packet) + 3) & ~0x3)
 
     def _payload_bytes(self):
         p = self.packet
         p = p + (b'\x00' * (((len(p) + 3) & ~0x3) - len(p)))
-        return p
+        return struct.pack("<I", self.mission_time) + p
+
+    def __str__(self):
+        return f"{self.type_desc()} -> mission_time: {self.mission_time}, length: {len(self.packet)}"
 
 
 class DiagnosticDataOutgoingRadioPacketBlock(DiagnosticDataRadioPacketBlock):
@@ -287,10 +340,8 @@ class DiagnosticDataOutgoingRadioPacketBlock(DiagnosticDataRadioPacketBlock):
 
     @classmethod
     def _parse(cls, block_type, length, payload):
-        return DiagnosticDataOutgoingRadioPacketBlock(payload)
-
-    def __str__(self):
-        return f"{self.type_desc()} -> length: {self.length}"
+        mission_time = struct.unpack("<I", payload[0:4])[0]
+        return DiagnosticDataOutgoingRadioPacketBlock(mission_time, payload[4:])
 
 
 class DiagnosticDataIncomingRadioPacketBlock(DiagnosticDataRadioPacketBlock):
@@ -307,7 +358,5 @@ class DiagnosticDataIncomingRadioPacketBlock(DiagnosticDataRadioPacketBlock):
 
     @classmethod
     def _parse(cls, block_type, length, payload):
-        return DiagnosticDataIncomingRadioPacketBlock(payload)
-
-    def __str__(self):
-        return f"{self.type_desc()} -> length: {self.length}"
+        mission_time = struct.unpack("<I", payload[0:4])[0]
+        return DiagnosticDataIncomingRadioPacketBlock(mission_time, payload[4:])
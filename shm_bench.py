@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+# Benchmark of the shared memory rings in shm_ring.py: one producer writing records as fast as it can and
+# several consumer processes reading them.
+#
+# The producer writes synthetic records to a ring in batches, or (with --infile) decodes a file into the
+# rings of every stream, while each consumer polls one ring either through zero-copy views (the default,
+# summing a column so the records are actually touched) or by copying them with read(). The producer's
+# write rate, each consumer's read rate and how many records each one missed by falling more than a ring
+# behind are printed.
+#
+#   python3 shm_bench.py --consumers 4 --records 5000000
+#   python3 shm_bench.py --infile full --consumers 4 --copy
+
+import argparse
+import multiprocessing
+import os
+import time
+
+from shm_ring import RING_CAPACITY, RingReader, RingWriter, TelemetryRings, produce
+from timeline import STREAM_FIELDS
+
+BENCH_PREFIX = "cuinspace_bench"
+# Records written at once by the synthetic producer
+BATCH_RECORDS = 64
+# Fields of each synthetic record, after its time
+BENCH_FIELDS = 3
+
+
+def consume(stream: str, prefix: str, copy: bool, ready, start, done, results):
+    reader = RingReader(stream, prefix)
+    ready.release()
+    start.wait()
+    began = time.perf_counter()
+    records = 0
+    # Records that were overwritten while being read through views
+    overwritten = 0
+    checksum = 0.0
+    while True:
+        finished = done.is_set()
+        if copy:
+            rows = reader.read()
+            records += len(rows)
+            checksum += sum(row[0] for row in rows)
+        else:
+            views = reader.read_views()
+            for view in views:
+                records += view.shape[0]
+                checksum += sum(view[i, 0] for i in range(0, view.shape[0], 64))
+                view.release()
+            overwritten += reader.overwritten()
+        # One more read once the producer is done, for the last records
+        if finished:
+            break
+        if reader.available() == 0:
+            time.sleep(0.0001)
+    results.put((os.getpid(), stream, records - overwritten, reader.missed + overwritten,
+                 time.perf_counter() - began))
+    reader.close()
+
+
+def write_synthetic(writer: RingWriter, num_records: int):
+    batch = [float(i) for i in range(BATCH_RECORDS * (1 + BENCH_FIELDS))]
+    for _ in range(num_records // BATCH_RECORDS):
+        writer.write(batch)
+
+
+def run(args) -> dict:
+    if args.infile is None:
+        streams = ["bench"]
+        rings = None
+        writer = RingWriter("bench", 1 + BENCH_FIELDS, args.capacity, BENCH_PREFIX)
+    else:
+        streams = list(STREAM_FIELDS)
+        rings = TelemetryRings(args.capacity, BENCH_PREFIX)
+
+    ready = multiprocessing.Semaphore(0)
+    start = multiprocessing.Event()
+    done = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    consumers = [multiprocessing.Process(target=consume, args=(streams[i % len(streams)], BENCH_PREFIX,
+                                                                args.copy, ready, start, done, results))
+                 for i in range(args.consumers)]
+    try:
+        for consumer in consumers:
+            consumer.start()
+        for _ in consumers:
+            ready.acquire()
+
+        start.set()
+        began = time.perf_counter()
+        if rings is None:
+            write_synthetic(writer, args.records)
+            written = args.records // BATCH_RECORDS * BATCH_RECORDS
+        else:
+            produce(args.infile, rings)
+            written = sum(w.seq for w in rings.writers.values())
+        elapsed = time.perf_counter() - began
+        done.set()
+        consumed = [results.get() for _ in consumers]
+        for consumer in consumers:
+            consumer.join()
+    finally:
+        if rings is None:
+            writer.close()
+        else:
+            rings.close()
+    return {"written": written, "write_seconds": elapsed, "consumers": consumed}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark shared memory ring producer/consumer throughput.")
+    arg_parser.add_argument("--infile", help="decode this SD card image or mission file instead of writing "
+                                             "synthetic records")
+    arg_parser.add_argument("--records", type=int, default=2_000_000,
+                            help="synthetic records to write (default: 2000000)")
+    arg_parser.add_argument("--consumers", type=int, default=4, help="consumer processes (default: 4)")
+    arg_parser.add_argument("--capacity", type=int, default=RING_CAPACITY,
+                            help=f"records in each ring (default: {RING_CAPACITY})")
+    arg_parser.add_argument("--copy", action="store_true", help="consumers copy records rather than use views")
+    args = arg_parser.parse_args()
+
+    result = run(args)
+    written = result["written"]
+    print(f"Producer: {written} records in {result['write_seconds']:.2f} s "
+          f"({written / result['write_seconds']:.0f} records/s)")
+    for pid, stream, records, missed, seconds in sorted(result["consumers"]):
+        print(f"Consumer {pid} ({stream}): {records} records in {seconds:.2f} s "
+              f"({records / seconds:.0f} records/s), {missed} missed")
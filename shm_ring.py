@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+# Shared memory ring buffers of recently decoded telemetry, so several local processes (a plotter, an
+# event detector, a logger) can all follow a flight while it is decoded only once.
+#
+# The producer keeps a ring for each sensor stream (altitude, gnss_location, kx134_accelerometer,
+# mpu9250_imu, acceleration, angular_velocity) in a multiprocessing.shared_memory block named
+# <prefix>_<stream>. A ring is a RING_HEADER followed by capacity fixed size records, each a float64 time in
+# ms followed by a float64 for each of the stream's fields, and record number n is kept in slot
+# n % capacity.
+#
+# There is one writer per ring and no locks. The header has two sequence counters: reserved, the number of
+# records the writer has started writing, and written, the number it has finished. The writer bumps
+# reserved before overwriting slots and written after, and readers read records below written without
+# copying them, then check reserved to find out whether the writer had reached (and overwritten) any of
+# them in the meantime. A reader that falls more than capacity records behind skips ahead and counts what
+# it missed. The counters are 8 byte aligned and accessed through a memoryview of native unsigned 64 bit
+# integers, so each is read and written with a single load or store (struct's little endian formats copy a
+# byte at a time, and a reader could see half an update). Everything is in native byte order, since the
+# rings are only shared between processes on the same machine.
+#
+#   python3 shm_ring.py produce full --speed 1
+#   python3 shm_ring.py tail altitude
+
+import argparse
+import struct
+import sys
+import time
+from array import array
+from multiprocessing import shared_memory
+
+from mission_v2 import open_mission
+from replay import gen_timed_blocks, wait_until
+from sd_block import SDBlock, SDBlockClass
+from superblock import SuperBlock, find_superblock
+from timeline import STREAM_FIELDS, gen_block_samples
+
+MAGIC = b"CUInRing"
+# magic, version, doubles per record, capacity, reserved, written, stream name
+RING_HEADER = struct.Struct("=8sIIQQQ24s")
+# Indexes of the sequence counters in the header as 64 bit integers
+RESERVED = 3
+WRITTEN = 4
+RING_VERSION = 1
+RING_PREFIX = "cuinspace"
+# Default number of records in each ring
+RING_CAPACITY = 65536
+
+
+def ring_name(stream: str, prefix: str = RING_PREFIX) -> str:
+    return f"{prefix}_{stream}"
+
+
+class RingWriter:
+    """ The writer of a ring, which creates its shared memory and removes it when closed """
+
+    def __init__(self, stream: str, fields: int, capacity: int = RING_CAPACITY, prefix: str = RING_PREFIX):
+        self.stream: str = stream
+        self.fields: int = fields
+        self.capacity: int = capacity
+        self.shm = shared_memory.SharedMemory(ring_name(stream, prefix), create=True,
+                                              size=RING_HEADER.size + capacity * fields * 8)
+        RING_HEADER.pack_into(self.shm.buf, 0, MAGIC, RING_VERSION, fields, capacity, 0, 0, stream.encode())
+        self.counters = self.shm.buf[:RING_HEADER.size].cast("Q")
+        self.records = self.shm.buf[RING_HEADER.size:].cast("d")
+        self.seq: int = 0
+
+    def write(self, values):
+        """ Writes records, given as a flat sequence of their values (time then fields, record after record) """
+        values = array("d", values)
+        n = len(values) // self.fields
+        # Only the last capacity records would survive anyway
+        if n > self.capacity:
+            values = values[(n - self.capacity) * self.fields:]
+            self.seq += n - self.capacity
+            n = self.capacity
+        if n == 0:
+            return
+
+        self.counters[RESERVED] = self.seq + n
+        slot = self.seq % self.capacity
+        first = min(n, self.capacity - slot)
+        self.records[slot * self.fields:(slot + first) * self.fields] = values[:first * self.fields]
+        if first < n:
+            self.records[:(n - first) * self.fields] = values[first * self.fields:]
+        self.seq += n
+        self.counters[WRITTEN] = self.seq
+
+    def close(self):
+        self.counters.release()
+        self.records.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """ Attaches to shared memory without the resource tracker removing it when this process exits """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers with the resource tracker
+        # and unregistering would break a creator in the same process tree, so skip registering instead
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: rtype == "shared_memory" or register(name, rtype)
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+
+class RingReader:
+    """ A reader of a ring, starting from the oldest record still in it or (if latest) from the next one
+    written """
+
+    def __init__(self, stream: str, prefix: str = RING_PREFIX, latest: bool = False):
+        self.shm = _attach(ring_name(stream, prefix))
+        magic, version, self.fields, self.capacity, _, written, name = RING_HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or version != RING_VERSION:
+            self.shm.close()
+            raise ValueError(f"{ring_name(stream, prefix)} is not a telemetry ring")
+        self.stream: str = name.rstrip(b"\0").decode()
+        self.counters = self.shm.buf[:RING_HEADER.size].cast("Q")
+        self.records = self.shm.buf[RING_HEADER.size:].cast("d")
+        self.next_seq: int = written if latest else max(written - self.capacity, 0)
+        # Records that were overwritten before they could be read
+        self.missed: int = 0
+        # Start of the records returned by the last read_views
+        self._view_seq: int = self.next_seq
+
+    def available(self) -> int:
+        return self.counters[WRITTEN] - self.next_seq
+
+    def read_views(self, max_records: int = None) -> list[memoryview]:
+        """ The records written since the last read as (at most two) views of the ring, shaped (records,
+        fields), without copying them. The writer may overwrite them at any time, so once done with them
+        call overwritten() to check they weren't. """
+        written = self.counters[WRITTEN]
+        if written - self.next_seq > self.capacity:
+            self.missed += written - self.capacity - self.next_seq
+            self.next_seq = written - self.capacity
+        end = written if max_records is None else min(written, self.next_seq + max_records)
+        self._view_seq = self.next_seq
+
+        views = []
+        seq = self.next_seq
+        while seq < end:
+            slot = seq % self.capacity
+            n = min(end - seq, self.capacity - slot)
+            views.append(self.records[slot * self.fields:(slot + n) * self.fields].cast("B").cast(
+                "d", (n, self.fields)))
+            seq += n
+        self.next_seq = end
+        return views
+
+    def overwritten(self) -> int:
+        """ Number of records at the start of the last read_views that the writer has overwritten since, 0 if
+        they are all still valid """
+        overwritten = self.counters[RESERVED] - self.capacity - self._view_seq
+        return min(max(overwritten, 0), self.next_seq - self._view_seq)
+
+    def read(self, max_records: int = None) -> list[tuple]:
+        """ Copies of the records written since the last read, as (time, field, ...) tuples """
+        views = self.read_views(max_records)
+        rows = [tuple(row) for view in views for row in view.tolist()]
+        for view in views:
+            view.release()
+        overwritten = self.overwritten()
+        if overwritten != 0:
+            self.missed += overwritten
+            rows = rows[overwritten:]
+        return rows
+
+    def close(self):
+        """ Closes the reader, which fails if views it returned haven't been released """
+        self.counters.release()
+        self.records.release()
+        self.shm.close()
+
+
+class TelemetryRings:
+    """ The rings of every sensor stream, written from decoded blocks """
+
+    def __init__(self, capacity: int = RING_CAPACITY, prefix: str = RING_PREFIX):
+        self.writers: dict[str, RingWriter] = dict()
+        try:
+            for stream, fields in STREAM_FIELDS.items():
+                self.writers[stream] = RingWriter(stream, 1 + len(fields), capacity, prefix)
+        except Exception:
+            self.close()
+            raise
+
+    def write_block(self, block):
+        """ Writes the samples of a decoded block to its stream's ring """
+        values = []
+        stream = None
+        for time_ms, stream, sample in gen_block_samples(block):
+            values.append(time_ms)
+            values.extend(sample)
+        if stream is not None:
+            self.writers[stream].write(values)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = dict()
+
+
+def produce(path, rings: TelemetryRings, speed: float = None) -> int:
+    """ Decodes every flight of a file into rings, at speed times real time (or as fast as possible if
+    speed is None). Returns the number of blocks written. """
+    count = 0
+    with open_mission(path) as file:
+        superblock_addr = find_superblock(file)
+        if superblock_addr is None:
+            raise ValueError(f"No superblock found in {path}")
+        file.seek(superblock_addr * 512)
+        for flight in SuperBlock.from_bytes(file.read(512)).flights:
+            start = time.perf_counter()
+            t0 = None
+            latest = None
+            for mission_time, rawblock in gen_timed_blocks(file, superblock_addr, flight):
+                if rawblock[0] & 0x3f != SDBlockClass.TELEMETRY_DATA:
+                    continue
+                if speed is not None and mission_time is not None:
+                    if t0 is None:
+                        t0 = mission_time
+                        start = time.perf_counter()
+                    latest = mission_time if latest is None else max(latest, mission_time)
+                    wait_until(start + (latest - t0) / 1000 / speed)
+                rings.write_block(SDBlock.from_bytes(rawblock))
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Shared memory rings of decoded telemetry.")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    produce_parser = subparsers.add_parser("produce", help="decode a file into the rings")
+    produce_parser.add_argument("infile", help="SD card image or mission file")
+    produce_parser.add_argument("--speed", default="max",
+                                help="speed factor, 1 for real time, or max for as fast as possible (default: max)")
+    produce_parser.add_argument("--capacity", type=int, default=RING_CAPACITY,
+                                help=f"records in each ring (default: {RING_CAPACITY})")
+    produce_parser.add_argument("--hold", type=float, default=0, metavar="SECONDS",
+                                help="seconds to keep the rings once done, for readers to catch up")
+    tail_parser = subparsers.add_parser("tail", help="print the records of a ring as they are written")
+    tail_parser.add_argument("stream", choices=STREAM_FIELDS.keys())
+    for p in (produce_parser, tail_parser):
+        p.add_argument("--prefix", default=RING_PREFIX, help=f"prefix of the rings' names (default: {RING_PREFIX})")
+    args = arg_parser.parse_args()
+
+    if args.command == "produce":
+        rings = TelemetryRings(args.capacity, args.prefix)
+        try:
+            count = produce(args.infile, rings, None if args.speed == "max" else float(args.speed))
+            print(f"Wrote {count} blocks", file=sys.stderr)
+            time.sleep(args.hold)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            rings.close()
+    else:
+        reader = RingReader(args.stream, args.prefix, latest=True)
+        print("time," + ",".join(STREAM_FIELDS[args.stream]))
+        try:
+            while True:
+                for row in reader.read():
+                    print(",".join(str(v) for v in row))
+                time.sleep(0.05)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        finally:
+            reader.close()
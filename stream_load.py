@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# Load test of stream_server.py with hundreds of local clients.
+#
+# The server is started on a file with --wait-clients, so it starts decoding once every client has
+# connected, and it is run twice: once with every client reading as fast as it can, and once with some of
+# them stalled (they subscribe and then never read). The decode rate of the two runs is compared to check
+# that slow consumers don't stall decoding, and how many records the clients received or had dropped is
+# shown. Stalled clients have small socket buffers and the first flight of the file is repeated into a
+# mission file of at least --size MB, so what is sent to a stalled client always fills its queue.
+# Exits with 1 if stalled clients slowed decoding down by more than MAX_SLOWDOWN, or if any of them
+# didn't have records dropped (the per-client bound was never reached).
+#
+#   python3 stream_load.py full --clients 300 --stalled 0.2
+
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from memory_check import make_mission
+from stream_server import POLICIES, QUEUE_SIZE
+
+# Largest acceptable ratio of the decode time with stalled clients to the decode time without
+MAX_SLOWDOWN = 2.0
+# Receive buffer of a stalled client's socket, so the kernel holds little of what is sent to it
+STALLED_RCVBUF = 4096
+# Default size (MB) of the mission file streamed, well over what a stalled client's socket buffers hold
+DEFAULT_SIZE = 4
+
+
+async def fast_client(host: str, port: int, streams: str, received: list, i: int):
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+    writer.write(streams.encode() + b"\n")
+    await writer.drain()
+    while await reader.readline():
+        received[i] += 1
+    writer.close()
+
+
+async def stalled_client(host: str, port: int, streams: str, done: asyncio.Event):
+    # A plain socket, so nothing reads what the server sends
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STALLED_RCVBUF)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, (host, port))
+        await loop.sock_sendall(sock, streams.encode() + b"\n")
+        await done.wait()
+    finally:
+        sock.close()
+
+
+async def run_clients(host: str, port: int, num_fast: int, num_stalled: int, streams: str) -> list:
+    received = [0] * num_fast
+    done = asyncio.Event()
+    stalled = [asyncio.create_task(stalled_client(host, port, streams, done)) for _ in range(num_stalled)]
+    await asyncio.gather(*(fast_client(host, port, streams, received, i) for i in range(num_fast)))
+    done.set()
+    await asyncio.gather(*stalled, return_exceptions=True)
+    return received
+
+
+def run(infile, port: int, num_fast: int, num_stalled: int, streams: str, queue_size: int, policy: str) -> dict:
+    """ Runs the server with clients, returns its stats and the records each fast client received """
+    server = subprocess.Popen([sys.executable, Path(__file__).parent.joinpath("stream_server.py"), infile,
+                               "--port", str(port), "--wait-clients", str(num_fast + num_stalled), "--stats",
+                               "--linger", "2", "--queue-size", str(queue_size), "--policy", policy],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        # Wait for the server to listen
+        server.stdout.readline()
+        received = asyncio.run(run_clients("127.0.0.1", port, num_fast, num_stalled, streams))
+        stats = json.loads(server.stdout.read().strip().splitlines()[-1])
+    finally:
+        server.wait(timeout=30)
+    stats["received"] = received
+    return stats
+
+
+def report(name: str, stats: dict):
+    received = stats["received"]
+    print(f"{name}: {stats['blocks']} blocks decoded in {stats['decode_seconds']:.2f} s "
+          f"({stats['blocks_per_s']:.0f} blocks/s), {stats['records']} records published to {stats['clients']} "
+          f"clients, {stats['sent']} sent, {stats['dropped']} dropped from {stats['dropping_clients']} clients")
+    if len(received) != 0:
+        print(f"    records received by reading clients: min {min(received)}, "
+              f"median {statistics.median(received):.0f}, max {max(received)}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Load test stream_server.py with many local clients.")
+    arg_parser.add_argument("infile", help="SD card image or mission file to stream")
+    arg_parser.add_argument("--clients", type=int, default=300, help="number of clients (default: 300)")
+    arg_parser.add_argument("--stalled", type=float, default=0.2,
+                            help="fraction of clients that never read in the second run (default: 0.2)")
+    arg_parser.add_argument("--streams", default="", help="streams the clients subscribe to (default: all)")
+    arg_parser.add_argument("--port", type=int, default=8790, help="port to run the server on (default: 8790)")
+    arg_parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                            help=f"records queued for each client (default: {QUEUE_SIZE})")
+    arg_parser.add_argument("--size", type=float, default=DEFAULT_SIZE,
+                            help="MB of data to stream, made of copies of the first flight of the file "
+                                 f"(default: {DEFAULT_SIZE})")
+    arg_parser.add_argument("--policy", choices=POLICIES, default="drop", help="server's policy (default: drop)")
+    args = arg_parser.parse_args()
+
+    num_stalled = int(args.clients * args.stalled)
+    with tempfile.TemporaryDirectory() as tmp:
+        mission = Path(tmp).joinpath("load.mission")
+        sectors = make_mission(args.infile, mission, int(args.size * 1024 ** 2))
+        print(f"Streaming a {sectors * 512 / 1024 ** 2:.0f} MB flight")
+        base = run(mission, args.port, args.clients, 0, args.streams, args.queue_size, args.policy)
+        report(f"{args.clients} reading clients", base)
+        loaded = run(mission, args.port, args.clients - num_stalled, num_stalled, args.streams, args.queue_size,
+                     args.policy)
+        report(f"{args.clients - num_stalled} reading and {num_stalled} stalled clients", loaded)
+
+    slowdown = loaded["decode_seconds"] / base["decode_seconds"]
+    print(f"Decoding took {slowdown:.2f}x as long with stalled clients (at most {MAX_SLOWDOWN:g}x allowed)")
+    # Every stalled client has to have reached its queue's bound, or the test didn't apply any backpressure
+    bounded = loaded["dropping_clients"] >= num_stalled
+    if not bounded:
+        print(f"Only {loaded['dropping_clients']} of {num_stalled} stalled clients had records dropped, "
+              f"increase --size or lower --queue-size")
+    sys.exit(0 if slowdown <= MAX_SLOWDOWN and bounded else 1)
@@ -0,0 +1,394 @@
+#! /usr/bin/env python3
+# Streams decoded telemetry to TCP and WebSocket clients, for ground station dashboards.
+#
+# The server decodes the flights of an SD card image or mission file (or follows an image that is still
+# being written) and publishes a record for each block of sensor data: its flight, stream (altitude,
+# gnss_location, kx134_accelerometer, mpu9250_imu, acceleration or angular_velocity) and samples. Clients
+# connect to one port and either send a line with the streams they want (comma separated, empty for all)
+# to get JSON lines, or open a WebSocket (ws://host:port/?streams=altitude,gnss_location) to get a JSON
+# text message per record. Either way the first message lists the fields of each stream.
+#
+# Decoding never waits for clients. Each client has its own bounded queue, filled by the decoder and
+# emptied by the client's own writer task. When a client's queue is full, either the oldest queued records
+# are dropped ("drop") or, until the client catches up, only the latest record of each stream is kept
+# ("coalesce").
+#
+#   python3 stream_server.py full --port 8765 --policy coalesce
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import time
+from collections import deque
+from itertools import islice
+from urllib.parse import urlsplit, parse_qs
+
+from data_block import (AltitudeDataBlock, GNSSLocationBlock, KX134AccelerometerDataBlock, MPU9250IMUDataBlock,
+                        AccelerationDataBlock, AngularVelocityDataBlock)
+from flight_parser import gen_raw_blocks
+from follow import POLL_INTERVAL, gen_new_blocks
+from mission_v2 import open_mission
+from sd_block import SDBlock, SDBlockClass
+from superblock import SuperBlock, find_superblock
+from timeline import STREAM_FIELDS, gen_block_samples
+
+DEFAULT_PORT = 8765
+# Records a client's queue holds before its policy applies
+QUEUE_SIZE = 1024
+POLICIES = ("drop", "coalesce")
+# Blocks decoded between giving clients' writers a turn
+DECODE_BATCH = 256
+# Bytes written to a client before waiting for its socket to drain
+WRITE_CHUNK = 64 * 1024
+# Data blocks that have samples to publish
+STREAM_CLASSES = (AltitudeDataBlock, GNSSLocationBlock, KX134AccelerometerDataBlock, MPU9250IMUDataBlock,
+                  AccelerationDataBlock, AngularVelocityDataBlock)
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def websocket_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    """ An unmasked, unfragmented WebSocket frame (a text message by default) """
+    if len(payload) < 126:
+        head = struct.pack("!BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+    return head + payload
+
+
+class Record:
+    """ A message to clients, encoded once for every client as a JSON line and, if needed, a WebSocket
+    frame """
+
+    def __init__(self, stream: str, message: dict):
+        self.stream: str = stream
+        self.json: bytes = json.dumps(message, separators=(",", ":")).encode()
+        self._frame: bytes = None
+
+    def encoded(self, websocket: bool) -> bytes:
+        if not websocket:
+            return self.json + b"\n"
+        if self._frame is None:
+            self._frame = websocket_frame(self.json)
+        return self._frame
+
+
+class Client:
+    def __init__(self, writer: asyncio.StreamWriter, streams: set, websocket: bool, queue_size: int = QUEUE_SIZE,
+                 policy: str = "drop"):
+        self.writer = writer
+        # Streams the client wants, None for all
+        self.streams: set = streams
+        self.websocket: bool = websocket
+        self.queue_size: int = queue_size
+        self.policy: str = policy
+        self.queue: deque = deque()
+        # Latest record of each stream, used instead of the queue while a coalescing client catches up
+        self.latest: dict = dict()
+        self.ready = asyncio.Event()
+        self.sent: int = 0
+        self.dropped: int = 0
+
+    def put(self, record: Record):
+        """ Queues a record for the client without waiting, applying the client's policy if it is behind """
+        if self.streams is not None and record.stream not in self.streams:
+            return
+        if self.policy == "coalesce" and (len(self.latest) != 0 or len(self.queue) >= self.queue_size):
+            if record.stream in self.latest:
+                self.dropped += 1
+            self.latest[record.stream] = record
+        else:
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(record)
+        self.ready.set()
+
+    async def run(self):
+        """ Writes queued records to the client until it disconnects """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while len(self.queue) != 0 or len(self.latest) != 0:
+                chunk = []
+                size = 0
+                while len(self.queue) != 0 and size < WRITE_CHUNK:
+                    data = self.queue.popleft().encoded(self.websocket)
+                    chunk.append(data)
+                    size += len(data)
+                if len(self.queue) == 0 and size < WRITE_CHUNK:
+                    # Coalesced records are newer than anything that was in the queue
+                    chunk.extend(record.encoded(self.websocket) for record in self.latest.values())
+                    self.latest = dict()
+                self.sent += len(chunk)
+                self.writer.write(b"".join(chunk))
+                # Only this client's writer waits for its socket
+                await self.writer.drain()
+
+
+class TelemetryServer:
+    def __init__(self, queue_size: int = QUEUE_SIZE, policy: str = "drop"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy: {policy}")
+        self.queue_size: int = queue_size
+        self.policy: str = policy
+        self.clients: set[Client] = set()
+        self.connected = asyncio.Condition()
+        self.published: int = 0
+        # Totals of clients that have disconnected
+        self.sent: int = 0
+        self.dropped: int = 0
+        self.dropping_clients: int = 0
+
+    def publish(self, record: Record):
+        self.published += 1
+        for client in self.clients:
+            client.put(record)
+
+    async def wait_for_clients(self, n: int):
+        async with self.connected:
+            await self.connected.wait_for(lambda: len(self.clients) >= n)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Serves a client connection """
+        try:
+            line = await reader.readline()
+            websocket = line.startswith(b"GET ")
+            if websocket:
+                streams = await self._websocket_handshake(reader, writer, line)
+                if streams is False:
+                    return
+            else:
+                names = [name.strip() for name in line.decode("utf-8", "replace").split(",") if name.strip()]
+                streams = set(names) if len(names) != 0 and names != ["*"] else None
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+
+        client = Client(writer, streams, websocket, self.queue_size, self.policy)
+        client.queue.append(Record("", {"streams": dict((name, ["time", *fields])
+                                                        for name, fields in STREAM_FIELDS.items())}))
+        client.ready.set()
+        async with self.connected:
+            self.clients.add(client)
+            self.connected.notify_all()
+
+        # The client is done once it disconnects (or, for a WebSocket, sends a close frame)
+        writing = asyncio.create_task(client.run())
+        watching = asyncio.create_task(self._watch(reader, websocket))
+        try:
+            await asyncio.wait((writing, watching), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients.discard(client)
+            self.sent += client.sent
+            self.dropped += client.dropped
+            if client.dropped != 0:
+                self.dropping_clients += 1
+            for task in (writing, watching):
+                task.cancel()
+            writer.close()
+
+    async def _websocket_handshake(self, reader, writer, request_line: bytes):
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get("sec-websocket-key")
+        if key is None:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+            writer.close()
+            return False
+
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        query = parse_qs(urlsplit(request_line.split()[1].decode()).query)
+        names = [name for value in query.get("streams", []) for name in value.split(",") if name]
+        return set(names) if len(names) != 0 else None
+
+    @staticmethod
+    async def _watch(reader: asyncio.StreamReader, websocket: bool):
+        """ Returns once the client disconnects or closes its WebSocket, ignoring anything else it sends """
+        try:
+            while True:
+                if not websocket:
+                    if await reader.read(4096) == b"":
+                        return
+                    continue
+                head = await reader.readexactly(2)
+                length = head[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack("!H", await reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", await reader.readexactly(8))[0]
+                # Client frames are masked
+                await reader.readexactly(length + (4 if head[1] & 0x80 else 0))
+                if head[0] & 0x0f == 0x8:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+
+    def publish_blocks(self, flight_num: int, rawblocks) -> int:
+        """ Decodes blocks and publishes their samples, returns the number of blocks """
+        count = 0
+        for rawblock in rawblocks:
+            count += 1
+            block_class, block_type, _ = SDBlock.parse_header(rawblock)
+            if block_class != SDBlockClass.TELEMETRY_DATA:
+                continue
+            if SDBlock.lookup_class(block_class, block_type) not in STREAM_CLASSES:
+                continue
+            samples = list(gen_block_samples(SDBlock.from_bytes(rawblock)))
+            if len(samples) != 0:
+                stream = samples[0][1]
+                self.publish(Record(stream, {"flight": flight_num, "stream": stream,
+                                             "samples": [[t, *values] for t, _, values in samples]}))
+        return count
+
+    async def stream_file(self, path) -> int:
+        """ Publishes every flight of an SD card image or mission file, returns the number of blocks """
+        total = 0
+        with open_mission(path) as file:
+            superblock_addr = find_superblock(file)
+            if superblock_addr is None:
+                raise ValueError(f"No superblock found in {path}")
+            file.seek(superblock_addr * 512)
+            sb = SuperBlock.from_bytes(file.read(512))
+            for flight_num, flight in enumerate(sb.flights):
+                file.seek((superblock_addr + flight.first_block) * 512)
+                rawblocks = gen_raw_blocks(file, flight.num_blocks)
+                while True:
+                    batch = [rawblock for _, rawblock in zip(range(DECODE_BATCH), rawblocks)]
+                    if len(batch) == 0:
+                        break
+                    total += self.publish_blocks(flight_num, batch)
+                    await asyncio.sleep(0)
+        return total
+
+    async def stream_followed(self, path, interval: float = POLL_INTERVAL, idle_timeout: float = None) -> int:
+        """ Publishes the blocks of an image as they are written, until it hasn't changed for idle_timeout
+        seconds (if given). Returns the number of blocks. """
+        total = 0
+        offsets = dict()
+        superblock_addr = None
+        last_stat = None
+        last_change = time.monotonic()
+        with open(path, "rb", buffering=0) as file:
+            while True:
+                stat = os.fstat(file.fileno())
+                if (stat.st_size, stat.st_mtime_ns) == last_stat:
+                    if idle_timeout is not None and time.monotonic() - last_change > idle_timeout:
+                        return total
+                    await asyncio.sleep(interval)
+                    continue
+                last_stat = (stat.st_size, stat.st_mtime_ns)
+                last_change = time.monotonic()
+
+                if superblock_addr is None:
+                    superblock_addr = find_superblock(file)
+                    if superblock_addr is None:
+                        continue
+                file.seek(superblock_addr * 512)
+                try:
+                    flights = SuperBlock.from_bytes(file.read(512)).flights
+                except ValueError:
+                    # Caught mid-write, try again next poll
+                    last_stat = None
+                    await asyncio.sleep(interval)
+                    continue
+                for flight_num, flight in enumerate(flights):
+                    rawblocks = gen_new_blocks(file, superblock_addr, flight, offsets.get(flight_num, 0))
+                    # A batch at a time, so a large flight is never all in memory
+                    while True:
+                        batch = list(islice(rawblocks, DECODE_BATCH))
+                        if len(batch) == 0:
+                            break
+                        offsets[flight_num] = offsets.get(flight_num, 0) + sum(len(rawblock) for rawblock in batch)
+                        total += self.publish_blocks(flight_num, batch)
+                        await asyncio.sleep(0)
+
+    async def drain_clients(self, timeout: float):
+        """ Waits up to timeout seconds for clients to be sent what is queued for them """
+        deadline = time.monotonic() + timeout
+        while any(len(c.queue) != 0 or len(c.latest) != 0 for c in self.clients) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+async def serve(path, host: str = "127.0.0.1", port: int = DEFAULT_PORT, follow: bool = False,
+                interval: float = POLL_INTERVAL, idle_timeout: float = None, queue_size: int = QUEUE_SIZE,
+                policy: str = "drop", wait_clients: int = 0, linger: float = 5.0) -> dict:
+    """ Serves the telemetry of a file until it has all been published (or, when following, until the image
+    stops changing) and clients have had up to linger seconds to receive it. Returns stats of the run. """
+    server = TelemetryServer(queue_size, policy)
+    tcp_server = await asyncio.start_server(server.handle, host, port)
+    print(f"Serving on {', '.join(str(s.getsockname()) for s in tcp_server.sockets)}", flush=True)
+    async with tcp_server:
+        if wait_clients > 0:
+            await server.wait_for_clients(wait_clients)
+        start = time.perf_counter()
+        if follow:
+            blocks = await server.stream_followed(path, interval, idle_timeout)
+        else:
+            blocks = await server.stream_file(path)
+        elapsed = time.perf_counter() - start
+        await server.drain_clients(linger)
+
+        num_clients = len(server.clients)
+        # Closing a client's connection ends its handler, which adds its totals to the server's
+        for client in list(server.clients):
+            client.writer.close()
+        deadline = time.monotonic() + 1.0
+        while len(server.clients) != 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+    return {
+        "blocks": blocks,
+        "records": server.published,
+        "decode_seconds": elapsed,
+        "blocks_per_s": blocks / elapsed if elapsed > 0 else 0,
+        "clients": num_clients,
+        "sent": server.sent,
+        "dropped": server.dropped,
+        "dropping_clients": server.dropping_clients,
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Stream decoded telemetry to TCP and WebSocket clients.")
+    arg_parser.add_argument("infile", help="SD card image or mission file")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    arg_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port (default: {DEFAULT_PORT})")
+    arg_parser.add_argument("--follow", action="store_true", help="follow an image that is still being written")
+    arg_parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+                            help=f"seconds between checks for new data when following (default: {POLL_INTERVAL:g})")
+    arg_parser.add_argument("--idle-timeout", type=float, metavar="SECONDS",
+                            help="stop following once the image hasn't changed for SECONDS seconds")
+    arg_parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                            help=f"records queued for each client (default: {QUEUE_SIZE})")
+    arg_parser.add_argument("--policy", choices=POLICIES, default="drop",
+                            help="what to do when a client's queue is full: drop the oldest records, or keep "
+                                 "only the latest of each stream (default: drop)")
+    arg_parser.add_argument("--wait-clients", type=int, default=0, metavar="N",
+                            help="wait for N clients to connect before starting")
+    arg_parser.add_argument("--linger", type=float, default=5.0, metavar="SECONDS",
+                            help="seconds to keep sending queued records once everything has been published "
+                                 "(default: 5)")
+    arg_parser.add_argument("--stats", action="store_true", help="print stats of the run as JSON when done")
+    args = arg_parser.parse_args()
+
+    try:
+        stats = asyncio.run(serve(args.infile, args.host, args.port, args.follow, args.interval, args.idle_timeout,
+                                  args.queue_size, args.policy, args.wait_clients, args.linger))
+    except KeyboardInterrupt:
+        pass
+    else:
+        if args.stats:
+            print(json.dumps(stats))
@@ -0,0 +1,169 @@
+# Per-flight summaries, saved next to the flight output folders as a by-product of parsing.
+#
+# A full parse saves block counts, the mission time range, spacer bytes, per-sensor sample counts and
+# min/max values and the flight's events. When there is no saved summary, a metadata-only scan of the
+# block headers gives everything but the sensor values, and is saved too so it's only done once.
+
+import json
+import math
+from collections import Counter
+from pathlib import Path
+
+from handlers import BlockHandler
+from misc.converter import mt_to_ms
+from sd_block import SDBlock, LoggingMetadataSpacerBlock
+from superblock import Flight, flight_dict
+from time_index import gen_block_headers
+from timeline import STREAM_FIELDS, TimelineHandler, gen_block_samples
+
+
+def summary_path(imagedir: Path, flight_num: int) -> Path:
+    return imagedir.joinpath(f"flight_{flight_num}_summary.json")
+
+
+def follow_state_path(imagedir: Path, flight_num: int) -> Path:
+    """ Where follow.py saves how far it got into a flight, which has to be removed whenever the flight's
+    folder is replaced """
+    return imagedir.joinpath(f"flight_{flight_num}_follow.json")
+
+
+def write_summary(imagedir: Path, flight_num: int, summary: dict):
+    imagedir.mkdir(parents=True, exist_ok=True)
+    with open(summary_path(imagedir, flight_num), "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+def read_summary(imagedir: Path, flight_num: int, flight: Flight = None) -> dict | None:
+    """ Returns the saved summary of a flight, or None if there is none (or it is for a different flight
+    than the one given) """
+    try:
+        with open(summary_path(imagedir, flight_num), "r") as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if flight is not None and summary.get("flight") != flight_dict(flight):
+        return None
+    return summary
+
+
+def find_event(summary: dict, name: str):
+    """ Returns the time (ms) of the first event with a name in a flight summary, or None """
+    for event in summary.get("events", []):
+        if event["name"] == name:
+            return event["time"]
+    return None
+
+
+def block_stats_summary(flight: Flight, num_blocks: int, block_type_counts: Counter, spacer_bytes: int,
+                        first_time: float, last_time: float) -> dict:
+    """ Summary of what parse_flight (or a metadata scan) counts while reading blocks """
+    return {
+        "flight": flight_dict(flight),
+        "num_blocks": num_blocks,
+        "block_type_counts": dict((cls.__name__, count) for cls, count in block_type_counts.items()),
+        "spacer_bytes": spacer_bytes,
+        "first_time": first_time,
+        "last_time": last_time,
+    }
+
+
+def scan_flight(file, part_offset: int, flight: Flight) -> dict:
+    """ Summarises a flight from its block headers alone """
+    block_type_counts = Counter()
+    spacer_bytes = 0
+    num_blocks = 0
+    first_time = None
+    last_time = None
+    for _, block_class, block_type, block_length, mission_time in gen_block_headers(file, part_offset, flight):
+        num_blocks += 1
+        cls = SDBlock.lookup_class(block_class, block_type)
+        if cls is None:
+            continue
+        block_type_counts[cls] += 1
+        if cls == LoggingMetadataSpacerBlock:
+            spacer_bytes += block_length
+        if mission_time is not None:
+            last_time = mt_to_ms(mission_time)
+            if first_time is None:
+                first_time = last_time
+
+    summary = block_stats_summary(flight, num_blocks, block_type_counts, spacer_bytes, first_time, last_time)
+    summary["scanned"] = True
+    return summary
+
+
+def load_or_scan_summary(file, imagedir: Path, part_offset: int, flight_num: int, flight: Flight) -> dict:
+    """ Loads the saved summary of a flight, scanning its headers (and saving the result) if there is none """
+    summary = read_summary(imagedir, flight_num, flight)
+    if summary is None:
+        summary = scan_flight(file, part_offset, flight)
+        write_summary(imagedir, flight_num, summary)
+    return summary
+
+
+def format_summary(summary: dict) -> str:
+    """ Human readable overview of a flight summary """
+    lines = []
+    if summary.get("first_time") is not None:
+        duration = (summary["last_time"] - summary["first_time"]) / 1000
+        lines.append(f"Mission time: {summary['first_time'] / 1000:.3f} s to {summary['last_time'] / 1000:.3f} s "
+                     f"({duration:.3f} s)")
+    lines.append(f"Blocks: {summary['num_blocks']}, spacer bytes: {summary['spacer_bytes']}")
+    for name, count in sorted(summary["block_type_counts"].items()):
+        lines.append(f"    {name}: {count}")
+
+    sensors = summary.get("sensors", {})
+    for stream, stats in sensors.items():
+        lines.append(f"{stream}: {stats['samples']} samples")
+    if "altitude" in sensors:
+        lines.append(f"Max altitude: {sensors['altitude']['max']['altitude']} m")
+    if "kx134_accelerometer" in sensors:
+        lines.append(f"Max acceleration: {sensors['kx134_accelerometer']['max_magnitude']:.2f} g")
+    for event in summary.get("events", []):
+        if event["name"] != "deployment_state":
+            lines.append(f"{event['name'].capitalize()}: {event['time'] / 1000:.3f} s ({event['detail']})")
+
+    if summary.get("scanned"):
+        lines.append("(from block headers only, parse the flight for sensor values and events)")
+    return "\n".join(lines)
+
+
+class SensorStatsHandler(BlockHandler):
+    """ Counts the samples of each sensor stream and tracks the min and max of each of their values """
+    block_types = TimelineHandler.block_types
+
+    def __init__(self):
+        self.stats = dict()
+
+    def consume_batch(self, blocks):
+        for block in blocks:
+            for _, stream, values in gen_block_samples(block):
+                stats = self.stats.get(stream)
+                if stats is None:
+                    stats = self.stats[stream] = [0, list(values), list(values), 0.0]
+                stats[0] += 1
+                mins = stats[1]
+                maxs = stats[2]
+                for i, v in enumerate(values):
+                    if v < mins[i]:
+                        mins[i] = v
+                    elif v > maxs[i]:
+                        maxs[i] = v
+                if stream in ("kx134_accelerometer", "acceleration"):
+                    stats[3] = max(stats[3], math.sqrt(sum(v * v for v in values)))
+
+    def state(self):
+        return {"stats": self.stats}
+
+    def resume(self, flightdir: Path, state):
+        self.stats = state["stats"]
+
+    def summary(self) -> dict:
+        sensors = dict()
+        for stream, (samples, mins, maxs, max_magnitude) in self.stats.items():
+            fields = STREAM_FIELDS[stream]
+            sensors[stream] = {"samples": samples, "min": dict(zip(fields, mins)), "max": dict(zip(fields, maxs))}
+            if stream in ("kx134_accelerometer", "acceleration"):
+                sensors[stream]["max_magnitude"] = max_magnitude
+        return {"sensors": sensors}
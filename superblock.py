@@ -1,10 +1,16 @@
 #! /usr/bin/env python3
-import os
 import struct
 import datetime
 import sys
 from datetime import datetime
 
+from mbr import MBR
+
+# Type of the MBR partitions holding CU InSpace data
+CUINSPACE_PARTITION_TYPE = 0x89
+# Most flights a superblock can list
+MAX_FLIGHTS = 32
+
 
 class Flight:
     def __init__(self, first_block: int, num_blocks: int, timestamp: int):
@@ -33,6 +39,11 @@ class Flight:
         return False if self.first_block == 0 or self.num_blocks == 0 or self.timestamp == 0 else True
 
 
+def flight_dict(flight: Flight) -> dict:
+    """ A flight's superblock entry as a dict, saved with outputs to tell which flight they are for """
+    return {"first_block": flight.first_block, "num_blocks": flight.num_blocks, "timestamp": flight.timestamp}
+
+
 class SuperBlock:
     MAGIC = b'CUInSpac'
 
@@ -65,7 +76,7 @@ class SuperBlock:
 
         flights = list()
         flight_blocks = 1
-        for i in range(32):
+        for i in range(MAX_FLIGHTS):
             flight_start = 0x60 + (12 * i)
             flight_entry = block[flight_start:flight_start + 12]
             flight_obj = Flight.from_bytes(flight_entry)
@@ -91,7 +102,9 @@ class SuperBlock:
         block[0x1f8:0x200] = SuperBlock.MAGIC
         return block
 
-    def output(self, output_dd_cmd: bool = False):
+    def output(self, output_dd_cmd: bool = False, summaries: list[str] = None, last_block: int = None):
+        """ Prints the superblock, with a summary under each flight if given. The dd command copies up to
+        last_block if given (the end of the written data found by extract.py), or else the last flight. """
         print(f"Superblock Version: {self.version}")
         print(f"First flight continued from previous partition: {'yes' if self.continued else 'no'}")
         print(f"Partition length: {self.partition_length}")
@@ -100,29 +113,86 @@ class SuperBlock:
         flight_blocks = 0
         for i, flight in enumerate(self.flights):
             print(f"Flight {i} -> start: {flight.first_block}, length: {flight.num_blocks}, time: {flight.timestamp}")
+            if summaries is not None and summaries[i] is not None:
+                print("    " + summaries[i].replace("\n", "\n    "))
             flight_blocks = flight.first_block + flight.num_blocks
         print()
 
         if output_dd_cmd:
+            if last_block is not None:
+                flight_blocks = max(flight_blocks, last_block)
             print(f"Last block: {flight_blocks}")
             print(f"To copy full SD card image, use:    dd if=[disk] of=full bs=512 count={flight_blocks + 2049}")
 
 
+def superblock_sector(file) -> int | None:
+    """ Sector the superblock of an SD card image or mission file should be in: the start of the image's
+    CU InSpace partition, or 0 if it has no MBR (a mission file). None if its MBR has no CU InSpace
+    partition. """
+    file.seek(0)
+    try:
+        mbr = MBR(file.read(512))
+    except ValueError:
+        return 0
+    return next((part.first_sector_lba for part in mbr.partitions if part.type == CUINSPACE_PARTITION_TYPE),
+                None)
+
+
+def find_superblock(file) -> int | None:
+    """ Sector of the superblock in an SD card image or mission file, or None if it has none """
+    addr = superblock_sector(file)
+    if addr is None:
+        return None
+
+    file.seek(addr * 512)
+    try:
+        SuperBlock.from_bytes(file.read(512))
+    except ValueError:
+        return None
+    return addr
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         # No arguments
         exit(0)
 
-    # File size
+    from mission_v2 import open_mission
+
     infile = sys.argv[1]
-    file_size = os.stat(infile).st_size
+    with open_mission(infile) as f:
+        # Size of the data in the file (compressed mission files are read as if they weren't)
+        file_size = f.seek(0, 2)
 
-    with open(infile, "rb") as f:
         # Skip MBR and the rest of first sector to get to superblock
         # (512 bytes is just superblock, anything larger should be the full sd card image)
         # If it's a cuinspace telemetry file, first block is a superblock so don't skip.
+        superblock_addr = 0
         if ".mission" not in infile and file_size > 512:
-            f.seek(512 * 2048)
+            superblock_addr = 2048
+        f.seek(512 * superblock_addr)
         sb = SuperBlock.from_bytes(f.read(512))
 
-        sb.output(True)
+        # Summaries saved by telem-parser.py, if the flight data is here they can be found by a quick scan
+        from cuinspace_telemetry import image_dir
+        from summary import format_summary, load_or_scan_summary, read_summary
+
+        imagedir = image_dir(infile)
+        summaries = list()
+        for i, flight in enumerate(sb.flights):
+            if file_size > 512:
+                summary = load_or_scan_summary(f, imagedir, superblock_addr, i, flight)
+            else:
+                summary = read_summary(imagedir, i, flight)
+            summaries.append(format_summary(summary) if summary is not None else None)
+
+        # The dd command copies up to the end of the written data, which a flight that was still being logged
+        # when the power was lost carries on past
+        last_block = None
+        if superblock_addr != 0:
+            from extract import find_written_end
+
+            recorded_end = max((flight.first_block + flight.num_blocks for flight in sb.flights), default=1)
+            probe = find_written_end(f, superblock_addr + recorded_end, file_size // 512)
+            last_block = probe.written_end - superblock_addr
+        sb.output(True, summaries, last_block)
@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+# Non-interactive command line interface for processing many SD card images and mission files in one go,
+# for scripts and scheduled jobs (telem-parser.py asks what to do interactively).
+#
+# Each subcommand takes any number of files, which are processed in parallel by worker processes
+# (--workers, one per CPU by default), one file per worker at a time:
+#   info              prints each file's flights along with their summaries
+#   extract-mission   copies flights into a mission file, missions/<file>.mission by default
+#   parse             parses flights into CSV files in out/<file>, like telem-parser.py
+#   time-index        builds (or loads) the time index of each flight
+#
+# --flights selects the flights of each file (such as 0,2-3, all of them by default). Results are printed
+# as each file is done, as text or (--format json) one JSON object per line. What the parser prints while
+# working is kept in a log per file, which is printed with --verbose or if the file failed.
+#
+# Exit codes: 0 if every file was processed, 1 if any failed (unreadable, no superblock, no such flight),
+# 2 for invalid arguments and 130 if interrupted.
+#
+#   python3 telem-batch.py info cards/*.img
+#   python3 telem-batch.py parse cards/*.img --flights 0 --timeline 100 --workers 4 --format json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from cuinspace_telemetry import image_dir, read_superblock
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_INTERRUPTED = 130
+
+
+class BatchError(Exception):
+    """ A file that can't be processed, with a message for the user """
+    pass
+
+
+def parse_flight_list(text: str) -> list[int]:
+    """ Flight numbers from a list like 0,2-3 """
+    flights = set()
+    try:
+        for part in text.split(","):
+            first, _, last = part.strip().partition("-")
+            flights.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid flight list: {text}")
+    return sorted(flights)
+
+
+def select_flights(path, flights: list, selected: list[int] | None) -> list[int]:
+    if selected is None:
+        return list(range(len(flights)))
+    missing = [num for num in selected if num >= len(flights)]
+    if len(missing) != 0:
+        raise BatchError(f"No flight {','.join(str(num) for num in missing)} in {path}, it has {len(flights)}")
+    return selected
+
+
+def run_info(file, path, superblock_addr: int, superblock, selected: list[int], args) -> dict:
+    from summary import flight_dict, load_or_scan_summary
+
+    imagedir = image_dir(path, args.outdir)
+    return {"superblock_addr": superblock_addr, "version": superblock.version, "continued": superblock.continued,
+            "flights": [{"flight": i, **flight_dict(superblock.flights[i]),
+                         "summary": load_or_scan_summary(file, imagedir, superblock_addr, i, superblock.flights[i])}
+                        for i in selected]}
+
+
+def run_extract_mission(file, path, superblock_addr: int, superblock, selected: list[int], args) -> dict:
+    from cuinspace_telemetry import create_telemetry_mission
+
+    if args.name is not None:
+        name, missions_dir = args.name, args.missions_dir
+    else:
+        # Under the file's folders like its outputs, so files with the same name in different folders don't
+        # overwrite each other's missions
+        name = Path(path).name
+        missions_dir = image_dir(Path(path).parent, args.missions_dir or Path.cwd().joinpath("missions"))
+    mission = create_telemetry_mission(file, name, superblock_addr, [superblock.flights[i] for i in selected],
+                                       missions_dir)
+    if args.compress:
+        from mission_v2 import compress_mission
+
+        v1 = mission.with_name(mission.name + ".v1")
+        mission.rename(v1)
+        try:
+            compress_mission(v1, mission)
+        finally:
+            v1.unlink()
+    return {"mission": str(mission), "flights": selected, "bytes": mission.stat().st_size}
+
+
+def run_parse(file, path, superblock_addr: int, superblock, selected: list[int], args) -> dict:
+    from cuinspace_telemetry import make_handler_factories, parse_flights
+    from summary import read_summary
+
+    memory = None
+    if args.memory_limit is not None:
+        from memory_budget import MemoryBudget
+
+        memory = MemoryBudget(int(args.memory_limit * 1024 ** 2))
+    cache = None
+    if not args.no_cache:
+        from parse_cache import ParseCache
+
+        # Pruned once every file is done, so workers never evict entries that others are using
+        cache = ParseCache(args.cache_dir, max_size=sys.maxsize)
+
+    imagedir = image_dir(path, args.outdir)
+    imagedir.mkdir(parents=True, exist_ok=True)
+    handler_factories = make_handler_factories(args.timeline, args.resample_method, args.downsample,
+                                               args.downsample_method, args.pyramid)
+    parse_flights(file, imagedir, superblock_addr, superblock.flights, selected, handler_factories,
+                  window=args.window, around=args.around, cache=cache, memory=memory)
+
+    flights = []
+    for i in selected:
+        summary = read_summary(imagedir, i, superblock.flights[i]) if args.window is None and args.around is None \
+            else None
+        flights.append({"flight": i, "summary": summary})
+    return {"outdir": str(imagedir), "flights": flights}
+
+
+def run_time_index(file, path, superblock_addr: int, superblock, selected: list[int], args) -> dict:
+    from time_index import index_path, load_or_build_index
+
+    imagedir = image_dir(path, args.outdir)
+    flights = []
+    for i in selected:
+        index = load_or_build_index(file, imagedir, superblock_addr, i, superblock.flights[i])
+        flights.append({"flight": i, "entries": len(index.offsets), "stride_sectors": index.stride_sectors,
+                        "path": str(index_path(imagedir, i))})
+    return {"flights": flights}
+
+
+RUNNERS = {
+    "info": run_info,
+    "extract-mission": run_extract_mission,
+    "parse": run_parse,
+    "time-index": run_time_index,
+}
+
+
+def run_file(path: str, args) -> dict:
+    """ Runs a command on one file, returns its result (with "ok", and "error" if it failed) and the log of
+    what was printed while running it """
+    from partitions import open_image
+
+    result = {"file": path, "command": args.command}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            buffer_size = -1
+            if getattr(args, "memory_limit", None) is not None:
+                from memory_budget import MemoryBudget
+
+                buffer_size = MemoryBudget(int(args.memory_limit * 1024 ** 2)).reader_bytes
+            with open_image(path, buffer_size=buffer_size) as file:
+                try:
+                    superblock_addr, superblock = read_superblock(file)
+                except ValueError as e:
+                    raise BatchError(str(e))
+                selected = select_flights(path, superblock.flights, args.flights)
+                result.update(RUNNERS[args.command](file, path, superblock_addr, superblock, selected, args))
+        result["ok"] = True
+    except (BatchError, OSError, ValueError) as e:
+        result["ok"] = False
+        result["error"] = str(e)
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+        log.write(traceback.format_exc())
+    result["log"] = log.getvalue()
+    return result
+
+
+def format_result(result: dict) -> str:
+    """ Human readable report of a file's result """
+    if not result["ok"]:
+        return f"{result['file']}: failed: {result['error']}"
+
+    from summary import format_summary
+
+    lines = [f"{result['file']}:"]
+    match result["command"]:
+        case "info":
+            lines[0] += (f" superblock at sector {result['superblock_addr']}, version {result['version']}, "
+                         f"{len(result['flights'])} flight{'s' if len(result['flights']) != 1 else ''}")
+            for flight in result["flights"]:
+                lines.append(f"Flight {flight['flight']} -> start: {flight['first_block']}, "
+                             f"length: {flight['num_blocks']}, time: {flight['timestamp']}")
+                lines.append("    " + format_summary(flight["summary"]).replace("\n", "\n    "))
+        case "extract-mission":
+            lines[0] += (f" flights {','.join(str(num) for num in result['flights'])} written to "
+                         f"{result['mission']} ({result['bytes']} bytes)")
+        case "parse":
+            lines[0] += f" flights {','.join(str(f['flight']) for f in result['flights'])} parsed into {result['outdir']}"
+        case "time-index":
+            for flight in result["flights"]:
+                lines.append(f"Flight {flight['flight']}: {flight['entries']} entries every "
+                             f"{flight['stride_sectors']} sectors, {flight['path']}")
+    return "\n".join(lines)
+
+
+def report(result: dict, args):
+    if args.verbose or not result["ok"]:
+        sys.stderr.write(result["log"])
+    if args.format == "json":
+        print(json.dumps(dict((k, v) for k, v in result.items() if k != "log")), flush=True)
+    else:
+        print(format_result(result), flush=True)
+
+
+def run_batch(args) -> int:
+    """ Runs a command on every file, reporting each as it is done, returns the exit code """
+    failed = 0
+    workers = min(args.workers or os.cpu_count() or 1, len(args.files))
+    if workers == 1:
+        for path in args.files:
+            result = run_file(path, args)
+            failed += not result["ok"]
+            report(result, args)
+    else:
+        executor = ProcessPoolExecutor(workers)
+        try:
+            for future in as_completed([executor.submit(run_file, path, args) for path in args.files]):
+                result = future.result()
+                failed += not result["ok"]
+                report(result, args)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    if args.command == "parse" and not args.no_cache:
+        from parse_cache import ParseCache
+
+        ParseCache(args.cache_dir, int(args.cache_size * 1024 ** 2)).prune(int(args.cache_size * 1024 ** 2))
+    return EXIT_OK if failed == 0 else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    from parse_cache import CACHE_DIR, MAX_CACHE_SIZE
+
+    arg_parser = argparse.ArgumentParser(description="Process CU InSpace SD card images and mission files without "
+                                                     "prompts.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("files", nargs="+", help="SD card images or mission files")
+    common.add_argument("--flights", type=parse_flight_list, metavar="LIST",
+                        help="flights to process, such as 0,2-3 (default: all)")
+    common.add_argument("--workers", type=int, help="files processed at once (default: one per CPU)")
+    common.add_argument("--format", choices=("text", "json"), default="text",
+                        help="print results as text or as a JSON object per line (default: text)")
+    common.add_argument("--outdir", type=Path, help="folder for the outputs of each file (default: ./out)")
+    common.add_argument("--verbose", action="store_true", help="print what the parser prints for each file")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("info", parents=[common], help="print the flights of each file with their summaries")
+
+    mission_parser = subparsers.add_parser("extract-mission", parents=[common],
+                                           help="copy flights into a mission file")
+    mission_parser.add_argument("--name", help="mission name, only with one file, written straight to the missions "
+                                               "folder (default: the file's path)")
+    mission_parser.add_argument("--missions-dir", type=Path, help="where mission files go (default: ./missions)")
+    mission_parser.add_argument("--compress", action="store_true", help="write version 2 (compressed) mission files")
+
+    parse_parser = subparsers.add_parser("parse", parents=[common], help="parse flights into CSV files")
+    window_group = parse_parser.add_mutually_exclusive_group()
+    window_group.add_argument("--window", nargs=2, type=float, metavar=("T0", "T1"),
+                              help="only parse telemetry with a mission time between T0 and T1 (ms)")
+    window_group.add_argument("--around", nargs=3, metavar=("EVENT", "BEFORE", "AFTER"),
+                              help="only parse telemetry from BEFORE ms before to AFTER ms after an event found by "
+                                   "a previous full parse")
+    parse_parser.add_argument("--timeline", nargs="?", type=float, const=0, metavar="RATE",
+                              help="also write timeline.csv, resampled to RATE Hz if given")
+    parse_parser.add_argument("--resample-method", choices=("hold", "linear"), default="hold",
+                              help="how the timeline is resampled (default: hold)")
+    parse_parser.add_argument("--downsample", type=int, metavar="POINTS",
+                              help="also write downsampled KX134 and MPU9250 outputs (requires NumPy)")
+    parse_parser.add_argument("--downsample-method", choices=("lttb", "minmax"), default="lttb",
+                              help="how the outputs are downsampled (default: lttb)")
+    parse_parser.add_argument("--pyramid", action="store_true",
+                              help="also build pyramids of the KX134 and MPU9250 data (requires NumPy)")
+    parse_parser.add_argument("--no-cache", action="store_true", help="don't reuse or cache parsed flights")
+    parse_parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR,
+                              help="where parsed flights are cached (default: ./cache)")
+    parse_parser.add_argument("--cache-size", type=float, default=MAX_CACHE_SIZE / 1024 ** 2, metavar="MB",
+                              help=f"size the cache is pruned to at the end (default: {MAX_CACHE_SIZE // 1024 ** 2} MB)")
+    parse_parser.add_argument("--memory-limit", type=float, metavar="MB",
+                              help="keep the memory used by each worker's parse under about MB megabytes")
+
+    subparsers.add_parser("time-index", parents=[common], help="build the time index of each flight")
+    args = arg_parser.parse_args()
+
+    if args.workers is not None and args.workers < 1:
+        arg_parser.error("--workers must be at least 1")
+    if args.command == "extract-mission" and args.name is not None and len(args.files) > 1:
+        arg_parser.error("--name can only be used with one file")
+    if getattr(args, "memory_limit", None) is not None:
+        from cuinspace_telemetry import make_handler_factories
+        from memory_budget import MemoryBudget
+
+        handler_factories = make_handler_factories(args.timeline, args.resample_method, args.downsample,
+                                                   args.downsample_method, args.pyramid)
+        try:
+            memory = MemoryBudget(int(args.memory_limit * 1024 ** 2))
+            memory.for_handlers([factory() for factory in handler_factories])
+        except ValueError as e:
+            arg_parser.error(str(e))
+
+    try:
+        sys.exit(run_batch(args))
+    except KeyboardInterrupt:
+        sys.exit(EXIT_INTERRUPTED)
+    except BrokenPipeError:
+        # Output piped to something that stopped reading, like head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(EXIT_FAILED)
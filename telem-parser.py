@@ -1,355 +1,115 @@
 #! /usr/bin/env python3
-import datetime
-import os
+# Command line interface of the parser, see cuinspace_telemetry.py for the library it is built on.
+
+import argparse
 import sys
-from collections import Counter
 from pathlib import Path
-from typing import BinaryIO
-
-from mbr import MBR
-from superblock import SuperBlock, Flight
-from sd_block import *
-from data_block import *
-
-MISSION_EXTENSION = "mission"
-
-
-def mt_to_ms(mt):
-    """ Convert mission time to milliseconds """
-    return mt * (1000 / 1024)
-
-
-class ParsingException(Exception):
-    pass
-
-
-def write_row(file, data, header=False):
-    wrap = '' if header else ''
-    file.write(",".join(wrap + i + wrap for i in data.columns) + "\n")
-
-
-def log_diag_message(block, outfile, index):
-    """ DiagnosticDataLogMessageBlock and DebugMessageDataBlock """
-    outfile.write(str(block))
-    outfile.write("\n")
-
-
-def log_diag_radio(block, outfile, index):
-    """ DiagnosticDataOutgoingRadioPacketBlock and DiagnosticDataIncomingRadioPacketBlock """
-    print(f"Log diag radio not yet implemented: {block}")
-
-
-def log_altitude(block, outfile, index):
-    """ AltitudeDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),Pressure (Pa),Temperature (C),Altitude (m)\n')
-    d = block.data
-    outfile.write(f"{mt_to_ms(d.mission_time)},{d.pressure},{d.temperature},{d.altitude}\n")
-
-
-def log_gnss_loc(block, outfile, index):
-    """ GNSSLocationBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),Latitude,Longitude,UTC Time,Altitude (m),'
-                      'Speed (knots),Course (degs),PDOP,HDOP,VDOP,Sats in Fix,Fix Type\n')
-    d = block.data
-    outfile.write(f"{mt_to_ms(d.mission_time)},{d.latitude / 600000},"
-                  f"{d.longitude / 600000},{d.utc_time},{d.altitude},"
-                  f"{d.speed},{d.course},{d.pdop},{d.hdop},{d.vdop},{d.sats},{d.fix_type}\n")
-
-
-def log_gnss_meta(block, outfile, index):
-    """ GNSSMetadataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),GPS sats in use,GLONASS sats in use, Sats in view\n')
-    d = block.data
-
-    # Alternative sats_in_view output
-    # sat_string = ""
-    # for sat in d.sats_in_view:
-    #     sat_string += ' '.join(str(item) for item in list(dict(sat).values())) + " "
-
-    outfile.write(f"{mt_to_ms(d.mission_time)},[{' '.join(str(num) for num in d.gps_sats_in_use)}],"
-                  f"[{' '.join(str(num) for num in d.glonass_sats_in_use)}],"
-                  f"[{' '.join(str(sat.identifier) for sat in d.sats_in_view)}]\n")
-
-
-def log_kx134(block, outfile, index):
-    """ KX134AccelerometerDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),ODR (Hz),Range (g),LPF Rolloff (ODR/x),'
-                      'Resolution (bits),X (g),Y (g),Z (g)\n')
-    d = block.data
-    for time, x, y, z in block.data.gen_samples():
-        outfile.write(f"{time},{d.odr.samples_per_sec},{d.accel_range.acceleration},"
-                      f"{'9' if d.rolloff == KX134LPFRolloff.ODR_OVER_9 else '2'},"
-                      f"{d.resolution.bits},{x},{y},{z}\n")
-
-
-def log_mpu9250(block, outfile, index):
-    """ MPU9250IMUDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),Accel/Gyro Sample Rate (Hz),Mag Sample Rate (Hz),'
-                      'Accel FSR (g),Gyro FSR (deg/s),Accel Bandwidth (Hz),Gyro '
-                      'Bandwidth,Accel X (g),Accel Y (g),Accel Z (g),Gyro X (dps),'
-                      'Gyro Y (dps),Gyro Z (dps),Mag X (uT),Mag Y (uT),Mag Z '
-                      '(uT),Mag Overflow,Mag Res (bits),Temperature (C)\n')
-    d = block.data
-    for time, s in block.data.gen_samples():
-        outfile.write(f"{time},{d.ag_sample_rate},{d.mag_sample_rate.samples_per_sec},"
-                      f"{d.accel_fsr.acceleration},{d.gyro_fsr.angular_velocity},"
-                      f"{d.accel_bw.bandwidth},{d.gyro_bw.bandwidth},{s.accel_x},"
-                      f"{s.accel_y},{s.accel_z},{s.gyro_x},{s.gyro_y},{s.gyro_z},{s.mag_x},"
-                      f"{s.mag_y},{s.mag_z},{s.mag_ovf},{s.mag_res.bits},{s.temperature}\n")
-
-
-def log_status(block, outfile, index):
-    """ StatusDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),KX134 State,Altimeter State,IMU State,'
-                      'SD Card Driver State,Deployment State,SD Blocks Recorded,'
-                      'SD Checkouts Missed\n')
-    d = block.data
-    outfile.write(f"{mt_to_ms(d.mission_time)},{str(d.kx134_state)},{str(d.alt_state)},"
-                  f"{str(d.imu_state)},{str(d.sd_state)},{str(d.deployment_state)},"
-                  f"{d.sd_blocks_recorded},{d.sd_checkouts_missed}\n")
-
-
-def log_acceleration(block, outfile, index):
-    """ AccelerationDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),FSR (g),X (g),Y (g),Z (g)\n')
-    d = block.data
-    outfile.write(f"{mt_to_ms(d.mission_time)},{d.fsr},{d.x},{d.y},{d.z}\n")
-
-
-def log_angular_velocity(block, outfile, index):
-    """ AngularVelocityDataBlock """
-    if index == 0:
-        # write header
-        outfile.write('Mission Time (ms),FSR (dps),X (dps),Y (dps),Z (dps)\n')
-    d = block.data
-    outfile.write(f"{mt_to_ms(d.mission_time)},{d.fsr},{d.x},{d.y},{d.z}\n")
-
-
-def sanitize_superblock(superblock: bytearray, flights_to_keep: list[Flight]):
-    """ Sanitizes the superblock by shifting flights and only keeping specified flights for telemetry mission """
-    flight_blocks_stored = 1
-    # Loop over every flight spot
-    for i in range(32):
-        # Location of flight struct in superblock
-        flight_start = 0x60 + (12 * i)
-
-        # Zero out unused flight data holders
-        if len(flights_to_keep) == 0:
-            superblock[flight_start:flight_start + 12] = b'\x00' * 12
-            continue
-
-        # Shift flight block numbering to properly match
-        flight = flights_to_keep[0]
-        flight.first_block = flight_blocks_stored
-        flight_blocks_stored += flight.num_blocks
-
-        # Output adjusted flight to superblock
-        superblock[flight_start:flight_start + 12] = flight.to_bytes()
-
-        # Remove flight shifted
-        flights_to_keep.pop(0)
-    return superblock
-
-
-def create_telemetry_mission(file: BinaryIO, mission_filename: str, superblock_addr: int,
-                             flights_list: list[Flight]):
-    """ CONSTRUCT TELEMETRY MISSION FILE FROM SD CARD IMAGE FILE """
-    """ FIRST BLOCK IS A SUPERBLOCK, FOLLOWED BY SD DATA BLOCKS """
 
-    missions_dir = Path.cwd().joinpath("missions")
-    missions_dir.mkdir(parents=True, exist_ok=True)
-    output_file_path = missions_dir.joinpath(f"{mission_filename}.{MISSION_EXTENSION}")
+from cuinspace_telemetry import (create_telemetry_mission, image_dir, make_handler_factories, parse_flights,
+                                 read_superblock)
+from memory_budget import MemoryBudget
+from partitions import StitchedImage, open_image
+from parse_cache import CACHE_DIR, MAX_CACHE_SIZE, ParseCache
+from summary import format_summary, load_or_scan_summary
+from superblock import Flight
 
-    # Generates the new telemetry mission file
-    with open(output_file_path, "wb") as outfile:
-        # Sanitize superblock
-        file.seek(superblock_addr * 512)
-        new_sb = sanitize_superblock(bytearray(file.read(512)), flights_list.copy())
-        outfile.write(new_sb)
-
-        # Show user the new flight details
-        print("NEW TELEMETRY FLIGHT DETAILS")
-        SuperBlock.from_bytes(new_sb).output()
-
-        # Output corresponding flight blocks to output file
-        for flight_to_copy in flights_list:
-            file.seek((superblock_addr + flight_to_copy.first_block) * 512)
-
-            # Copy each block to new file
-            for i in range(flight_to_copy.num_blocks):
-                outfile.write(file.read(512))
-
-
-block_handlers = {
-    LoggingMetadataSpacerBlock: (None, None),
-    DiagnosticDataLogMessageBlock: (log_diag_message, "log_messages"),
-    DebugMessageDataBlock: (log_diag_message, "log_messages"),
-    DiagnosticDataOutgoingRadioPacketBlock: (log_diag_radio, "outgoing_radio_packets"),
-    DiagnosticDataIncomingRadioPacketBlock: (log_diag_radio, "incoming_radio_packets"),
-    AltitudeDataBlock: (log_altitude, "altitude"),
-    GNSSLocationBlock: (log_gnss_loc, "gnss_location"),
-    GNSSMetadataBlock: (log_gnss_meta, "gnss_metadata"),
-    KX134AccelerometerDataBlock: (log_kx134, "kx134_accelerometer"),
-    MPU9250IMUDataBlock: (log_mpu9250, "mpu9250_imu"),
-    StatusDataBlock: (log_status, "status"),
-    AccelerationDataBlock: (log_acceleration, "acceleration"),
-    AngularVelocityDataBlock: (log_angular_velocity, "angular_velocity"),
-}
-
-
-def gen_blocks(file, first_block, num_blocks):
-    # Seek to start of flight
-    count = 0
-
-    while count <= ((num_blocks * 512) - 4):
-        header = file.read(4)
-
-        try:
-            block_length = SDBlock.parse_length(header)
-
-        except SDBlockException:
-            # END OF FILE EXCEPTION
-            # print(count, ((num_blocks * 512) - 4), block_length, num_blocks*512)
-            return
-
-        count = count + block_length
-        if count > (num_blocks * 512):
-            raise ParsingException(f"Read block of length {block_length} would read {count} bytes "
-                                   f"from {num_blocks * 512} byte flight")
-        try:
-            block = header + file.read(block_length - 4)
-
-            yield SDBlock.from_bytes(block), block
-        except ValueError:
-            print("READ LENGTH MUST BE NON-NEG OR -1", header, block_length, block_length - 4)
-            return
-        # print(block.hex().upper())
-        #        print(SDBlock.from_bytes(block))
-
-
-
-def parse_flight(file, imagedir: Path, part_offset, flight_num, flight):
-    print(f"############### Flight {flight_num} ###############")
-    print(f"Starts at block: {flight.first_block}, {flight.num_blocks} "
-          f"block{'s' if flight.num_blocks != 1 else ''} long, time: {flight.timestamp}")
+if len(sys.argv) < 2:
+    # No arguments
+    exit(0)
 
-    # Create flight
-    flightdir = imagedir.joinpath(f"flight_{flight_num}")
+arg_parser = argparse.ArgumentParser(description="Parse CU InSpace telemetry from an SD card image or mission file.")
+arg_parser.add_argument("infile", help="SD card image or mission file")
+arg_parser.add_argument("--window", nargs=2, type=float, metavar=("T0", "T1"),
+                        help="only parse telemetry with a mission time between T0 and T1 (ms)")
+arg_parser.add_argument("--around", nargs=3, metavar=("EVENT", "BEFORE", "AFTER"),
+                        help="only parse telemetry from BEFORE ms before to AFTER ms after an event (launch, "
+                             "burnout, apogee or landing) found by a previous full parse")
+arg_parser.add_argument("--timeline", nargs="?", type=float, const=0, metavar="RATE",
+                        help="also write all sensor samples to one time ordered timeline.csv, resampled to "
+                             "RATE Hz if given")
+arg_parser.add_argument("--resample-method", choices=("hold", "linear"), default="hold",
+                        help="how the timeline is resampled (default: hold)")
+arg_parser.add_argument("--downsample", type=int, metavar="POINTS",
+                        help="also write copies of the KX134 and MPU9250 outputs downsampled to about POINTS "
+                             "points for plotting (requires NumPy)")
+arg_parser.add_argument("--downsample-method", choices=("lttb", "minmax"), default="lttb",
+                        help="how the outputs are downsampled (default: lttb)")
+arg_parser.add_argument("--pyramid", action="store_true",
+                        help="also build min/max/mean pyramids of the KX134 and MPU9250 data for zooming "
+                             "(requires NumPy)")
+arg_parser.add_argument("--no-cache", action="store_true",
+                        help="always parse flights from scratch rather than reusing cached outputs")
+arg_parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR,
+                        help="where parsed flights are cached (default: ./cache)")
+arg_parser.add_argument("--cache-size", type=float, default=MAX_CACHE_SIZE / 1024 ** 2, metavar="MB",
+                        help=f"size the cache is pruned to after each parse (default: {MAX_CACHE_SIZE // 1024 ** 2} MB)")
+arg_parser.add_argument("--profile", nargs="?", type=Path, const=Path("profile.json"), metavar="PATH",
+                        help="time reading, decoding and each handler, print a breakdown for each flight and save "
+                             "it as JSON to PATH in the output folder (default: profile.json), parsing flights "
+                             "rather than using cached outputs")
+arg_parser.add_argument("--cprofile", action="store_true",
+                        help="run each flight's parse under cProfile and save its stats to flight_N.pstats in "
+                             "the output folder")
+arg_parser.add_argument("--no-progress", action="store_true",
+                        help="don't show progress while parsing (it is shown when stderr is a terminal)")
+arg_parser.add_argument("--progress-json", metavar="PATH",
+                        help="append progress reports as JSON lines to PATH (- for stdout)")
+arg_parser.add_argument("--memory-limit", type=float, metavar="MB",
+                        help="keep the memory used by each flight's parse under about MB megabytes, sizing "
+                             "buffers, batches and the time index to fit")
+args = arg_parser.parse_args()
+
+handler_factories = make_handler_factories(args.timeline, args.resample_method, args.downsample,
+                                           args.downsample_method, args.pyramid)
+# Profiling needs the flights to actually be parsed
+profiling = args.profile is not None or args.cprofile
+cache = None if args.no_cache or profiling else ParseCache(args.cache_dir, int(args.cache_size * 1024 ** 2))
+profiles = dict()
+memory = None
+if args.memory_limit is not None:
     try:
-        flightdir.mkdir(parents=True, exist_ok=False)
-    except FileExistsError:
-        print(f"Flight {i} has already been parsed. Not parsing again.")
-        return
-
-    # Open output files for writing
-    outfiles = dict((k, open(os.path.join(flightdir, f"{v[1]}.csv"), "w")) for (k, v) in
-                    block_handlers.items() if v[1] is not None)
-
-    # Read blocks and record data
-    block_type_counts = Counter()
-    spacer_bytes = 0
-    num_blocks = 0
-    total_bytes = 0
-    first_time = None
-    last_time = None
-
-    file.seek((part_offset + flight.first_block) * 512)
-
-    for block, rawblock in gen_blocks(file, flight.first_block, flight.num_blocks):
-        num_blocks += 1
-
-        cls = type(block)
-        if cls == TelemetryDataBlock:
-            #print(num_blocks, block)
-            cls = type(block.data)
-
-            if first_time is None:
-                first_time = mt_to_ms(block.data.mission_time)
-
-            last_time = mt_to_ms(block.data.mission_time)
-
-        # Increment count for block type
-        block_type = (type(block), cls)
-        index = block_type_counts[block_type]
-
-        block_type_counts[block_type] = index + 1
-
-        # If this is a spacer, add to the total
-        if cls == LoggingMetadataSpacerBlock:
-            spacer_bytes += block.length
-
-        try:
-            handler = block_handlers[cls][0]
-            handler_name = block_handlers[cls][1]
-
-            if handler is not None:
-                handler(block, outfiles[cls], index)
-
+        memory = MemoryBudget(int(args.memory_limit * 1024 ** 2))
+        # Fail now rather than at the first flight if the handlers' state doesn't fit
+        memory.for_handlers([factory() for factory in handler_factories])
+    except ValueError as e:
+        exit(str(e))
 
-        except KeyError as e:
-            print(f"No handler for block of type {e.args[0].type_desc()}")
+show_progress = not args.no_progress and sys.stderr.isatty()
+progress_json = None
+if args.progress_json == "-":
+    progress_json = sys.stdout
+elif args.progress_json is not None:
+    progress_json = open(args.progress_json, "a")
 
-    # Close output files
-    for f in outfiles.values():
-        f.close()
 
-    print(f"Read {num_blocks} entries, output to {flightdir}.")
+def flight_progress(flight_num: int, flight: Flight):
+    if not show_progress and progress_json is None:
+        return None
+    from progress import Progress
 
+    return Progress(flight.num_blocks * 512, f"Flight {flight_num}", out=sys.stderr if show_progress else None,
+                    json_out=progress_json)
 
-if len(sys.argv) < 2:
-    # No arguments
-    exit(0)
 
-infile = sys.argv[1]
+infile = args.infile
 # Create output directory
-outdir = Path.cwd().joinpath("out")
-outdir.mkdir(parents=True, exist_ok=True)
-
-image_directory = outdir.joinpath(infile)
+image_directory = image_dir(infile)
 image_directory.mkdir(parents=True, exist_ok=True)
 
 # Read input file
-with open(infile, "rb") as file:
-    # Read MBR
-    superblock_addr = None
+with open_image(infile, buffer_size=memory.reader_bytes if memory is not None else -1) as file:
     try:
-        mbr = MBR(file.read(512))
+        superblock_addr, sb = read_superblock(file)
     except ValueError as e:
+        exit(str(e))
+    if isinstance(file, StitchedImage):
+        print(f"Found {len(file.partitions)} CUInSpace partitions, flights continued across them are joined.")
+    elif superblock_addr == 0:
         print("No valid MBR found, assuming that first block is superblock.")
-        superblock_addr = 0
-    else:
-        # Look for a valid partition
-        for part in mbr.partitions:
-            if part.type == 0x89:
-                superblock_addr = part.first_sector_lba
-                break
-
-        if superblock_addr is None:
-            exit("No CUInSpace partition found in MBR.")
-
-    # Parse superblock
-    file.seek(superblock_addr * 512)
-    try:
-        sb = SuperBlock.from_bytes(file.read(512))
-    except ValueError:
-        exit("Could not parse superblock.")
 
-    # Output superblock
-    sb.output()
+    # Output superblock with a summary of each flight
+    sb.output(summaries=[format_summary(load_or_scan_summary(file, image_directory, superblock_addr, i, flight))
+                         for i, flight in enumerate(sb.flights)])
 
     cmd = 0
     flights_selected = list(range(len(sb.flights)))
@@ -391,8 +151,15 @@ with open(infile, "rb") as file:
                     print("No flights selected. Please select at least one flight.")
                 else:
                     # Parse each selected flight
-                    for i, flight in enumerate(sb.flights):
-                        if int(i) in flights_selected:
-                            parse_flight(file, image_directory, superblock_addr, i, flight)
+                    parse_flights(file, image_directory, superblock_addr, sb.flights, flights_selected,
+                                  handler_factories, window=args.window, around=args.around, cache=cache,
+                                  memory=memory, progress=flight_progress,
+                                  profiles=profiles if args.profile is not None else None, cprofile=args.cprofile)
+                    if args.profile is not None and len(profiles) != 0:
+                        from profiling import write_profile
+
+                        write_profile(image_directory.joinpath(args.profile),
+                                      dict((n, p) for n, p in profiles.items() if p is not None))
+                        print(f"Profile saved to {image_directory.joinpath(args.profile)}")
                     print("########################################")
                     print(f"Successfully parsed flights selected [{','.join(str(num) for num in flights_selected)}]\n")
@@ -0,0 +1,128 @@
+# Sparse index of mission time by position in a flight, used to seek close to a time without parsing
+# everything before it.
+
+import json
+import struct
+from bisect import bisect_right
+from pathlib import Path
+
+from misc.converter import mt_to_ms
+from sd_block import SDBlock, SDBlockClass
+from superblock import Flight, flight_dict
+
+# Default number of sectors covered by each index entry
+INDEX_STRIDE_SECTORS = 64
+
+
+def gen_block_headers(file, part_offset: int, flight: Flight):
+    """ Generates (offset in flight, block class, block type, length, mission time) for each block in a flight
+    by walking the block headers. Only the mission time of telemetry data blocks is read, it is None for
+    other blocks, and the rest of each payload is skipped. """
+    flight_bytes = flight.num_blocks * 512
+    file.seek((part_offset + flight.first_block) * 512)
+
+    count = 0
+    while count <= flight_bytes - 4:
+        header = file.read(4)
+        if len(header) < 4:
+            return
+        block_class, block_type, block_length = SDBlock.parse_header(header)
+        if block_length < 4 or count + block_length > flight_bytes:
+            return
+
+        if block_class == SDBlockClass.TELEMETRY_DATA and block_length >= 8:
+            mission_time = struct.unpack("<I", file.read(4))[0]
+            file.seek(block_length - 8, 1)
+        else:
+            mission_time = None
+            file.seek(block_length - 4, 1)
+        yield count, block_class, block_type, block_length, mission_time
+        count += block_length
+
+
+class TimeIndex:
+    def __init__(self, stride_sectors: int = INDEX_STRIDE_SECTORS, offsets: list[int] = None,
+                 times: list[float] = None, max_entries: int = None):
+        self.stride_sectors: int = stride_sectors
+        # If the index grows past max_entries, every other entry is dropped and the stride doubled
+        self.max_entries: int = max_entries
+        # Byte offset in the flight of the first block starting in a stride, and its mission time (ms)
+        self.offsets: list[int] = offsets if offsets is not None else []
+        self.times: list[float] = times if times is not None else []
+        # Offset after which the next block starts a new stride
+        self._next_boundary = 0
+        if len(self.offsets) != 0:
+            stride = self.stride_sectors * 512
+            self._next_boundary = ((self.offsets[-1] // stride) + 1) * stride
+
+    def add(self, offset: int, block_class: int, rawblock: bytes):
+        """ Records a block read at a byte offset in the flight, only used if it starts a new stride """
+        if offset < self._next_boundary or block_class != SDBlockClass.TELEMETRY_DATA or len(rawblock) < 8:
+            return
+        self._add(offset, struct.unpack("<I", rawblock[4:8])[0])
+
+    def _add(self, offset: int, mission_time: int):
+        self.offsets.append(offset)
+        self.times.append(mt_to_ms(mission_time))
+        if self.max_entries is not None and len(self.offsets) > self.max_entries:
+            self.offsets = self.offsets[::2]
+            self.times = self.times[::2]
+            self.stride_sectors *= 2
+        stride = self.stride_sectors * 512
+        self._next_boundary = ((offset // stride) + 1) * stride
+
+    @classmethod
+    def build(cls, file, part_offset: int, flight: Flight, stride_sectors: int = INDEX_STRIDE_SECTORS):
+        """ Builds the index by walking block headers, payloads are skipped rather than read """
+        index = TimeIndex(stride_sectors)
+        for offset, _, _, _, mission_time in gen_block_headers(file, part_offset, flight):
+            if mission_time is not None and offset >= index._next_boundary:
+                index._add(offset, mission_time)
+        return index
+
+    def seek_offset(self, time: float) -> int:
+        """ Byte offset in the flight to start reading from to see every block at or after a time (ms) """
+        # After a mission time reset, blocks anywhere before an entry can be at or after the time
+        if any(a > b for a, b in zip(self.times, self.times[1:])):
+            return 0
+        # Step back an extra entry since streams are not strictly ordered with each other
+        i = bisect_right(self.times, time) - 2
+        return self.offsets[i] if i >= 0 else 0
+
+    def to_file(self, path: Path, flight: Flight):
+        """ Saves the index of a flight, along with its superblock entry """
+        with open(path, "w") as f:
+            json.dump({"flight": flight_dict(flight), "stride_sectors": self.stride_sectors,
+                       "offsets": self.offsets, "times": self.times}, f)
+
+    @classmethod
+    def from_file(cls, path: Path, flight: Flight = None):
+        """ Loads a saved index, raising ValueError if it is for a different flight than the one given """
+        with open(path, "r") as f:
+            d = json.load(f)
+        if flight is not None and d.get("flight") != flight_dict(flight):
+            raise ValueError(f"{path} is the index of a different flight")
+        return TimeIndex(d["stride_sectors"], d["offsets"], d["times"])
+
+
+def index_path(imagedir: Path, flight_num: int) -> Path:
+    return imagedir.joinpath(f"flight_{flight_num}_time_index.json")
+
+
+def load_or_build_index(file, imagedir: Path, part_offset: int, flight_num: int, flight: Flight) -> TimeIndex:
+    """ Loads the saved index for a flight, building and saving it if there is none (or it is for a different
+    flight, as when another card was extracted to the same path) """
+    path = index_path(imagedir, flight_num)
+    try:
+        return TimeIndex.from_file(path, flight)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if hasattr(file, "time_index"):
+        # Version 2 mission files have their own index
+        index = file.time_index(flight)
+    else:
+        index = TimeIndex.build(file, part_offset, flight)
+    imagedir.mkdir(parents=True, exist_ok=True)
+    index.to_file(path, flight)
+    return index
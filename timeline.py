@@ -0,0 +1,230 @@
+# Merging of the sensor streams of a flight into one time ordered timeline, with optional resampling
+# to a fixed rate.
+#
+# Blocks are read in the order they were logged, which is close to but not exactly time order across
+# sensors (multi-sample blocks are logged after their samples were taken). Each sensor stream is in
+# time order on its own though, so a heap based k-way merge can put them in order while only buffering
+# samples that are newer than the latest sample of the slowest stream.
+
+import heapq
+import math
+from collections import deque
+from pathlib import Path
+
+from data_block import (AccelerationDataBlock, AltitudeDataBlock, AngularVelocityDataBlock, GNSSLocationBlock,
+                        KX134AccelerometerDataBlock, MPU9250IMUDataBlock)
+from handlers import BlockHandler
+from misc.converter import mt_to_ms
+from sd_block import TelemetryDataBlock
+
+# Field names of the values of each sensor stream
+STREAM_FIELDS = {
+    "altitude": ("pressure", "temperature", "altitude"),
+    "gnss_location": ("latitude", "longitude", "altitude", "speed", "course"),
+    "kx134_accelerometer": ("x", "y", "z"),
+    "mpu9250_imu": ("accel_x", "accel_y", "accel_z", "gyro_x", "gyro_y", "gyro_z",
+                    "mag_x", "mag_y", "mag_z", "temperature"),
+    "acceleration": ("x", "y", "z"),
+    "angular_velocity": ("x", "y", "z"),
+}
+
+# Default limit of samples held by a merger before it stops waiting for stalled streams
+MAX_BUFFERED = 65536
+# Rough memory used by a sample held by a merger, and by a step held by a resampler
+SAMPLE_BYTES = 400
+STEP_BYTES = 2048
+
+
+def gen_block_samples(block):
+    """ Generates (time in ms, stream name, values) for each sensor sample in a block """
+    if not isinstance(block, TelemetryDataBlock):
+        return
+    d = block.data
+    match d:
+        case AltitudeDataBlock():
+            yield mt_to_ms(d.mission_time), "altitude", (d.pressure, d.temperature, d.altitude)
+        case GNSSLocationBlock():
+            yield (mt_to_ms(d.mission_time), "gnss_location",
+                   (d.latitude / 600000, d.longitude / 600000, d.altitude, d.speed, d.course))
+        case KX134AccelerometerDataBlock():
+            for time, x, y, z in d.gen_samples():
+                yield time, "kx134_accelerometer", (x, y, z)
+        case MPU9250IMUDataBlock():
+            for time, s in d.gen_samples():
+                yield time, "mpu9250_imu", (s.accel_x, s.accel_y, s.accel_z, s.gyro_x, s.gyro_y, s.gyro_z,
+                                            s.mag_x, s.mag_y, s.mag_z, s.temperature)
+        case AccelerationDataBlock():
+            yield mt_to_ms(d.mission_time), "acceleration", (d.x, d.y, d.z)
+        case AngularVelocityDataBlock():
+            yield mt_to_ms(d.mission_time), "angular_velocity", (d.x, d.y, d.z)
+
+
+class TimelineMerger:
+    """ Merges samples from streams that are each in time order, but arrive interleaved, into one time
+    ordered stream. Samples are held until every active stream has reached their time, and for at least
+    delay ms so streams that have not been seen yet can catch up. A stream counts as stalled (and is no
+    longer waited for) once it is max_lag ms behind the newest sample, and at most max_buffered samples
+    are held. """
+
+    def __init__(self, delay: float = 1000, max_lag: float = 5000, max_buffered: int = MAX_BUFFERED):
+        self.delay: float = delay
+        self.max_lag: float = max_lag
+        self.max_buffered: int = max_buffered
+        self._heap = []
+        self._latest = dict()
+        self._newest = -math.inf
+        self._seq = 0
+
+    def push(self, time: float, stream: str, values: tuple):
+        """ Adds a sample, then returns the (time, stream, values) samples that are ready in order """
+        heapq.heappush(self._heap, (time, self._seq, stream, values))
+        self._seq += 1
+        self._latest[stream] = time
+        self._newest = max(self._newest, time)
+        return self._pop_ready()
+
+    def _pop_ready(self):
+        active = [t for t in self._latest.values() if t >= self._newest - self.max_lag]
+        watermark = min(min(active), self._newest - self.delay)
+        ready = []
+        heap = self._heap
+        while len(heap) != 0 and (heap[0][0] <= watermark or len(heap) > self.max_buffered):
+            time, _, stream, values = heapq.heappop(heap)
+            ready.append((time, stream, values))
+        return ready
+
+    def flush(self):
+        """ Returns all remaining samples in order """
+        ready = []
+        while len(self._heap) != 0:
+            time, _, stream, values = heapq.heappop(self._heap)
+            ready.append((time, stream, values))
+        return ready
+
+
+class Resampler:
+    """ Resamples a time ordered timeline to a fixed rate (Hz), giving (time in ms, {stream: values})
+    for each step. The value of each stream at a step is its last sample (method "hold") or is
+    interpolated between the samples either side of it (method "linear"). Streams without a sample yet
+    are left out. With linear interpolation a step is held until every stream has a sample after it, or
+    until max_pending steps are waiting, after which waiting streams hold their last value. """
+
+    def __init__(self, rate: float, method: str = "hold", max_pending: int = 4096):
+        if method not in ("hold", "linear"):
+            raise ValueError(f"Unknown resampling method: {method}")
+        self.period: float = 1000 / rate
+        self.method: str = method
+        self.max_pending: int = max_pending
+        self._latest = dict()
+        self._first = dict()
+        self._pending = deque()
+        self._step = None
+
+    def _fill(self, row, stream, time, values):
+        prev = self._latest[stream]
+        if self.method == "hold" or time == prev[0]:
+            row[1][stream] = prev[1]
+        else:
+            frac = (row[0] - prev[0]) / (time - prev[0])
+            row[1][stream] = tuple(a + ((b - a) * frac) for a, b in zip(prev[1], values))
+
+    def _is_complete(self, row):
+        return all(stream in row[1] for stream, first in self._first.items() if first <= row[0])
+
+    def _complete(self, row):
+        for stream, (_, values) in self._latest.items():
+            if self._first[stream] <= row[0]:
+                row[1].setdefault(stream, values)
+        return row
+
+    def push(self, time: float, stream: str, values: tuple):
+        """ Adds a sample, then returns the steps that are ready in order """
+        if self._step is None:
+            self._step = math.ceil(time / self.period) * self.period
+
+        # Steps that were waiting on this stream can now be interpolated
+        if stream in self._latest:
+            for row in self._pending:
+                if stream not in row[1] and row[0] >= self._first[stream]:
+                    self._fill(row, stream, time, values)
+
+        while self._step < time:
+            row = (self._step, dict())
+            if stream in self._latest:
+                self._fill(row, stream, time, values)
+            self._pending.append(row)
+            self._step += self.period
+
+        ready = []
+        pending = self._pending
+        while len(pending) != 0 and (self.method == "hold" or self._is_complete(pending[0]) or
+                                     len(pending) > self.max_pending):
+            ready.append(self._complete(pending.popleft()))
+
+        self._latest[stream] = (time, values)
+        self._first.setdefault(stream, time)
+        return ready
+
+    def flush(self):
+        """ Returns all remaining steps """
+        ready = [self._complete(row) for row in self._pending]
+        self._pending.clear()
+        # A step at the time of the last sample is only emitted now
+        if len(self._latest) != 0 and self._step <= max(time for time, _ in self._latest.values()):
+            ready.append(self._complete((self._step, dict())))
+            self._step += self.period
+        return ready
+
+
+class TimelineHandler(BlockHandler):
+    """ Writes every sensor sample of a flight to one time ordered timeline.csv, optionally resampled
+    to a fixed rate """
+    block_types = (AltitudeDataBlock, GNSSLocationBlock, KX134AccelerometerDataBlock, MPU9250IMUDataBlock,
+                   AccelerationDataBlock, AngularVelocityDataBlock)
+
+    def __init__(self, rate: float = None, method: str = "hold"):
+        self.merger = TimelineMerger()
+        self.resampler = Resampler(rate, method) if rate is not None else None
+        self.outfile = None
+
+    def limit_memory(self, nbytes: int):
+        super().limit_memory(nbytes // 4)
+        self.merger.max_buffered = max(nbytes // 2 // SAMPLE_BYTES, 1)
+        if self.resampler is not None:
+            self.resampler.max_pending = max(nbytes // 4 // STEP_BYTES, 1)
+
+    def open(self, flightdir: Path):
+        self.outfile = open(flightdir.joinpath("timeline.csv"), "w", buffering=self.buffer_size)
+        if self.resampler is None:
+            self.outfile.write("Mission Time (ms),Stream,Values\n")
+        else:
+            self.outfile.write("Mission Time (ms)," + ",".join(f"{stream} {field}" for stream, fields in
+                                                             STREAM_FIELDS.items() for field in fields) + "\n")
+
+    def _write(self, samples, flush=False):
+        if self.resampler is None:
+            self.outfile.writelines(f"{time},{stream},{','.join(str(v) for v in values)}\n"
+                                    for time, stream, values in samples)
+            return
+
+        rows = [row for sample in samples for row in self.resampler.push(*sample)]
+        if flush:
+            rows.extend(self.resampler.flush())
+        self.outfile.writelines(f"{step}," + ",".join(str(v) for stream, fields in STREAM_FIELDS.items()
+                                                      for v in values.get(stream, ("",) * len(fields))) + "\n"
+                                for step, values in rows)
+
+    def consume_batch(self, blocks):
+        samples = []
+        for block in blocks:
+            for sample in gen_block_samples(block):
+                samples.extend(self.merger.push(*sample))
+        self._write(samples)
+
+    def flush(self):
+        # Samples still waiting for slower streams stay in the merger
+        self.outfile.flush()
+
+    def close(self):
+        self._write(self.merger.flush(), flush=True)
+        self.outfile.close()